@@ -1,4 +1,6 @@
-from flask import Flask, make_response, jsonify
+from flask import Flask, make_response, jsonify, request
+import gzip, zlib
+from io import BytesIO
 from flask_pymongo import PyMongo
 
 def get_app_config(config_filename="config.py"):
@@ -24,9 +26,18 @@ def create_app(config_filename="config.py"):
     try: app.config.from_pyfile("/home/app/config.py", silent=True)
     except IOError: pass
 
+    # track mongo, apic, and dns time per request, the mongo command listener
+    # must be registered before the client is created
+    from .timing import register_request_timing
+    register_request_timing(app)
+
     # register dependent applications
     app.mongo = PyMongo(app)
 
+    # serialize and parse json with fastest available codec
+    from .jsoncodec import register_json_codec
+    register_json_codec(app)
+
     # register blueprints
     from .api import api
     app.register_blueprint(api)
@@ -34,6 +45,9 @@ def create_app(config_filename="config.py"):
     # register error handlers
     register_error_handler(app)
 
+    # compress responses for clients that accept it
+    register_compression(app)
+
     # return app instance
     return app
 
@@ -65,3 +79,47 @@ def register_error_handler(app):
 
     return None
 
+# response mimetypes that are compressed
+COMPRESS_MIMETYPES = ["application/json", "text/html", "text/plain",
+    "text/css", "application/javascript"]
+
+def compress_body(data, encoding, level=6):
+    """ return data compressed with gzip or deflate encoding """
+    if encoding == "gzip":
+        buf = BytesIO()
+        with gzip.GzipFile(mode="wb", compresslevel=level, fileobj=buf) as f:
+            f.write(data)
+        return buf.getvalue()
+    return zlib.compress(data, level)
+
+def register_compression(app):
+    """ register after_request handler that compresses responses with gzip or
+        deflate based on the request Accept-Encoding.  Responses smaller than
+        COMPRESS_MIN_SIZE bytes are sent uncompressed.  Set COMPRESS_LEVEL to
+        0 to disable compression
+    """
+    min_size = app.config.get("COMPRESS_MIN_SIZE", 1024)
+    level = app.config.get("COMPRESS_LEVEL", 6)
+    if level <= 0: return None
+
+    def compress_response(response):
+        if response.mimetype not in COMPRESS_MIMETYPES or \
+            response.direct_passthrough or \
+            "Content-Encoding" in response.headers:
+            return response
+        response.vary.add("Accept-Encoding")
+        # prefer gzip when both encodings are equally acceptable
+        accept = request.accept_encodings
+        encoding = max(["gzip", "deflate"], key=lambda e: (accept.quality(e),
+            e == "gzip"))
+        if accept.quality(encoding) <= 0:
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress_body(data, encoding, level))
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    app.after_request(compress_response)
+    return None
@@ -30,8 +30,6 @@
 """  This module contains the Session class that controls communication
      with the APIC.
 """
-import copy
-import json
 import logging
 import ssl
 import threading
@@ -40,7 +38,7 @@ import socket
 import base64
 import requests
 import sys
-from collections import namedtuple
+from collections import deque, namedtuple
 
 if sys.version_info < (3, 0, 0):
     from urllib import unquote
@@ -51,9 +49,12 @@ try:
     from requests.packages.urllib3.exceptions import InsecureRequestWarning
 except ImportError:
     pass
-from six.moves.queue import Queue
+from six.moves.queue import Empty
 from websocket import create_connection, WebSocketException
 from requests.exceptions import ConnectionError
+from ..jsonstream import DecodedResponse, load_imdata
+from .. import jsoncodec
+from .. import metrics
 try:
     from OpenSSL.crypto import FILETYPE_PEM, load_privatekey, sign
     NO_OPENSSL = False
@@ -70,6 +71,16 @@ else:
     except AttributeError:
         pass
 
+# max characters of response bodies included in debug logs
+LOG_BODY_MAX = 1024
+
+APIC_REQUEST_SECONDS = metrics.histogram(
+    'apic_request_seconds', 'APIC request latency until response headers',
+    ['method', 'url'])
+APIC_RESPONSES = metrics.counter(
+    'apic_responses_total', 'APIC responses by status code',
+    ['method', 'url', 'code'])
+
 
 class CredentialsError(Exception):
     def __init___(self, message):
@@ -108,6 +119,7 @@ class Login(threading.Thread):
     def run(self):
         while not self._exit:
             time.sleep(self._login_timeout)
+            if self._exit: break
             try:
                 resp = self._apic.refresh_login(timeout=120)
             except ConnectionError:
@@ -130,10 +142,157 @@ class Login(threading.Thread):
                 self._apic.login_error = True
 
 
+class EventQueue(object):
+    """
+    FIFO queue of decoded events shared by the EventHandler thread and the
+    thread consuming events.  If maxsize is greater than 0 the queue is
+    bounded and the policy determines what happens when it is full:
+        block       - put waits until the consumer has removed an event
+        drop-oldest - the oldest event is discarded and resync is set to
+                      indicate that events have been lost
+    """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+
+    def __init__(self, maxsize=0, policy=BLOCK):
+        if policy not in (EventQueue.BLOCK, EventQueue.DROP_OLDEST):
+            raise ValueError('Invalid event queue policy: %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.high_water = 0
+        self.dropped = 0
+        self.resync = False
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def put(self, event, force=False):
+        """
+        Add an event to the end of the queue.
+
+        :param event: Event to add
+        :param force: If True, add the event even if the queue is full
+        """
+        with self._lock:
+            if self.maxsize > 0 and not force:
+                while len(self._queue) >= self.maxsize:
+                    if self.policy == EventQueue.BLOCK:
+                        self._not_full.wait()
+                        continue
+                    dropped = self._queue.popleft()
+                    if dropped is not None:
+                        self.dropped += 1
+                        self.resync = True
+            self._queue.append(event)
+            if len(self._queue) > self.high_water:
+                self.high_water = len(self._queue)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the event at the front of the queue.
+
+        :param block: If False, raise Empty immediately if no event is queued
+        :param timeout: Maximum seconds to block or None to wait forever
+        """
+        with self._lock:
+            if not block:
+                if not self._queue:
+                    raise Empty
+            elif timeout is None:
+                while not self._queue:
+                    self._not_empty.wait()
+            else:
+                end_time = time.time() + timeout
+                while not self._queue:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+            event = self._queue.popleft()
+            self._not_full.notify()
+            return event
+
+    def empty(self):
+        return len(self._queue) == 0
+
+    def qsize(self):
+        return len(self._queue)
+
+    def clear_resync(self):
+        """
+        Clear the resync flag.
+
+        :returns: True if events were dropped since the last call
+        """
+        with self._lock:
+            resync = self.resync
+            self.resync = False
+            return resync
+
+    def stats(self):
+        """
+        :returns: Dictionary with the current depth, high-water mark, and\
+                  number of dropped events
+        """
+        with self._lock:
+            return {'depth': len(self._queue), 'high_water': self.high_water,
+                    'dropped': self.dropped, 'maxsize': self.maxsize,
+                    'policy': self.policy}
+
+
+class TransferStats(object):
+    """
+    Thread-safe counters of bytes received from the APIC.  wire_bytes is the
+    size of the response bodies as transferred (compressed if the APIC used a
+    content encoding) and body_bytes is the size after decompression.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.compressed = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+
+    def add(self, resp, body_bytes=None):
+        """
+        Record a response once its body has been read
+
+        :param resp: Instance of requests.Response
+        :param body_bytes: Number of decompressed bytes read from a streamed\
+                           response, defaults to the length of resp.content
+        """
+        if body_bytes is None:
+            body_bytes = len(resp.content)
+        # urllib3 tracks bytes read from the connection before decoding
+        tell = getattr(resp.raw, 'tell', None)
+        wire_bytes = tell() if tell is not None else body_bytes
+        with self._lock:
+            self.responses += 1
+            if resp.headers.get('Content-Encoding') in ('gzip', 'deflate'):
+                self.compressed += 1
+            self.wire_bytes += wire_bytes
+            self.body_bytes += body_bytes
+
+    def stats(self):
+        """
+        :returns: Dictionary with the number of responses and compressed\
+                  responses, wire and decompressed bytes, and the ratio\
+                  between them
+        """
+        with self._lock:
+            ratio = float(self.body_bytes) / self.wire_bytes if self.wire_bytes else 1.0
+            return {'responses': self.responses, 'compressed': self.compressed,
+                    'wire_bytes': self.wire_bytes, 'body_bytes': self.body_bytes,
+                    'ratio': round(ratio, 2)}
+
+
 class EventHandler(threading.Thread):
     """
     Thread responsible for websocket communication.
-    Receives events through the websocket and places them into a Queue
+    Receives events through the websocket, decodes them, and places them
+    into the EventQueue
     """
     def __init__(self, subscriber):
         threading.Thread.__init__(self)
@@ -156,9 +315,13 @@ class EventHandler(threading.Thread):
                 continue
 
             # @agccie - add server receive timestamp to event
-            # instead of converting to json and back to string, manually add
-            # attribute at the end of the string
-            event = event.strip()[:-1]+",\"_ts\":%s}" % time.time()
+            ts = time.time()
+            try:
+                event = jsoncodec.loads(event)
+            except ValueError:
+                logging.error('Non-JSON event: %s', event)
+                continue
+            event['_ts'] = ts
             self.subscriber._event_q.put(event)
 
 
@@ -169,14 +332,15 @@ class Subscriber(threading.Thread):
     subscriptions before timer expiry.  It also reissues the
     subscriptions when the APIC login is refreshed.
     """
-    def __init__(self, apic):
+    def __init__(self, apic, queue_size=0, queue_policy=EventQueue.BLOCK):
         threading.Thread.__init__(self)
         self._apic = apic
         self._subscriptions = {}
+        self._subscription_urls = {}
         self._ws = None
         self._ws_url = None
         self._refresh_time = 30
-        self._event_q = Queue()
+        self._event_q = EventQueue(maxsize=queue_size, policy=queue_policy)
         self._events = {}
         self._exit = False
         self.event_handler_thread = None
@@ -187,6 +351,21 @@ class Subscriber(threading.Thread):
         """
         self._exit = True
 
+    def _set_subscription(self, url, subscription_id):
+        """
+        Set the subscription id for the specified URL and maintain the reverse
+        index of subscription id to URL used to route events.
+
+        :param url: URL string of the subscription
+        :param subscription_id: subscription id or None if not subscribed
+        """
+        old_id = self._subscriptions.get(url, None)
+        if old_id is not None and self._subscription_urls.get(str(old_id)) == url:
+            del self._subscription_urls[str(old_id)]
+        self._subscriptions[url] = subscription_id
+        if subscription_id is not None:
+            self._subscription_urls[str(subscription_id)] = url
+
     def _send_subscription(self, url, only_new=False):
         """
         Send the subscription for the specified URL.
@@ -196,20 +375,20 @@ class Subscriber(threading.Thread):
         try:
             resp = self._apic.get(url)
         except ConnectionError:
-            self._subscriptions[url] = None
+            self._set_subscription(url, None)
             logging.error('Could not send subscription to APIC for url %s', url)
             resp = requests.Response()
             resp.status_code = 404
             resp._content = '{"error": "Could not send subscription to APIC"}'
             return resp
         if not resp.ok:
-            self._subscriptions[url] = None
+            self._set_subscription(url, None)
             logging.error('Could not send subscription to APIC for url %s', url)
             resp = requests.Response()
             resp.status_code = 404
             resp._content = '{"error": "Could not send subscription to APIC"}'
             return resp
-        resp_data = json.loads(resp.text)
+        resp_data = jsoncodec.loads(resp.text)
         if 'subscriptionId' not in resp_data:
             logging.error('Did not receive proper subscription response from APIC for url %s response: %s', url, resp_data)
             resp = requests.Response()
@@ -217,13 +396,16 @@ class Subscriber(threading.Thread):
             resp._content = '{"error": "Could not send subscription to APIC"}'
             return resp
         subscription_id = resp_data['subscriptionId']
-        self._subscriptions[url] = subscription_id
+        self._set_subscription(url, subscription_id)
         if not only_new:
             while len(resp_data['imdata']):
                 event = {"totalCount": "1",
                          "subscriptionId": [resp_data['subscriptionId']],
-                         "imdata": [resp_data["imdata"][0]]}
-                self._event_q.put(json.dumps(event))
+                         "imdata": [resp_data["imdata"][0]],
+                         "_ts": time.time()}
+                # initial objects may be queued by the consuming thread so
+                # they are always added regardless of the queue bound
+                self._event_q.put(event, force=True)
                 resp_data["imdata"].remove(resp_data["imdata"][0])
         return resp
 
@@ -306,6 +488,7 @@ class Subscriber(threading.Thread):
         for url in self._subscriptions:
             urls.append(url)
         self._subscriptions = {}
+        self._subscription_urls = {}
         for url in urls:
             self.subscribe(url, only_new=True)
 
@@ -318,26 +501,30 @@ class Subscriber(threading.Thread):
             return
 
         while not self._event_q.empty():
-            event = self._event_q.get()
-            orig_event = event
             try:
-                event = json.loads(event)
-            except ValueError:
-                logging.error('Non-JSON event: %s', orig_event)
+                self._route_event(self._event_q.get(block=False))
+            except Empty:
+                break
+
+    def _route_event(self, event):
+        """
+        Put a single event from the event queue into the bucket of each URL
+        subscription it belongs to.
+        """
+        if event is None:
+            # wake sentinel from wake()
+            return
+        # Find the URL for each subscription of this event.  An event that
+        # belongs to several subscriptions is shared between them and must
+        # not be modified by the receiver
+        for subscription_id in event['subscriptionId']:
+            url = self._subscription_urls.get(str(subscription_id), None)
+            if url is None:
+                logging.debug('Event for unknown subscription %s', subscription_id)
                 continue
-            # Find the URL for this event
-            num_subscriptions = len(event['subscriptionId'])
-            for i in range(0, num_subscriptions):
-                url = None
-                for k in self._subscriptions:
-                    if self._subscriptions[k] == str(event['subscriptionId'][i]):
-                        url = k
-                        break
-                if url not in self._events:
-                    self._events[url] = []
-                self._events[url].append(event)
-                if num_subscriptions > 1:
-                    event = copy.deepcopy(event)
+            if url not in self._events:
+                self._events[url] = []
+            self._events[url].append(event)
 
     def subscribe(self, url, only_new=False):
         """
@@ -403,6 +590,62 @@ class Subscriber(threading.Thread):
         logging.debug('Event received %s', event)
         return event
 
+    def get_events(self, url):
+        """
+        Get all pending events for a particular APIC URL subscription in the
+        order they were received.
+
+        :param url: URL string to get pending events
+        :returns: List of events, empty if no events are pending.  Events\
+                  may be shared with other subscriptions and must not be\
+                  modified.
+        """
+        self._process_event_q()
+        events = self._events.get(url, [])
+        self._events[url] = []
+        return events
+
+    def wait_for_events(self, timeout=None):
+        """
+        Block until at least one event has been received or wake() is called.
+
+        :param timeout: Maximum seconds to wait.  If None, wait until an\
+                        event is received or wake() is called.
+        :returns: True if events are pending for any subscription
+        """
+        for url in self._events:
+            if len(self._events[url]) > 0:
+                return True
+        try:
+            self._route_event(self._event_q.get(timeout=timeout))
+        except Empty:
+            return False
+        self._process_event_q()
+        for url in self._events:
+            if len(self._events[url]) > 0:
+                return True
+        return False
+
+    def wake(self):
+        """
+        Wake any caller blocked in wait_for_events.
+        """
+        self._event_q.put(None, force=True)
+
+    def resync_required(self):
+        """
+        Check if events have been dropped from the event queue since the last
+        call.  If True, the receiver should discard pending events and reload
+        the current state of its subscriptions.
+        """
+        return self._event_q.clear_resync()
+
+    def get_event_queue_stats(self):
+        """
+        :returns: Dictionary of event queue statistics
+        """
+        return self._event_q.stats()
+
     def unsubscribe(self, url):
         """
         Unsubscribe from a particular APIC URL.  Used internally by the
@@ -425,6 +668,7 @@ class Subscriber(threading.Thread):
         # Chew up any outstanding events
         while self.has_events(url):
             self.get_event(url)
+        self._set_subscription(url, None)
         del self._subscriptions[url]
         if not self._subscriptions:
             self._ws.close(timeout=0)
@@ -445,7 +689,9 @@ class Session(object):
        This class is responsible for all communication with the APIC.
     """
     def __init__(self, url, uid, pwd=None, cert_name=None, key=None, verify_ssl=False,
-                 appcenter_user=False, subscription_enabled=True, proxies=None):
+                 appcenter_user=False, subscription_enabled=True, proxies=None,
+                 event_queue_size=0, event_queue_policy=EventQueue.BLOCK,
+                 token_login=True):
         """
         :param url:  String containing the APIC URL such as ``https://1.2.3.4``
         :param uid: String containing the username that will be used as\
@@ -463,6 +709,17 @@ class Session(object):
         the context of an APIC appcenter app
         :param proxies: Optional dictionary containing the proxies passed\
         directly to the Requests library
+        :param event_queue_size: Maximum number of received subscription\
+        events waiting to be processed, 0 for unbounded
+        :param event_queue_policy: 'block' to stop reading the websocket or\
+        'drop-oldest' to discard events (and require a resync) when the event\
+        queue is full.  A blocked websocket does not answer pings and may be\
+        closed by the APIC, losing events without a resync
+        :param token_login: When using certificate authentication, login once\
+        with a signed request and authenticate following requests with the\
+        returned token instead of signing every request.  Requests are signed\
+        again if the token cannot be obtained or refreshed.  Always enabled for\
+        appcenter_user with subscription enabled
 
         """
         if not isinstance(url, basestring):
@@ -529,15 +786,19 @@ class Session(object):
         self.api = url
         self.session = None
         self.verify_ssl = verify_ssl
+        self.transfer_stats = TransferStats()
         self.token = None
         self.login_thread = Login(self)
         self._relogin_callbacks = []
         self.login_error = False
         self._logged_in = False
         self._subscription_enabled = subscription_enabled
+        self._token_login = self.cert_auth and (token_login or
+                                                (appcenter_user and subscription_enabled))
         self._proxies = proxies
         if subscription_enabled:
-            self.subscription_thread = Subscriber(self)
+            self.subscription_thread = Subscriber(self, queue_size=event_queue_size,
+                                                  queue_policy=event_queue_policy)
             self.subscription_thread.daemon = True
             self.subscription_thread.start()
 
@@ -549,6 +810,39 @@ class Session(object):
         """
         return self.__class__, (self.api, self.uid, self.pwd)
 
+    def _new_session(self):
+        """
+        Return a requests session that asks the APIC for compressed bodies
+        and records the size of each response in transfer_stats
+        """
+        session = requests.Session()
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        session.hooks['response'].append(self._record_transfer)
+        return session
+
+    def _record_transfer(self, resp, *args, **kwargs):
+        """
+        Response hook adding the response to transfer_stats and the request
+        latency metrics.  The body of a streamed response has not been read
+        yet so it is recorded by jsonstream.load_imdata once decoded.
+        """
+        method = resp.request.method
+        url = metrics.url_label(resp.request.path_url)
+        APIC_REQUEST_SECONDS.observe(resp.elapsed.total_seconds(),
+                                     method=method, url=url)
+        APIC_RESPONSES.inc(method=method, url=url, code=resp.status_code)
+        if kwargs.get('stream'):
+            resp.transfer_stats = self.transfer_stats
+        else:
+            self.transfer_stats.add(resp)
+
+    def get_transfer_stats(self):
+        """
+        :returns: Dictionary with the number of responses received and the\
+                  compressed and decompressed byte counts
+        """
+        return self.transfer_stats.stats()
+
     def _prep_x509_header(self, method, url, data=None):
         """
         This function returns a dictionary containing the authentication signature for a given
@@ -565,13 +859,13 @@ class Session(object):
         if not self.cert_auth:
             return {}
 
-        # for appcenter_user with subscription enabled and currently logged_in
-        # no need to build x509 header since authentication is using token
-        if self.appcenter_user and self._subscription_enabled and self._logged_in:
+        # with token login and currently logged_in no need to build x509 header
+        # since authentication is using token
+        if self._token_login and self._logged_in:
             return {}
 
         if not self.session:
-            self.session = requests.Session()
+            self.session = self._new_session()
 
         if self.appcenter_user:
             cert_dn = 'uni/userext/appuser-{0}/usercert-{1}'.format(self.uid, self.cert_name)
@@ -580,18 +874,12 @@ class Session(object):
 
         url = unquote(url)
 
-        logging.debug((
+        logging.debug(
             "Preparing certificate based authentication with:"
-            "\n Cert DN: {}"
-            "\n Key file: {} "
-            "\n Request: {} {}"
-            "\n Data: {}").format(
-                cert_dn,
-                self.key,
-                method,
-                url,
-                data)
-        )
+            "\n Cert DN: %s"
+            "\n Key file: %s "
+            "\n Request: %s %s"
+            "\n Data: %.*s", cert_dn, self.key, method, url, LOG_BODY_MAX, data)
 
         payload = '{}{}'.format(method, url)
         if data:
@@ -603,7 +891,7 @@ class Session(object):
                     'APIC-Certificate-Fingerprint': 'fingerprint',
                     'APIC-Certificate-DN': cert_dn}
 
-        logging.debug('Authentication cookie %s' % cookie)
+        logging.debug('Authentication cookie %s', cookie)
         return cookie
 
     def _send_login(self, timeout=None):
@@ -616,12 +904,16 @@ class Session(object):
                 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
             except AttributeError:
                 pass
-        self.session = requests.Session()
+        self.session = self._new_session()
         self._logged_in = False
 
-        if self.appcenter_user and self._subscription_enabled:
+        if self._token_login and self.appcenter_user:
             login_url = '/api/requestAppToken.json'
             data = {'aaaAppToken':{'attributes':{'appName': self.cert_name}}}
+        elif self._token_login:
+            # aaaLogin signed with the certificate returns a token
+            login_url = '/api/aaaLogin.json'
+            data = {'aaaUser': {'attributes': {'name': self.uid}}}
         elif self.cert_auth:
             logging.warning('Will not explicitly login because certificate based authentication is being used for this session.')
             logging.warning('If permanently using cert auth, consider removing the call to login().')
@@ -631,14 +923,24 @@ class Session(object):
             login_url = '/api/aaaLogin.json'
             data = {'aaaUser': {'attributes': {'name': self.uid,
                                                 'pwd': self.pwd}}}
-        ret = self.push_to_apic(login_url, data=data, timeout=timeout)
+        try:
+            ret = self.push_to_apic(login_url, data=data, timeout=timeout)
+        except requests.exceptions.HTTPError as e:
+            if not self.cert_auth:
+                raise
+            ret = e.response
         if not ret.ok:
             logging.error('Could not relogin to APIC. Aborting login thread.')
             self.login_thread.exit()
             if self._subscription_enabled: self.subscription_thread.exit()
+            elif self.cert_auth:
+                # without a token every request is signed with the certificate
+                logging.warning('Token login failed, falling back to certificate signature per request.')
+                CertAuthResponse = namedtuple('CertAuthResponse', ['ok'])
+                return CertAuthResponse(ok=True)
             return ret
         self._logged_in = True
-        ret_data = json.loads(ret.text)['imdata'][0]
+        ret_data = jsoncodec.loads(ret.text)['imdata'][0]
         timeout = ret_data['aaaLogin']['attributes']['refreshTimeoutSeconds']
         self.token = str(ret_data['aaaLogin']['attributes']['token'])
         if self._subscription_enabled:
@@ -663,7 +965,7 @@ class Session(object):
             resp = requests.Response()
             resp.status_code = 404
             resp._content = '{"error": "Could not relogin to APIC due to ConnectionError"}'
-        if (self.appcenter_user and self._subscription_enabled) or not self.cert_auth:
+        if self._logged_in or not self.cert_auth:
             self.login_thread.daemon = True
             self.login_thread.start()
         return resp
@@ -685,7 +987,7 @@ class Session(object):
         """
         refresh_url = '/api/aaaRefresh.json'
         resp = self.get(refresh_url, timeout=timeout)
-        ret_data = json.loads(resp.text)['imdata'][0]
+        ret_data = jsoncodec.loads(resp.text)['imdata'][0]
         self.token = str(ret_data['aaaLogin']['attributes']['token'])
         return resp
 
@@ -755,6 +1057,46 @@ class Session(object):
         """
         return self.subscription_thread.get_event(url)
 
+    def get_events(self, url):
+        """
+        Get all pending events for a particular URL.
+
+        :param url:  URL string belonging to subscription
+        :returns: List of events in the order they were received
+        """
+        return self.subscription_thread.get_events(url)
+
+    def wait_for_events(self, timeout=None):
+        """
+        Block until an event is received for any subscription, timeout\
+        seconds have elapsed, or wake_events is called.
+
+        :param timeout:  Maximum seconds to wait or None to wait forever
+        :returns: True if events are pending for any subscription
+        """
+        return self.subscription_thread.wait_for_events(timeout=timeout)
+
+    def wake_events(self):
+        """
+        Wake any caller blocked in wait_for_events.
+        """
+        self.subscription_thread.wake()
+
+    def resync_required(self):
+        """
+        Check if subscription events have been dropped since the last call.
+
+        :returns: True if the receiver needs to reload subscribed objects
+        """
+        return self.subscription_thread.resync_required()
+
+    def get_event_queue_stats(self):
+        """
+        :returns: Dictionary with the event queue depth, high-water mark,\
+                  and number of dropped events
+        """
+        return self.subscription_thread.get_event_queue_stats()
+
     def unsubscribe(self, url):
         """
         Unsubscribe from events for a particular URL.  Used internally by the
@@ -779,9 +1121,8 @@ class Session(object):
         post_url = self.api + url
         logging.debug('Posting url: %s data: %s', post_url, data)
 
-        if self.cert_auth and not \
-            (self.appcenter_user and self._subscription_enabled and self._logged_in):
-            data = json.dumps(data, sort_keys=True)
+        if self.cert_auth and not (self._token_login and self._logged_in):
+            data = jsoncodec.dumps(data, sort_keys=True)
             cookies = self._prep_x509_header('POST', url, data)
             resp = self.session.post(post_url, data=data, verify=self.verify_ssl,
                                      timeout=timeout, proxies=self._proxies, cookies=cookies)
@@ -789,26 +1130,31 @@ class Session(object):
                 logging.error('Certificate authentication failed. Please check all settings are correct.')
                 resp.raise_for_status()
         else:
-            resp = self.session.post(post_url, data=json.dumps(data, sort_keys=True), verify=self.verify_ssl,
+            resp = self.session.post(post_url, data=jsoncodec.dumps(data, sort_keys=True), verify=self.verify_ssl,
                                     timeout=timeout, proxies=self._proxies)
             if resp.status_code == 403:
-                logging.error(resp.text)
+                logging.error('%.*s', LOG_BODY_MAX, resp.text)
                 logging.error('Trying to login again....')
                 resp = self._send_login()
                 self.resubscribe()
                 logging.error('Trying post again...')
                 logging.debug(post_url)
-                resp = self.session.post(post_url, data=json.dumps(data, sort_keys=True), verify=self.verify_ssl,
-                                        timeout=timeout, proxies=self._proxies)
-        logging.debug('Response: %s %s', resp, resp.text)
+                data = jsoncodec.dumps(data, sort_keys=True)
+                cookies = self._prep_x509_header('POST', url, data)
+                resp = self.session.post(post_url, data=data, verify=self.verify_ssl,
+                                        timeout=timeout, proxies=self._proxies, cookies=cookies)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Response: %s %.*s', resp, LOG_BODY_MAX, resp.text)
         return resp
 
-    def get(self, url, timeout=None):
+    def get(self, url, timeout=None, stream=False):
         """
         Perform a REST GET call to the APIC.
 
         :param url: String containing the URL that will be used to\
         send the object data to the APIC.
+        :param stream: If True, the response body is not read until accessed\
+        so it can be decoded incrementally with jsonstream.load_imdata.
         :returns: Response class instance from the requests library.\
         response.ok is True if request is sent successfully.\
         response.json() will return the JSON data sent back by the APIC.
@@ -817,54 +1163,66 @@ class Session(object):
         logging.debug(get_url)
 
         cookies = self._prep_x509_header('GET', url)
-        resp = self.session.get(get_url, timeout=timeout, verify=self.verify_ssl, proxies=self._proxies, cookies=cookies)
+        resp = self.session.get(get_url, timeout=timeout, verify=self.verify_ssl, proxies=self._proxies, cookies=cookies,
+                                stream=stream)
         if resp.status_code == 403:
-            if self.cert_auth and not (self.appcenter_user and self._subscription_enabled):
+            if self.cert_auth and not self._token_login:
                 logging.error('Certificate authentication failed. Please check all settings are correct.')
                 resp.raise_for_status()
             else:
-                logging.error(resp.text)
+                logging.error('%.*s', LOG_BODY_MAX, resp.text)
+                # release the connection of the rejected (possibly streamed)
+                # response before sending new requests
+                resp.close()
                 logging.error('Trying to login again....')
                 resp = self._send_login()
                 self.resubscribe()
                 logging.error('Trying get again...')
                 logging.debug(get_url)
-                resp = self.session.get(get_url, timeout=timeout, verify=self.verify_ssl, proxies=self._proxies)
+                cookies = self._prep_x509_header('GET', url)
+                resp = self.session.get(get_url, timeout=timeout, verify=self.verify_ssl, proxies=self._proxies,
+                                        cookies=cookies, stream=stream)
         elif resp.status_code == 400 and 'Unable to process the query, result dataset is too big' in resp.text:
             # Response is too big so we will need to get the response in pages
-            # Get the first chunk of entries
+            # Get the first chunk of entries.  Each page is decoded as it is
+            # received and the combined entries are returned without being
+            # serialized again
             logging.error('Response too big. Need to collect it in pages. Starting collection...')
+            resp.close()
             page_number = 0
             logging.debug('Getting first page')
             cookies = self._prep_x509_header('GET', url + '&page=%s&page-size=10000' % page_number)
             resp = self.session.get(get_url + '&page=%s&page-size=10000' % page_number,
-                                    timeout=timeout, verify=self.verify_ssl, proxies=self._proxies, cookies=cookies)
+                                    timeout=timeout, verify=self.verify_ssl, proxies=self._proxies, cookies=cookies,
+                                    stream=True)
             entries = []
             if resp.ok:
-                entries += resp.json()['imdata']
-                orig_total_count = int(resp.json()['totalCount'])
+                (imdata, attributes) = load_imdata(resp)
+                entries += imdata
+                orig_total_count = int(attributes['totalCount'])
                 total_count = orig_total_count - 10000
                 while total_count > 0 and resp.ok:
                     page_number += 1
-                    logging.debug('Getting page %s' % page_number)
+                    logging.debug('Getting page %s', page_number)
                     # Get the next chunk
                     cookies = self._prep_x509_header('GET', url + '&page=%s&page-size=10000' % page_number)
                     resp = self.session.get(get_url + '&page=%s&page-size=10000' % page_number,
                                             timeout=timeout, verify=self.verify_ssl,
-                                            proxies=self._proxies, cookies=cookies)
+                                            proxies=self._proxies, cookies=cookies, stream=True)
                     if resp.ok:
-                        entries += resp.json()['imdata']
+                        entries += load_imdata(resp)[0]
                         total_count -= 10000
-                resp_content = {'imdata': entries,
-                                'totalCount': orig_total_count}
-                resp._content = json.dumps(resp_content)
+                resp = DecodedResponse(resp, {'imdata': entries,
+                                              'totalCount': orig_total_count})
         elif 400 < resp.status_code < 600:
-            logging.debug('Received error: %s %s' % (str(resp.status_code), resp.text))
+            logging.debug('Received error: %s %.*s', resp.status_code, LOG_BODY_MAX, resp.text)
             retries = 3
             while retries > 0:
                 logging.debug('Retrying query')
+                resp.close()
                 cookies = self._prep_x509_header('GET', url)
-                resp = self.session.get(get_url, timeout=timeout, verify=self.verify_ssl, proxies=self._proxies, cookies=cookies)
+                resp = self.session.get(get_url, timeout=timeout, verify=self.verify_ssl, proxies=self._proxies, cookies=cookies,
+                                        stream=stream)
                 if resp.status_code != 200:
                     logging.debug('Retry was not successful.')
                     retries -= 1
@@ -875,7 +1233,11 @@ class Session(object):
                 logging.error('Raising ConnectionError')
                 raise ConnectionError
         logging.debug(resp)
-        logging.debug(resp.text)
+        # streamed and decoded bodies are left for the caller to read.  The
+        # body is only decoded to text when debug logging is enabled
+        if not stream and not isinstance(resp, DecodedResponse) and \
+                logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('%.*s', LOG_BODY_MAX, resp.text)
         return resp
 
     def register_login_callback(self, callback_fn):
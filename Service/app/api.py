@@ -1,8 +1,14 @@
 
-import logging, time
-from dns import resolver, reversename, exception
-from flask import Blueprint, jsonify, abort, current_app
-from .utils import (setup_logger, get_apic_session, get_class, get_user_params)
+import logging, time, re, os
+from dns import exception
+from flask import Blueprint, Response, jsonify, abort, current_app
+from .utils import (setup_logger, apic_session, get_class, get_user_params,
+    get_user_data, set_log_level, get_log_levels)
+from .dnscache import (lookup_ptr, resolve_bulk, get_cached, set_cached,
+    expire_ts)
+from .dnsresolver import get_resolver_engine
+from .prefixtrie import get_endpoint_trie
+from . import metrics
 api = Blueprint("/", __name__)
 
 # module level logging
@@ -13,13 +19,55 @@ def is_alive():
     """ api to verify server is alive """
     return jsonify({'status': '200', 'text': "It's alive !"})
 
+@api.route("/metrics")
+def get_metrics():
+    """ return metrics of this app process in prometheus text format """
+    return Response(metrics.REGISTRY.render(),
+        mimetype="text/plain; version=0.0.4")
+
+@api.route("/metrics/subscriber")
+def get_subscriber_metrics():
+    """ return the most recent metrics written by the subscriber process in
+        prometheus text format.  Abort with 404 if not available
+    """
+    path = os.path.join(current_app.config["LOG_DIR"],
+        metrics.SUBSCRIBER_METRICS_FILE)
+    try:
+        with open(path, "r") as f:
+            data = f.read()
+    except IOError as e:
+        abort(404, "subscriber metrics not available")
+    return Response(data, mimetype="text/plain; version=0.0.4")
+
+@api.route("/loglevel.json", methods=["GET", "POST"])
+def log_level():
+    """ return configured levels of app loggers in this process.  Set the
+        level of a logger by providing 'level' (name or number) and optional
+        'logger' (default 'app') in POST data or as parameters.  A logger
+        without a level (NOTSET) uses the level of its parent.  Only the
+        loggers of the api process serving the request are changed, the
+        subscriber levels are set with LOG_LEVELS
+
+        returns {"levels": {<logger>: <level>, ...}}
+    """
+    data = get_user_data()
+    if len(data) == 0: data = get_user_params()
+    name = data.get("logger", "app")
+    if "level" in data:
+        if name != "app" and not name.startswith("app."):
+            abort(400, "logger must be app or an app module")
+        try:
+            set_log_level(name, data["level"])
+        except ValueError as e:
+            abort(400, "invalid log level %s" % data["level"])
+    return jsonify({"levels":get_log_levels()})
+
 @api.route('/tenant.json')
 def get_tenant():
     """ test api that returns all tenants - just for fun """
-    session = get_apic_session()
-    if session is None: abort(500, "unable to connect to APIC")
-    
-    objects = get_class(session, "fvTenant") 
+    with apic_session() as session:
+        if session is None: abort(500, "unable to connect to APIC")
+        objects = get_class(session, "fvTenant")
     if objects is None: abort(500, "unable to query fvTenants")
     
     # let's just return tenant names
@@ -44,45 +92,170 @@ def resolve():
         abort(400, "ip parameter required for resolve")
 
     # check cache first
-    logger.debug("checking dnsCache for %s" % ip)
+    logger.debug("checking dnsCache for %s", ip)
     db = current_app.mongo.db
-    cache = db.dnsCache.find_one({"addr":ip})
+    cache = get_cached(db, ip)
     if cache is not None:
-        # check that entry did not expire
-        delta = cache["expire"] - ts
-        if delta <= 0:
-            logger.debug("cache entry expired at %s (%ssec)" % (
-                cache["expire"], -1*delta))
-        else:
-            logger.debug("returning result from cache: %s, (timeout:%ssec)"%(
-                cache, delta))
-            return jsonify({"ip":ip, "ptr":cache["ptr"], "cache":True})
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("returning result from cache: %s, (timeout:%ssec)",
+                cache, expire_ts(cache) - ts)
+        return jsonify({"ip":ip, "ptr":cache["ptr"], "cache":True})
 
     # no hit on the cache, collect nameserver info and perform lookup
-    nameservers = []
-    for prov in db.dnsProv.find({}):
-        if prov["preferred"]: nameservers.insert(0, prov["addr"])
-        else: nameservers.append(prov["addr"])
-    
-    if len(nameservers) == 0:
+    engine = get_resolver_engine(db)
+    if len(engine.nameservers) == 0:
         abort(500, "no dnsProv configured on apic")
-    logger.debug("dns lookup for %s against %s" % (ip, nameservers))
+    # ordered() takes the resolver lock and sorts, only build it for debug
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("dns lookup for %s against %s", ip, engine.ordered())
 
-    r = resolver.Resolver()
     try:
-        lookup = r.query(reversename.from_address(ip), "PTR")
-        (ptr, expire) = (lookup[0].to_text(), lookup.expiration)
-    except resolver.NXDOMAIN as e:
-        logger.debug("resolver not found: %s" % e)
-        (ptr, expire) = ("n/a", ts+600)     # cache for 10 minutes
+        cache = lookup_ptr(engine, ip)
     except exception.SyntaxError as e:
         # should only be raised on invalid address
         abort(500, "invalid address %s" % ip)
 
     # add entry to cache
-    cache = {"addr":ip, "ptr":ptr, "expire":expire}
-    logger.debug("returning and adding result to cache: %s" % cache)
-    db.dnsCache.update_one({"addr":ip}, {"$set":cache}, upsert=True)
+    logger.debug("returning and adding result to cache: %s", cache)
+    set_cached(db, cache)
 
     # return result
     return jsonify({"ip":ip,"ptr":cache["ptr"], "cache":False})
+
+@api.route("/resolve_bulk.json", methods=["GET", "POST"])
+def resolve_many():
+    """ resolve dns for a list of ipv4 or ipv6 addresses.  Addresses are
+        provided as a list in POST data {"ips": [...]} or as a comma separated
+        'ips' parameter.  Cached entries are returned from dnsCache and all
+        misses are resolved concurrently and added to dnsCache.
+
+        returns {"results": [...]} in the same order as the provided addresses
+        where each result is {"ip", "ptr", "cache"} or {"ip", "error"}
+    """
+    ips = get_user_data().get("ips", None)
+    if ips is None:
+        ips = get_user_params().get("ips", "").split(",")
+    if not isinstance(ips, list):
+        abort(400, "ips must be a list of addresses")
+    # remove empty and duplicate entries while maintaining order
+    (addrs, seen) = ([], set())
+    for ip in ips:
+        if not isinstance(ip, basestring):
+            abort(400, "invalid address %s" % ip)
+        ip = ip.strip()
+        if len(ip) > 0 and ip not in seen:
+            seen.add(ip)
+            addrs.append(ip)
+    if len(addrs) == 0:
+        abort(400, "ips parameter required for resolve")
+    max_addrs = current_app.config.get("DNS_BULK_MAX", 4096)
+    if len(addrs) > max_addrs:
+        abort(400, "maximum of %s addresses per request" % max_addrs)
+
+    db = current_app.mongo.db
+    if len(get_resolver_engine(db).nameservers) == 0:
+        abort(500, "no dnsProv configured on apic")
+    results = resolve_bulk(db, addrs)
+    return jsonify({"results":[results[ip] for ip in addrs]})
+
+# endpoint attributes returned by endpoint apis
+ENDPOINT_PROJECTION = {"_id":0, "dn":1, "ip":1, "mac":1, "encap":1}
+
+def add_endpoint_ips(db, endpoints):
+    """ add 'ips' list with all fvIp addresses to each endpoint """
+    index = {}
+    for ep in endpoints:
+        ep["ips"] = []
+        index[ep["dn"]] = ep
+    for ip in db.endpointIp.find({"ep":{"$in":index.keys()}},
+        {"_id":0, "ep":1, "addr":1}):
+        index[ip["ep"]]["ips"].append(ip["addr"])
+    return endpoints
+
+def get_endpoints_by_dn(db, dns, limit):
+    """ return tuple (endpoints, truncated) for list of endpoint dns sorted by
+        ip and limited to limit entries
+    """
+    dns = sorted(dns)
+    truncated = len(dns) > limit
+    endpoints = list(db.endpoint.find({"dn":{"$in":dns[:limit]}},
+        ENDPOINT_PROJECTION))
+    endpoints.sort(key=lambda ep: ep.get("ip",""))
+    return (add_endpoint_ips(db, endpoints), truncated)
+
+@api.route("/endpoints.json")
+def get_endpoints():
+    """ return endpoints from local endpoint mirror where the endpoint ip or any
+        of its learned fvIp addresses starts with the provided prefix. If no
+        prefix is provided then all endpoints are returned up to max limit.
+
+        returns {"endpoints": [...], "truncated": <bool>} where each endpoint is
+        {"dn", "ip", "mac", "encap", "ips": [<fvIp addr>, ...]}
+    """
+    prefix = get_user_params().get("prefix", "").strip()
+    limit = current_app.config.get("ENDPOINT_SEARCH_MAX", 10000)
+    db = current_app.mongo.db
+    # anchored regex with no wildcard uses the ip/addr index as a range scan
+    query = {"$regex": "^%s" % re.escape(prefix)}
+
+    endpoints = {}
+    for ep in db.endpoint.find({"ip":query}, ENDPOINT_PROJECTION).limit(
+        limit+1):
+        endpoints[ep["dn"]] = ep
+    parents = set()
+    for ip in db.endpointIp.find({"addr":query}, {"_id":0, "ep":1}).limit(
+        limit+1):
+        if ip["ep"] not in endpoints: parents.add(ip["ep"])
+    if len(parents) > 0:
+        for ep in db.endpoint.find({"dn":{"$in":list(parents)}},
+            ENDPOINT_PROJECTION):
+            endpoints[ep["dn"]] = ep
+
+    truncated = len(endpoints) > limit
+    results = sorted(endpoints.values(), key=lambda ep: ep.get("ip",""))[:limit]
+    add_endpoint_ips(db, results)
+    logger.debug("found %s endpoints for prefix '%s'", len(results), prefix)
+    return jsonify({"endpoints":results, "truncated":truncated})
+
+@api.route("/subnet.json")
+def get_subnet_endpoints():
+    """ return endpoints with an ip or fvIp address within the provided ipv4 or
+        ipv6 prefix (for example 10.0.0.0/14).  Uses the in-process endpoint
+        prefix trie so only exact subnet matches are returned.
+
+        returns {"endpoints": [...], "truncated": <bool>} in the same format as
+        endpoints.json
+    """
+    prefix = get_user_params().get("prefix", None)
+    if prefix is None or len(prefix)==0:
+        abort(400, "prefix parameter required for subnet")
+    db = current_app.mongo.db
+    try:
+        eps = get_endpoint_trie(db).subnet(prefix)
+    except ValueError as e:
+        abort(400, "invalid prefix %s" % prefix)
+    limit = current_app.config.get("ENDPOINT_SEARCH_MAX", 10000)
+    (endpoints, truncated) = get_endpoints_by_dn(db, eps, limit)
+    logger.debug("found %s endpoints in subnet %s", len(eps), prefix)
+    return jsonify({"endpoints":endpoints, "truncated":truncated})
+
+@api.route("/longest_match.json")
+def get_longest_match():
+    """ return the most specific endpoint prefix covering the provided ipv4 or
+        ipv6 address along with the corresponding endpoints
+
+        returns {"prefix": <prefix or null>, "endpoints": [...]}
+    """
+    addr = get_user_params().get("addr", None)
+    if addr is None or len(addr)==0:
+        abort(400, "addr parameter required for longest match")
+    db = current_app.mongo.db
+    try:
+        match = get_endpoint_trie(db).longest_match(addr)
+    except ValueError as e:
+        abort(400, "invalid address %s" % addr)
+    if match is None:
+        return jsonify({"prefix":None, "endpoints":[]})
+    limit = current_app.config.get("ENDPOINT_SEARCH_MAX", 10000)
+    (endpoints, truncated) = get_endpoints_by_dn(db, match[1], limit)
+    return jsonify({"prefix":match[0], "endpoints":endpoints})
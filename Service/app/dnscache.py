@@ -0,0 +1,420 @@
+
+import logging, os, sys, time, threading, traceback, calendar
+from datetime import datetime
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from functools import partial
+from dns import resolver, exception
+from pymongo import UpdateOne, DESCENDING
+from pymongo.errors import BulkWriteError
+from .utils import get_app_config, get_generations, bump_generation
+from .dnsresolver import get_resolver_engine
+from . import metrics, timing
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# status of dnsCache entries and default time in seconds to cache each
+# negative result (NXDOMAIN/no PTR record, SERVFAIL, and timeout)
+STATUS_OK = "ok"
+STATUS_NXDOMAIN = "nxdomain"
+STATUS_SERVFAIL = "servfail"
+STATUS_TIMEOUT = "timeout"
+NEGATIVE_CACHE_TIME = {
+    STATUS_NXDOMAIN: 600,
+    STATUS_SERVFAIL: 60,
+    STATUS_TIMEOUT: 30,
+}
+
+def is_current(entry, prov_version):
+    """ return False if entry is a negative result cached before the dnsProv
+        objects were last changed.  Negative results are revalidated after any
+        provider change while positive results remain valid until they expire
+        or their provider is removed
+    """
+    if entry.get("status", STATUS_OK) == STATUS_OK: return True
+    return entry.get("provVersion", None) == prov_version
+
+def to_datetime(ts):
+    """ convert epoch timestamp to naive utc datetime stored in dnsCache """
+    return datetime.utcfromtimestamp(ts)
+
+def expire_ts(entry):
+    """ return epoch timestamp of dnsCache entry expire.  Supports datetime
+        (naive utc or timezone aware) along with legacy float timestamps
+    """
+    expire = entry["expire"]
+    if isinstance(expire, datetime):
+        return calendar.timegm(expire.utctimetuple()) + \
+            expire.microsecond/1000000.0
+    return expire
+
+# approximate per-entry overhead of LocalCache bookkeeping in bytes
+LOCAL_CACHE_ENTRY_OVERHEAD = 400
+
+class LocalCache(object):
+    """ in-process LRU cache of dnsCache entries bounded by approximate memory
+        usage.  Entries are dropped once expired or no longer current and the
+        whole cache is flushed when the dnsCache generation counter in the db
+        changes.  The dnsCache and dnsProv counters are read at most once every
+        gen_interval seconds.  Cache hits per address are counted and added to
+        the 'hits' of the dnsCache entries at most once every hits_interval
+        seconds so the refresher can find frequently used entries.
+    """
+    def __init__(self, max_bytes, gen_interval=1.0, hits_interval=10.0):
+        self.max_bytes = max_bytes
+        self.gen_interval = gen_interval
+        self.hits_interval = hits_interval
+        self.pid = os.getpid()
+        self.generation = None
+        self.prov_version = None        # dnsProv generation
+        self._gen_checked = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = {}
+        self._hits_flushed = time.time()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "stale": 0,
+            "evicted": 0, "flushed": 0}
+
+    def _size(self, entry):
+        return LOCAL_CACHE_ENTRY_OVERHEAD + sys.getsizeof(entry["addr"]) + \
+            sys.getsizeof(entry["ptr"])
+
+    def check_generation(self, db):
+        """ flush cache if dnsCache generation has changed and update current
+            dnsProv generation
+        """
+        ts = time.time()
+        if ts - self._gen_checked < self.gen_interval: return
+        self._gen_checked = ts
+        gens = get_generations(db, ["dnsCache", "dnsProv"])
+        self.prov_version = gens["dnsProv"]
+        gen = gens["dnsCache"]
+        if gen != self.generation:
+            if self.generation is not None:
+                logger.debug("dnsCache generation changed %s to %s",
+                    self.generation, gen)
+            self.flush()
+            self.generation = gen
+
+    def get(self, addr):
+        """ return cached entry or None if not present or expired """
+        with self._lock:
+            cached = self._entries.pop(addr, None)
+            if cached is None:
+                self._stats["misses"]+= 1
+                return None
+            (entry, size, expire) = cached
+            if expire <= time.time():
+                self._bytes-= size
+                self._stats["expired"]+= 1
+                return None
+            if not is_current(entry, self.prov_version):
+                self._bytes-= size
+                self._stats["stale"]+= 1
+                return None
+            # re-insert as most recently used
+            self._entries[addr] = cached
+            self._stats["hits"]+= 1
+            self._hits[addr] = self._hits.get(addr, 0) + 1
+            return entry
+
+    def add_hit(self, addr):
+        """ count hit for addr served from dnsCache in db """
+        with self._lock:
+            self._hits[addr] = self._hits.get(addr, 0) + 1
+
+    def flush_hits(self, db):
+        """ add counted hits to dnsCache entries in db if hits_interval has
+            passed since the last flush
+        """
+        ts = time.time()
+        if ts - self._hits_flushed < self.hits_interval: return
+        with self._lock:
+            (hits, self._hits) = (self._hits, {})
+            self._hits_flushed = ts
+        if len(hits) == 0: return
+        ops = [UpdateOne({"addr":addr}, {"$inc":{"hits":count}}) \
+            for (addr, count) in hits.items()]
+        try:
+            db.dnsCache.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            logger.debug("hits bulk write errors: %s", e.details)
+
+    def set(self, entry):
+        """ add or replace entry, evicting least recently used entries to stay
+            within max_bytes
+        """
+        if self.max_bytes <= 0: return
+        size = self._size(entry)
+        expire = expire_ts(entry)
+        with self._lock:
+            cached = self._entries.pop(entry["addr"], None)
+            if cached is not None: self._bytes-= cached[1]
+            self._entries[entry["addr"]] = (entry, size, expire)
+            self._bytes+= size
+            while self._bytes > self.max_bytes and len(self._entries)>0:
+                (addr, cached) = self._entries.popitem(last=False)
+                self._bytes-= cached[1]
+                self._stats["evicted"]+= 1
+
+    def flush(self):
+        """ remove all entries """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._stats["flushed"]+= 1
+
+    def stats(self):
+        """ return dict of current cache statistics """
+        ret = dict(self._stats)
+        ret.update({"entries": len(self._entries), "bytes": self._bytes,
+            "max_bytes": self.max_bytes, "generation": self.generation,
+            "prov_version": self.prov_version})
+        return ret
+
+# track local cache per process, rebuilt if process has been forked
+_g_local_cache = None
+_g_local_cache_lock = threading.Lock()
+DNS_CACHE_LOOKUPS = metrics.counter("dns_cache_lookups_total",
+    "dnsCache lookups by source of the answer (local, db, expired, or miss)",
+    ["source"])
+
+def _local_cache_metrics():
+    # export statistics of the current process LocalCache, if created
+    local = _g_local_cache
+    if local is None or local.pid != os.getpid(): return []
+    stats = local.stats()
+    results = metrics.Counter("dns_local_cache_total",
+        "in-process dnsCache results", ["result"])
+    for result in ("hits", "misses", "expired", "stale", "evicted"):
+        results.inc(stats.get(result, 0), result=result)
+    size = metrics.Gauge("dns_local_cache_bytes",
+        "approximate size of in-process dnsCache entries")
+    size.set(stats["bytes"])
+    return [results, size]
+
+metrics.REGISTRY.register_collector(_local_cache_metrics)
+
+def get_local_cache():
+    """ return process-wide LocalCache """
+    global _g_local_cache
+    with _g_local_cache_lock:
+        if _g_local_cache is None or _g_local_cache.pid != os.getpid():
+            config = get_app_config()
+            _g_local_cache = LocalCache(
+                max_bytes=config.get("DNS_LOCAL_CACHE_MAX_BYTES", 16777216),
+                gen_interval=config.get("DNS_GEN_INTERVAL", 1.0),
+                hits_interval=config.get("DNS_HITS_INTERVAL", 10.0))
+        return _g_local_cache
+
+def get_cached(db, addr):
+    """ return unexpired cache entry for addr from in-process cache, falling
+        back to dnsCache in db.  Return None on miss
+    """
+    local = get_local_cache()
+    local.check_generation(db)
+    local.flush_hits(db)
+    entry = local.get(addr)
+    if entry is not None:
+        DNS_CACHE_LOOKUPS.inc(source="local")
+        return entry
+    # expired entries are purged by the TTL index but may still be present
+    # until the next TTL monitor pass, they are counted separately from misses
+    entry = db.dnsCache.find_one({"addr":addr})
+    if entry is not None and expire_ts(entry) <= time.time():
+        DNS_CACHE_LOOKUPS.inc(source="expired")
+        return None
+    if entry is None or not is_current(entry, local.prov_version):
+        DNS_CACHE_LOOKUPS.inc(source="miss")
+        return None
+    DNS_CACHE_LOOKUPS.inc(source="db")
+    local.set(entry)
+    local.add_hit(addr)
+    return entry
+
+def set_cached(db, entry):
+    """ add entry to dnsCache in db and in-process cache.  Entries with a zero
+        cache time (already expired) are not stored
+    """
+    if expire_ts(entry) <= time.time(): return
+    db.dnsCache.update_one({"addr":entry["addr"]}, {"$set":entry}, upsert=True)
+    get_local_cache().set(entry)
+
+def invalidate_providers(db, addrs):
+    """ remove all dnsCache entries answered by the provided nameserver
+        addresses and notify other processes to flush their local cache
+    """
+    addrs = list(addrs)
+    if len(addrs) == 0: return
+    ret = db.dnsCache.delete_many({"prov":{"$in":addrs}})
+    logger.debug("removed %s dnsCache entries for providers %s",
+        ret.deleted_count, addrs)
+    bump_generation(db, "dnsCache")
+
+def negative_cache_time(status):
+    """ return configured cache time in seconds for negative result status """
+    key = "DNS_%s_TTL" % status.upper()
+    return get_app_config().get(key, NEGATIVE_CACHE_TIME[status])
+
+def lookup_ptr(engine, ip):
+    """ perform reverse lookup for provided ipv4 or ipv6 address using the
+        provided ResolverEngine and return dnsCache entry
+        {"addr", "ptr", "expire", "status", "prov", "provVersion"} where prov
+        is the nameserver that answered (None if all failed) and provVersion
+        is the dnsProv generation of the engine.  If the address does not
+        resolve (NXDOMAIN, no PTR record, SERVFAIL from all nameservers, or
+        timeout) then ptr is set to 'n/a' and expire is set from the negative
+        cache time for the corresponding status.
+
+        raises dns.exception.SyntaxError on invalid address
+    """
+    (status, ns) = (STATUS_OK, None)
+    try:
+        (lookup, ns) = engine.query_ptr(ip)
+        (ptr, expire) = (lookup[0].to_text(), lookup.expiration)
+    except (resolver.NXDOMAIN, resolver.NoAnswer) as e:
+        logger.debug("resolver not found: %s", e)
+        status = STATUS_NXDOMAIN
+        ns = getattr(e, "nameserver", None)
+    except resolver.NoNameservers as e:
+        logger.debug("resolver failed: %s", e)
+        status = STATUS_SERVFAIL
+    except exception.Timeout as e:
+        logger.debug("resolver timeout: %s", e)
+        status = STATUS_TIMEOUT
+    if status != STATUS_OK:
+        (ptr, expire) = ("n/a", time.time()+negative_cache_time(status))
+    return {"addr":ip, "ptr":ptr, "expire":to_datetime(expire),
+        "status":status, "prov":ns, "provVersion":engine.generation}
+
+def _lookup_ptr_safe(engine, ip):
+    # lookup_ptr wrapper for worker threads that returns (ip, entry, error)
+    try:
+        return (ip, lookup_ptr(engine, ip), None)
+    except exception.SyntaxError as e:
+        return (ip, None, "invalid address %s" % ip)
+    except Exception as e:
+        logger.debug("lookup failed for %s: %s", ip, traceback.format_exc())
+        return (ip, None, "lookup failed for %s" % ip)
+
+# track worker pool per process, rebuilt if process has been forked
+_g_worker_pool = None
+_g_worker_pool_pid = None
+_g_worker_pool_lock = threading.Lock()
+def get_worker_pool():
+    """ return process-wide ThreadPool used for concurrent dns lookups """
+    global _g_worker_pool, _g_worker_pool_pid
+    with _g_worker_pool_lock:
+        if _g_worker_pool is None or _g_worker_pool_pid != os.getpid():
+            workers = get_app_config().get("DNS_BULK_WORKERS", 16)
+            _g_worker_pool = ThreadPool(processes=max(1, int(workers)))
+            _g_worker_pool_pid = os.getpid()
+        return _g_worker_pool
+
+def resolve_bulk(db, ips):
+    """ resolve list of addresses using dnsCache where possible.  Cache hits are
+        served from a single $in query, misses are resolved concurrently on the
+        worker pool and all new entries are upserted with one bulk write.
+
+        return dict indexed by address with each value containing:
+            {"ip": <addr>, "ptr": <ptr>, "cache": <bool>}
+        or for failed lookups:
+            {"ip": <addr>, "error": <description>}
+    """
+    ts = time.time()
+    results = {}
+    local = get_local_cache()
+    local.check_generation(db)
+    local.flush_hits(db)
+    remote = []
+    for ip in ips:
+        cache = local.get(ip)
+        if cache is None: remote.append(ip)
+        else: results[ip] = {"ip":ip, "ptr":cache["ptr"], "cache":True}
+    DNS_CACHE_LOOKUPS.inc(len(results), source="local")
+    expired = 0
+    if len(remote) > 0:
+        for cache in db.dnsCache.find({"addr":{"$in":remote}}):
+            if expire_ts(cache) <= ts:
+                expired+= 1
+                continue
+            if not is_current(cache, local.prov_version): continue
+            local.set(cache)
+            local.add_hit(cache["addr"])
+            results[cache["addr"]] = {"ip":cache["addr"], "ptr":cache["ptr"],
+                "cache":True}
+    misses = [ip for ip in ips if ip not in results]
+    DNS_CACHE_LOOKUPS.inc(len(remote) - len(misses), source="db")
+    DNS_CACHE_LOOKUPS.inc(expired, source="expired")
+    DNS_CACHE_LOOKUPS.inc(len(misses) - expired, source="miss")
+    logger.debug("bulk resolve %s addresses, %s cache misses", len(ips),
+        len(misses))
+    if len(misses) == 0:
+        return results
+
+    ops = []
+    engine = get_resolver_engine(db)
+    # lookups run on worker threads, request time is the wait for all of them
+    with timing.timed("dns"):
+        for (ip, cache, error) in get_worker_pool().imap_unordered(
+            partial(_lookup_ptr_safe, engine), misses):
+            if error is not None:
+                results[ip] = {"ip":ip, "error":error}
+                continue
+            results[ip] = {"ip":ip, "ptr":cache["ptr"], "cache":False}
+            if expire_ts(cache) <= time.time(): continue
+            local.set(cache)
+            ops.append(UpdateOne({"addr":ip}, {"$set":cache}, upsert=True))
+    if len(ops) > 0:
+        try:
+            db.dnsCache.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # concurrent upsert of same addr may fail on unique index, entry is
+            # already cached by the other writer
+            logger.debug("bulk write errors: %s", e.details)
+    logger.debug("bulk resolve completed in %0.3f seconds", time.time()-ts)
+    return results
+
+def refresh_ahead(db, ahead=30.0, min_hits=2, limit=1000):
+    """ re-resolve unexpired dnsCache entries with at least min_hits hits that
+        expire within ahead seconds so frequently used addresses are refreshed
+        before a request misses the cache.  Expired entries are left to the
+        TTL monitor.  Lookups run concurrently on the worker pool and entries
+        are updated in place with one bulk write.  The hits of each refreshed
+        entry are halved so entries that are no longer used stop being
+        refreshed.  Failed lookups (servfail/timeout) do not replace a
+        previously resolved ptr.  Return number of refreshed entries
+    """
+    ts = time.time()
+    hot = {}
+    for entry in db.dnsCache.find({"expire":{"$gt":to_datetime(ts),
+        "$lte":to_datetime(ts+ahead)}, "hits":{"$gte":min_hits}},
+        {"_id":0, "addr":1, "hits":1, "status":1}
+        ).sort("hits", DESCENDING).limit(limit):
+        hot[entry["addr"]] = entry
+    if len(hot) == 0: return 0
+    engine = get_resolver_engine(db)
+    if len(engine.nameservers) == 0: return 0
+
+    ops = []
+    for (ip, cache, error) in get_worker_pool().imap_unordered(
+        partial(_lookup_ptr_safe, engine), hot.keys()):
+        if error is not None: continue
+        if cache["status"] in [STATUS_SERVFAIL, STATUS_TIMEOUT] and \
+            hot[ip].get("status", STATUS_OK) == STATUS_OK:
+            continue
+        # entries removed since the query (such as by provider invalidation)
+        # are not added back
+        decay = hot[ip]["hits"] - hot[ip]["hits"]//2
+        ops.append(UpdateOne({"addr":ip}, {"$set":cache,
+            "$inc":{"hits":-decay}}))
+    if len(ops) > 0:
+        try:
+            db.dnsCache.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            logger.debug("refresh bulk write errors: %s", e.details)
+    logger.debug("refreshed %s/%s dnsCache entries in %0.3f seconds",
+        len(ops), len(hot), time.time()-ts)
+    return len(ops)
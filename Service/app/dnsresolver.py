@@ -0,0 +1,187 @@
+
+import logging, os, time, threading
+from dns import resolver, reversename, exception
+from .utils import get_app_config, get_generation
+from . import metrics, timing
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+DNS_QUERY_SECONDS = metrics.histogram("dns_query_seconds",
+    "PTR query latency per nameserver", ["nameserver", "result"])
+
+class NameserverStats(object):
+    """ rolling latency and failure rate for a single nameserver.  Both values
+        are exponentially weighted moving averages where alpha is the weight of
+        the most recent query
+    """
+    def __init__(self, addr, alpha=0.2):
+        self.addr = addr
+        self.alpha = alpha
+        self.latency = None         # average latency of answered queries
+        self.failure_rate = 0.0     # average rate of timeouts/errors
+        self.queries = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.last_query = 0
+
+    def record(self, latency, failed=False, timeout=False):
+        """ record result of a single query """
+        self.queries+= 1
+        self.last_query = time.time()
+        if timeout: self.timeouts+= 1
+        elif failed: self.errors+= 1
+        failed = failed or timeout
+        self.failure_rate+= self.alpha * ((1.0 if failed else 0.0) - \
+            self.failure_rate)
+        if not failed:
+            if self.latency is None: self.latency = latency
+            else: self.latency+= self.alpha * (latency - self.latency)
+
+    def to_dict(self):
+        return {"addr": self.addr, "latency": self.latency,
+            "failure_rate": self.failure_rate, "queries": self.queries,
+            "timeouts": self.timeouts, "errors": self.errors}
+
+class ResolverEngine(object):
+    """ long-lived resolver bound to an ordered list of nameservers (preferred
+        first).  Each lookup is sent to one nameserver at a time in the current
+        order, failing over to the next on timeout or server failure.
+        Nameservers whose rolling failure rate or latency exceed the configured
+        thresholds are moved to the end of the order and probed again after
+        retry_interval seconds.
+    """
+    def __init__(self, nameservers, timeout=2.0, alpha=0.2,
+        failure_threshold=0.3, slow_threshold=1.0, retry_interval=30.0,
+        stats=None, port=53):
+        self.nameservers = list(nameservers)
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.retry_interval = retry_interval
+        self.generation = None
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._resolvers = {}
+        self._stats = {}
+        stats = stats or {}
+        for ns in self.nameservers:
+            r = resolver.Resolver(configure=False)
+            r.nameservers = [ns]
+            r.port = port
+            r.timeout = timeout
+            r.lifetime = timeout
+            self._resolvers[ns] = r
+            # keep previously learned stats for nameservers that still exist
+            self._stats[ns] = stats.get(ns, NameserverStats(ns, alpha=alpha))
+
+    def is_healthy(self, ns):
+        """ return False if nameserver is currently considered slow or dead """
+        s = self._stats[ns]
+        if time.time() - s.last_query > self.retry_interval:
+            return True
+        if s.failure_rate >= self.failure_threshold: return False
+        if s.latency is not None and s.latency >= self.slow_threshold:
+            return False
+        return True
+
+    def ordered(self):
+        """ return nameservers in the order they should be queried """
+        with self._lock:
+            healthy = [ns for ns in self.nameservers if self.is_healthy(ns)]
+            demoted = [ns for ns in self.nameservers if ns not in healthy]
+        # demoted nameservers are sorted by expected cost of a query
+        demoted.sort(key=lambda ns: self._stats[ns].failure_rate * \
+            self.timeout + (self._stats[ns].latency or 0))
+        return healthy + demoted
+
+    def _record(self, ns, ts, failed=False, timeout=False):
+        latency = time.time()-ts
+        with self._lock:
+            self._stats[ns].record(latency, failed=failed, timeout=timeout)
+        DNS_QUERY_SECONDS.observe(latency, nameserver=ns, result="timeout" if
+            timeout else "error" if failed else "ok")
+        timing.add("dns", latency)
+
+    def query_ptr(self, ip):
+        """ perform PTR lookup for ip and return tuple (answer, nameserver)
+
+            raises dns.exception.SyntaxError on invalid address and NXDOMAIN or
+            NoAnswer if the nameserver answered without a PTR record, with the
+            answering nameserver set as the 'nameserver' attribute of the
+            exception.  If all nameservers fail then the last timeout or
+            failure is raised
+        """
+        qname = reversename.from_address(ip)
+        last_error = resolver.NoNameservers()
+        for ns in self.ordered():
+            ts = time.time()
+            try:
+                answer = self._resolvers[ns].query(qname, "PTR")
+                self._record(ns, ts)
+                return (answer, ns)
+            except (resolver.NXDOMAIN, resolver.NoAnswer) as e:
+                # nameserver is healthy but does not have a record
+                self._record(ns, ts)
+                e.nameserver = ns
+                raise
+            except exception.Timeout as e:
+                logger.debug("timeout on nameserver %s for %s", ns, ip)
+                self._record(ns, ts, timeout=True)
+                last_error = e
+            except resolver.NoNameservers as e:
+                logger.debug("nameserver %s failed for %s", ns, ip)
+                self._record(ns, ts, failed=True)
+                last_error = e
+        raise last_error
+
+    def stats(self):
+        """ return list of per-nameserver statistics in current order """
+        order = self.ordered()
+        with self._lock:
+            return [self._stats[ns].to_dict() for ns in order]
+
+def get_nameservers(db):
+    """ return list of dnsProv addresses with preferred provider first """
+    nameservers = []
+    for prov in db.dnsProv.find({}):
+        if prov["preferred"]: nameservers.insert(0, prov["addr"])
+        else: nameservers.append(prov["addr"])
+    return nameservers
+
+# track resolver engine per process, rebuilt if process has been forked or
+# dnsProv generation has changed
+_g_engine = None
+_g_engine_checked = 0
+_g_engine_lock = threading.Lock()
+def get_resolver_engine(db):
+    """ return process-wide ResolverEngine for the dnsProv objects in db.  The
+        dnsProv generation counter is checked at most once every
+        DNS_GEN_INTERVAL seconds and the engine rebuilt on change
+    """
+    global _g_engine, _g_engine_checked
+    config = get_app_config()
+    with _g_engine_lock:
+        ts = time.time()
+        if _g_engine is not None and _g_engine.pid == os.getpid() and \
+            ts - _g_engine_checked < config.get("DNS_GEN_INTERVAL", 1.0):
+            return _g_engine
+        _g_engine_checked = ts
+        gen = get_generation(db, "dnsProv")
+        if _g_engine is not None and _g_engine.pid == os.getpid() and \
+            _g_engine.generation == gen:
+            return _g_engine
+        nameservers = get_nameservers(db)
+        logger.debug("building resolver engine (generation %s) for %s",
+            gen, nameservers)
+        stats = {}
+        if _g_engine is not None and _g_engine.pid == os.getpid():
+            stats = _g_engine._stats
+        _g_engine = ResolverEngine(nameservers,
+            timeout=config.get("DNS_TIMEOUT", 2.0),
+            failure_threshold=config.get("DNS_FAILURE_THRESHOLD", 0.3),
+            slow_threshold=config.get("DNS_SLOW_THRESHOLD", 1.0),
+            retry_interval=config.get("DNS_RETRY_INTERVAL", 30.0),
+            stats=stats, port=config.get("DNS_PORT", 53))
+        _g_engine.generation = gen
+        return _g_engine
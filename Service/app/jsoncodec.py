@@ -0,0 +1,98 @@
+
+import json, logging
+from flask.json import JSONEncoder as FlaskJSONEncoder
+from flask.json import JSONDecoder as FlaskJSONDecoder
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# json codec used by the app and acitoolkit, the fastest available library is
+# preferred: orjson, ujson, simplejson (with C speedups), then stdlib json.
+# Callers of dumps pass only json-native types (dict, list, string, number,
+# bool, None) as the fast encoders differ from stdlib for other objects: ujson
+# does not raise for them but encodes datetime as an epoch integer and other
+# objects by their attributes.  orjson (with datetime passthrough) and
+# simplejson raise TypeError like stdlib
+try:
+    import orjson
+    NAME = "orjson"
+    def loads(s):
+        return orjson.loads(s)
+    def dumps(obj, sort_keys=False, indent=None):
+        option = getattr(orjson, "OPT_PASSTHROUGH_DATETIME", 0)
+        if sort_keys: option|= orjson.OPT_SORT_KEYS
+        if indent: option|= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option).decode("utf-8")
+except ImportError:
+    try:
+        import ujson
+        NAME = "ujson"
+        def loads(s):
+            return ujson.loads(s, precise_float=True)
+        def dumps(obj, sort_keys=False, indent=None):
+            return ujson.dumps(obj, sort_keys=sort_keys, indent=indent or 0,
+                escape_forward_slashes=False, double_precision=15)
+    except ImportError:
+        try:
+            import simplejson
+            NAME = "simplejson"
+            loads = simplejson.loads
+            def dumps(obj, sort_keys=False, indent=None):
+                return simplejson.dumps(obj, sort_keys=sort_keys,
+                    indent=indent)
+        except ImportError:
+            NAME = "json"
+            loads = json.loads
+            def dumps(obj, sort_keys=False, indent=None):
+                return json.dumps(obj, sort_keys=sort_keys, indent=indent)
+
+# types encoded the same by every codec
+NATIVE_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+CONTAINER_TYPES = frozenset([dict, list, tuple])
+
+def is_native(o):
+    """ return True if o only contains dicts, lists, tuples, and NATIVE_TYPES.
+        Subclasses such as flask Markup are not native
+    """
+    if type(o) not in CONTAINER_TYPES: return type(o) in NATIVE_TYPES
+    # only containers are added to the stack
+    stack = [o]
+    while len(stack) > 0:
+        o = stack.pop()
+        values = o
+        if type(o) is dict:
+            for k in o:
+                if type(k) not in NATIVE_TYPES: return False
+            values = o.itervalues()
+        for v in values:
+            t = type(v)
+            if t in CONTAINER_TYPES: stack.append(v)
+            elif t not in NATIVE_TYPES: return False
+    return True
+
+class JSONEncoder(FlaskJSONEncoder):
+    """ flask app json_encoder that serializes with the fast codec.  Objects
+        the codec does not support (datetime, uuid, objects with __html__, ...)
+        use the flask encoder so its handling of them is kept: the codec raises
+        for them, except ujson which silently encodes them so payloads are
+        first checked to be json-native
+    """
+    def encode(self, o):
+        if NAME != "json" and (NAME != "ujson" or is_native(o)):
+            try:
+                return dumps(o, sort_keys=self.sort_keys, indent=self.indent)
+            except (TypeError, OverflowError, ValueError) as e:
+                logger.debug("%s unable to encode, using json: %s", NAME, e)
+        return super(JSONEncoder, self).encode(o)
+
+class JSONDecoder(FlaskJSONDecoder):
+    """ flask app json_decoder that parses request data with the fast codec """
+    def decode(self, s):
+        return loads(s)
+
+def register_json_codec(app):
+    """ use jsoncodec for flask jsonify and request json parsing """
+    app.json_encoder = JSONEncoder
+    app.json_decoder = JSONDecoder
+    logger.debug("using json codec: %s", NAME)
+    return None
@@ -0,0 +1,151 @@
+
+import codecs, json, logging
+import requests
+from . import jsoncodec
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# bytes read from the socket per chunk when streaming a response
+STREAM_CHUNK_SIZE = 65536
+
+# whitespace allowed between json tokens
+_WHITESPACE = " \t\n\r"
+
+class ImdataReader(object):
+    """ incremental decoder for APIC responses of the form
+            {"totalCount": "N", "imdata": [{...}, {...}, ...]}
+        read from an iterable of byte chunks (such as resp.iter_content).
+        Iterating over the reader yields each imdata object as soon as it has
+        been received so the full body is never held as a string and only one
+        object is decoded at a time.  All other top-level values are added to
+        the 'attributes' dict as they are encountered.
+
+        raises ValueError on invalid json
+    """
+    def __init__(self, chunks):
+        self.attributes = {}
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buf = u""
+        self._pos = 0
+        self._eof = False
+        self._started = False
+
+    def _fill(self):
+        # read next chunk into buffer, return False once all chunks are read
+        while not self._eof:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._eof = True
+                chunk = self._utf8.decode(b"", final=True)
+            else:
+                chunk = self._utf8.decode(chunk)
+            if len(chunk) > 0:
+                self._buf = self._buf[self._pos:] + chunk
+                self._pos = 0
+                return True
+        return False
+
+    def _peek(self):
+        # return next non-whitespace character without consuming it or None
+        # at the end of the stream
+        while True:
+            while self._pos < len(self._buf) and \
+                self._buf[self._pos] in _WHITESPACE:
+                self._pos+= 1
+            if self._pos < len(self._buf): return self._buf[self._pos]
+            if not self._fill(): return None
+
+    def _expect(self, chars):
+        # consume and return next character which must be one of chars
+        c = self._peek()
+        if c is None or c not in chars:
+            raise ValueError("expected '%s' at offset %s, found '%s'" % (chars,
+                self._pos, c))
+        self._pos+= 1
+        return c
+
+    def _value(self):
+        # decode a single json value, reading more chunks until it is complete
+        self._peek()
+        while True:
+            try:
+                (value, end) = self._decoder.raw_decode(self._buf, self._pos)
+                # numbers and literals ending at the end of the buffer may
+                # continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError as e:
+                if self._eof: raise
+            self._fill()
+
+    def __iter__(self):
+        if self._started:
+            raise ValueError("ImdataReader can only be iterated once")
+        self._started = True
+        self._expect("{")
+        if self._peek() == "}": return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "imdata" and self._peek() == "[":
+                self._expect("[")
+                if self._peek() == "]": self._pos+= 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(",]") == "]": break
+            else:
+                self.attributes[key] = self._value()
+            if self._expect(",}") == "}": return
+
+class DecodedResponse(requests.Response):
+    """ requests Response for a body that has already been decoded, such as
+        the combined pages of a 'result dataset is too big' query.  json()
+        returns the decoded data and the body is only serialized again if
+        content or text is accessed.
+    """
+    def __init__(self, resp, data):
+        super(DecodedResponse, self).__init__()
+        self.__dict__.update(resp.__dict__)
+        self._data = data
+        self._content = False
+        self._content_consumed = True
+
+    def json(self, **kwargs):
+        return self._data
+
+    @property
+    def content(self):
+        if self._content is False:
+            self._content = jsoncodec.dumps(self._data)
+        return self._content
+
+def load_imdata(resp, chunk_size=STREAM_CHUNK_SIZE):
+    """ decode imdata from a streamed (stream=True) requests response and
+        return tuple (imdata, attributes) where attributes holds all other
+        top-level values such as totalCount.  The response is closed once
+        decoded and its size added to resp.transfer_stats if set.
+
+        raises ValueError on invalid json
+    """
+    if isinstance(resp, DecodedResponse):
+        attributes = dict(resp.json())
+        return (attributes.pop("imdata", []), attributes)
+    body_bytes = [0]
+    def chunks():
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            body_bytes[0]+= len(chunk)
+            yield chunk
+    try:
+        reader = ImdataReader(chunks())
+        imdata = [obj for obj in reader]
+        stats = getattr(resp, "transfer_stats", None)
+        if stats is not None: stats.add(resp, body_bytes[0])
+        return (imdata, reader.attributes)
+    finally:
+        resp.close()
@@ -0,0 +1,196 @@
+
+import logging, os, re, threading, time
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# file within LOG_DIR the subscriber periodically writes its metrics to
+SUBSCRIBER_METRICS_FILE = "subscriber.metrics"
+
+# default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+
+def _escape(value):
+    # escape label value for prometheus text format
+    return ("%s" % value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        "\"", "\\\"")
+
+def _format_labels(names, values, extra=None):
+    # return {name="value",...} string for label names and values
+    pairs = ["%s=\"%s\"" % (n, _escape(v)) for (n, v) in zip(names, values)]
+    if extra is not None: pairs.append("%s=\"%s\"" % extra)
+    if len(pairs) == 0: return ""
+    return "{%s}" % ",".join(pairs)
+
+def _format_value(value):
+    if value == float("inf"): return "+Inf"
+    if isinstance(value, float) and value.is_integer(): return "%d" % value
+    return "%s" % value
+
+class Metric(object):
+    """ base class for a named metric with a fixed list of label names.  Values
+        are tracked per tuple of label values
+    """
+    kind = "untyped"
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels) or \
+            any(l not in labels for l in self.labels):
+            raise ValueError("%s requires labels %s, got %s" % (self.name,
+                self.labels, labels.keys()))
+        return tuple(labels[l] for l in self.labels)
+
+    def samples(self):
+        """ return list of (suffix, label string, value) """
+        with self._lock:
+            return [("", _format_labels(self.labels, k), v) for (k, v) in
+                sorted(self._values.items())]
+
+    def render(self):
+        """ return metric in prometheus text format """
+        lines = ["# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.kind)]
+        for (suffix, labels, value) in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, labels,
+                _format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """ monotonically increasing value """
+    kind = "counter"
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+class Gauge(Metric):
+    """ value that can go up and down """
+    kind = "gauge"
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    """ distribution of observed values counted in cumulative buckets """
+    kind = "histogram"
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            v = self._values[key]
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    v[0][i]+= 1
+                    break
+            v[1]+= value
+            v[2]+= 1
+
+    def samples(self):
+        ret = []
+        with self._lock:
+            for (k, (counts, total, count)) in sorted(self._values.items()):
+                cumulative = 0
+                for (bound, n) in zip(self.buckets, counts):
+                    cumulative+= n
+                    ret.append(("_bucket", _format_labels(self.labels, k,
+                        ("le", _format_value(float(bound)))), cumulative))
+                ret.append(("_sum", _format_labels(self.labels, k), total))
+                ret.append(("_count", _format_labels(self.labels, k), count))
+        return ret
+
+class Registry(object):
+    """ process-wide collection of metrics along with collector functions that
+        return additional metrics when rendered
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def get_or_create(self, cls, name, description, labels=(), **kwargs):
+        """ return existing metric with name or register a new one """
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, description, labels, **kwargs)
+            metric = self._metrics[name]
+        if not isinstance(metric, cls):
+            raise ValueError("metric %s already registered as %s" % (name,
+                metric.kind))
+        return metric
+
+    def register_collector(self, collector):
+        """ register function that returns a list of metrics to render """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def render(self):
+        """ return all metrics in prometheus text format """
+        with self._lock:
+            metrics = [self._metrics[n] for n in sorted(self._metrics)]
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                metrics+= collector()
+            except Exception as e:
+                logger.warn("metrics collector %s failed: %s",
+                    collector.__name__, e)
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, description, labels=()):
+    """ return process-wide Counter """
+    return REGISTRY.get_or_create(Counter, name, description, labels)
+
+def gauge(name, description, labels=()):
+    """ return process-wide Gauge """
+    return REGISTRY.get_or_create(Gauge, name, description, labels)
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    """ return process-wide Histogram """
+    return REGISTRY.get_or_create(Histogram, name, description, labels,
+        buckets=buckets)
+
+def url_label(url):
+    """ return low cardinality label for APIC url: query parameters are removed
+        and managed object dns are replaced by their class-like prefix
+        (/api/mo/uni/tn-x/ap-y.json -> /api/mo/uni/tn/ap)
+    """
+    path = url.split("?", 1)[0]
+    if path.startswith("/api/mo/"):
+        dn = re.sub("\.json$", "", path[len("/api/mo/"):])
+        # remove rn values along with bracketed names that may contain '/'
+        dn = re.sub("\[[^\]]*\]", "", dn)
+        dn = "/".join(rn.split("-", 1)[0] for rn in dn.split("/"))
+        return "/api/mo/%s" % dn
+    return path
+
+def dump(path):
+    """ write rendered metrics to path, replacing the file atomically """
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+        f.write(REGISTRY.render())
+    os.rename(tmp, path)
+
+def run_metrics_dump(path, interval):
+    """ write metrics to path every interval seconds """
+    while True:
+        time.sleep(interval)
+        try:
+            dump(path)
+        except Exception as e:
+            logger.warn("failed to write metrics to %s: %s", path, e)
@@ -0,0 +1,289 @@
+
+import logging, os, time, threading
+import ipaddress
+from six import text_type
+from pymongo import ASCENDING
+from .utils import get_app_config, get_generation
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+class _Node(object):
+    """ single node within PrefixTrie """
+    __slots__ = ["prefix", "plen", "children", "values"]
+    def __init__(self, prefix, plen):
+        self.prefix = prefix        # left aligned integer prefix
+        self.plen = plen            # prefix length in bits
+        self.children = [None, None]
+        self.values = None          # dict of values if node holds a prefix
+
+class PrefixTrie(object):
+    """ path-compressed binary (patricia) trie of integer prefixes for a single
+        address family of 'width' bits.  Each stored prefix holds a dict of
+        values so multiple objects can share the same address.  Lookups walk at
+        most one node per differing bit so subnet queries are bounded by
+        O(prefix length + results)
+    """
+    def __init__(self, width):
+        self.width = width
+        self.root = _Node(0, 0)
+        self.count = 0
+
+    def _bit(self, prefix, pos):
+        # return bit at position pos (0 is most significant bit)
+        return (prefix >> (self.width - 1 - pos)) & 1
+
+    def _common(self, a, b, maxlen):
+        # return number of leading bits shared by a and b up to maxlen
+        diff = a ^ b
+        if diff == 0: return maxlen
+        return min(maxlen, self.width - diff.bit_length())
+
+    def _matches(self, node, prefix, plen):
+        # return True if node prefix covers prefix/plen
+        return node.plen <= plen and \
+            self._common(node.prefix, prefix, node.plen) == node.plen
+
+    def _mask(self, prefix, plen):
+        if plen == 0: return 0
+        return prefix & (((1 << plen) - 1) << (self.width - plen))
+
+    def _find(self, prefix, plen, create=False):
+        # return tuple (node, path) for prefix/plen where path is the list of
+        # ancestors from the root.  If create is set, nodes are added as needed
+        prefix = self._mask(prefix, plen)
+        node = self.root
+        path = []
+        while True:
+            if node.plen == plen: return (node, path)
+            bit = self._bit(prefix, node.plen)
+            child = node.children[bit]
+            if child is None:
+                if not create: return (None, path)
+                child = _Node(prefix, plen)
+                node.children[bit] = child
+                return (child, path + [node])
+            common = self._common(prefix, child.prefix, min(plen, child.plen))
+            if common == child.plen:
+                path.append(node)
+                node = child
+                continue
+            if not create: return (None, path)
+            if common == plen:
+                # new node is an ancestor of child
+                new = _Node(prefix, plen)
+                new.children[self._bit(child.prefix, plen)] = child
+                node.children[bit] = new
+                return (new, path + [node])
+            # split at the first differing bit
+            split = _Node(self._mask(prefix, common), common)
+            new = _Node(prefix, plen)
+            split.children[self._bit(child.prefix, common)] = child
+            split.children[self._bit(prefix, common)] = new
+            node.children[bit] = split
+            return (new, path + [node, split])
+
+    def add(self, prefix, plen, key, value):
+        """ add value identified by key to prefix/plen """
+        (node, path) = self._find(prefix, plen, create=True)
+        if node.values is None:
+            node.values = {}
+            self.count+= 1
+        node.values[key] = value
+
+    def remove(self, prefix, plen, key):
+        """ remove value identified by key from prefix/plen and prune nodes
+            that no longer hold a prefix
+        """
+        (node, path) = self._find(prefix, plen)
+        if node is None or node.values is None or key not in node.values:
+            return
+        del node.values[key]
+        if len(node.values) > 0: return
+        node.values = None
+        self.count-= 1
+        # splice out nodes without values and fewer than two children
+        while len(path) > 0 and node.values is None:
+            parent = path.pop()
+            children = [c for c in node.children if c is not None]
+            if len(children) > 1: break
+            index = parent.children.index(node)
+            parent.children[index] = children[0] if len(children)>0 else None
+            node = parent
+            if node is self.root: break
+
+    def subnet(self, prefix, plen):
+        """ return list of (prefix, plen, values) for all stored prefixes that
+            are equal to or more specific than prefix/plen
+        """
+        prefix = self._mask(prefix, plen)
+        node = self.root
+        while node is not None and node.plen < plen:
+            node = node.children[self._bit(prefix, node.plen)]
+            if node is not None and \
+                self._common(node.prefix, prefix, min(plen, node.plen)) < \
+                min(plen, node.plen):
+                return []
+        if node is None: return []
+        results = []
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.values is not None:
+                results.append((node.prefix, node.plen, node.values))
+            for child in reversed(node.children):
+                if child is not None: stack.append(child)
+        return results
+
+    def longest_match(self, prefix, plen=None):
+        """ return (prefix, plen, values) of the most specific stored prefix
+            that covers prefix/plen or None if no stored prefix covers it
+        """
+        if plen is None: plen = self.width
+        prefix = self._mask(prefix, plen)
+        node = self.root
+        best = None
+        while node is not None and self._matches(node, prefix, plen):
+            if node.values is not None:
+                best = (node.prefix, node.plen, node.values)
+            if node.plen >= plen: break
+            node = node.children[self._bit(prefix, node.plen)]
+        return best
+
+def parse_prefix(prefix):
+    """ return ipaddress network for ipv4 or ipv6 address or cidr prefix.
+        raises ValueError on invalid prefix
+    """
+    return ipaddress.ip_network(text_type(prefix).strip(), strict=False)
+
+class EndpointTrie(object):
+    """ ipv4 and ipv6 PrefixTrie over all endpoint addresses in the endpoint
+        mirror.  Each address maps owner dn (fvCEp or fvIp) to the endpoint
+        (fvCEp) dn.  The trie is loaded from the endpoint collections and kept
+        up to date by replaying the endpointChanges log written by the
+        subscriber event handlers.  A full reload occurs when the subscriber
+        reloads the mirror or changes are missing from the capped log.
+    """
+    def __init__(self, sync_interval=1.0):
+        self.sync_interval = sync_interval
+        self.pid = os.getpid()
+        self.epoch = None
+        self.seq = 0
+        self._synced = 0
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.owners = {}        # owner dn -> (network, ep dn)
+        self.children = {}      # ep dn -> set of owner dns
+
+    def set(self, owner, addr, ep):
+        """ set address for owner dn belonging to endpoint ep """
+        self.delete(owner)
+        try:
+            net = parse_prefix(addr)
+        except ValueError:
+            logger.debug("skipping invalid address %s for %s", addr, owner)
+            return
+        # endpoints without a learned ip report 0.0.0.0
+        if net.network_address.is_unspecified: return
+        self.tries[net.version].add(int(net.network_address), net.prefixlen,
+            owner, ep)
+        self.owners[owner] = (net, ep)
+        self.children.setdefault(ep, set()).add(owner)
+
+    def delete(self, owner):
+        """ remove address for owner dn """
+        if owner not in self.owners: return
+        (net, ep) = self.owners.pop(owner)
+        self.tries[net.version].remove(int(net.network_address), net.prefixlen,
+            owner)
+        owners = self.children.get(ep, set())
+        owners.discard(owner)
+        if len(owners) == 0: self.children.pop(ep, None)
+
+    def delete_endpoint(self, ep):
+        """ remove all addresses for endpoint dn """
+        for owner in list(self.children.get(ep, [])):
+            self.delete(owner)
+
+    def apply(self, change):
+        """ apply single change from endpointChanges log """
+        if change["op"] == "set":
+            self.set(change["dn"], change["addr"], change["ep"])
+        elif change["op"] == "del":
+            self.delete(change["dn"])
+        elif change["op"] == "delep":
+            self.delete_endpoint(change["ep"])
+
+    def load(self, db):
+        """ full load of trie from endpoint collections """
+        ts = time.time()
+        epoch = get_generation(db, "endpointLoad")
+        seq = get_generation(db, "endpoint")
+        self._clear()
+        for ep in db.endpoint.find({}, {"_id":0, "dn":1, "ip":1}):
+            if "ip" in ep: self.set(ep["dn"], ep["ip"], ep["dn"])
+        for ip in db.endpointIp.find({}, {"_id":0, "dn":1, "addr":1, "ep":1}):
+            if "addr" in ip: self.set(ip["dn"], ip["addr"], ip["ep"])
+        (self.epoch, self.seq) = (epoch, seq)
+        logger.debug("loaded %s endpoint addresses (epoch:%s, seq:%s) in %0.3f"\
+            " seconds", len(self.owners), epoch, seq, time.time()-ts)
+
+    def sync(self, db):
+        """ bring trie up to date with db, checked at most once every
+            sync_interval seconds
+        """
+        with self._lock:
+            ts = time.time()
+            if ts - self._synced < self.sync_interval: return
+            self._synced = ts
+            if get_generation(db, "endpointLoad") != self.epoch:
+                return self.load(db)
+            changes = db.endpointChanges.find({"seq":{"$gt":self.seq}}).sort(
+                "seq", ASCENDING)
+            for change in changes:
+                if change["seq"] != self.seq + 1:
+                    logger.debug("endpoint change %s missing, reloading",
+                        self.seq + 1)
+                    return self.load(db)
+                self.apply(change)
+                self.seq = change["seq"]
+
+    def subnet(self, prefix):
+        """ return set of endpoint dns with an address within prefix """
+        net = parse_prefix(prefix)
+        with self._lock:
+            results = self.tries[net.version].subnet(
+                int(net.network_address), net.prefixlen)
+            eps = set()
+            for (p, plen, values) in results: eps.update(values.values())
+            return eps
+
+    def longest_match(self, addr):
+        """ return tuple (prefix, set of endpoint dns) for most specific stored
+            prefix covering addr or None if not found
+        """
+        net = parse_prefix(addr)
+        with self._lock:
+            match = self.tries[net.version].longest_match(
+                int(net.network_address), net.prefixlen)
+            if match is None: return None
+            (p, plen, values) = match
+            if net.version == 4: p = ipaddress.IPv4Address(p)
+            else: p = ipaddress.IPv6Address(p)
+            return ("%s/%s" % (p, plen), set(values.values()))
+
+# track endpoint trie per process, rebuilt if process has been forked
+_g_endpoint_trie = None
+_g_endpoint_trie_lock = threading.Lock()
+def get_endpoint_trie(db):
+    """ return process-wide EndpointTrie synchronized with db """
+    global _g_endpoint_trie
+    with _g_endpoint_trie_lock:
+        if _g_endpoint_trie is None or _g_endpoint_trie.pid != os.getpid():
+            _g_endpoint_trie = EndpointTrie(sync_interval=get_app_config().get(
+                "ENDPOINT_SYNC_INTERVAL", 1.0))
+    _g_endpoint_trie.sync(db)
+    return _g_endpoint_trie
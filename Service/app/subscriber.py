@@ -1,17 +1,91 @@
 
-import logging, sys
-from .utils import (setup_logger, get_app, pretty_print, db_is_alive, init_db,
-    get_apic_session, get_class, subscribe,
+import logging, os, sys, time, threading, traceback
+from collections import OrderedDict
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from .utils import (setup_logger, get_app, get_app_config, pretty_print,
+    db_is_alive, init_db, apic_session, iter_class, subscribe, bump_generation,
+    get_parent_dn, ApicQueryError,
 )
+from .dnscache import invalidate_providers, refresh_ahead
+from . import metrics
 
 # module level logging
 logger = logging.getLogger(__name__)
 
+# number of objects per page and per insert_many during initial bulk load
+BULK_PAGE_SIZE = 10000
+BULK_INSERT_SIZE = 5000
+
+def run_subscriptions(db):
+    """ initialize db, load current state of all tracked objects from the APIC,
+        and subscribe to changes.  This function returns only if the
+        subscriptions fail
+    """
+    # ensure collections and indexes exist, existing objects are reconciled
+    # with the APIC so dnsCache is kept across restarts
+    init_db(drop=False)
+
+    interests = {}
+    for init in (dns_subscriptions, endpoint_subscriptions):
+        ret = init(db)
+        if ret is None: return
+        interests.update(ret)
+    start_dns_refresher(db)
+    start_metrics_dump()
+    subscribe(interests,
+        batch_window=get_app_config().get("SUBSCRIBER_BATCH_WINDOW", 0.25))
+    logger.error("subscription unexpectedly ended")
+
 def dns_subscriptions(db):
-    """ build subscription to APIC dns objects and keep consistent values in 
-        database.  On startup, simply wipe the db since we'll be pulling new 
-        objects (and any cached entries can be considered invalid on startup)
-        
+    """ read APIC dns objects into the database and return subscription
+        interests to keep consistent values in database.  Returns None on
+        error.
+    """
+    if not load_dns(db): return None
+    # subscriptions to interesting objects
+    return {
+        "dnsDomain": {"callback": handle_dns_event, "resync": resync_dns,
+            "flush": flush_dns_events},
+        "dnsProv": {"callback": handle_dns_event, "resync": resync_dns,
+            "flush": flush_dns_events},
+    }
+
+def reconcile(collection, objects, key="dn"):
+    """ apply inserts, updates, and deletes with a single unordered bulk write
+        so collection matches the provided list of objects.  Return tuple
+        (inserted, updated, deleted) where inserted is the list of new objects,
+        updated is the list of (old, new) tuples for changed objects, and
+        deleted is the list of previously stored objects that were removed
+    """
+    current = {}
+    for obj in collection.find({}, {"_id":0}):
+        current[obj[key]] = obj
+    (ops, inserted, updated, deleted) = ([], [], [], [])
+    for obj in objects:
+        old = current.pop(obj[key], None)
+        if old is None:
+            ops.append(InsertOne(obj))
+            inserted.append(obj)
+        elif any(old.get(a) != obj[a] for a in obj):
+            ops.append(UpdateOne({key:obj[key]}, {"$set":obj}))
+            updated.append((old, obj))
+    for k in current:
+        ops.append(DeleteOne({key:k}))
+        deleted.append(current[k])
+    if len(ops) > 0:
+        collection.bulk_write(ops, ordered=False)
+    logger.debug("reconciled %s: %s objects, %s changes", collection.name,
+        len(objects), len(ops))
+    return (inserted, updated, deleted)
+
+def load_dns(db):
+    """ reconcile dnsDomain and dnsProv objects in the database with current
+        objects from the APIC.  If any dnsProv changed then other processes
+        are notified to rebuild their resolvers and dnsCache entries of
+        removed (or re-addressed) providers are deleted.  Returns boolean
+        success.
+
         dnsDomain   
             - multiple domains supported, only one is 'default'
             - track 'name' and 'isDefault' (yes/no)
@@ -22,56 +96,132 @@ def dns_subscriptions(db):
             - only support dnsp-default
     """
 
-    # initialize db to clear out all existing objects
-    init_db()
-  
-    # read initial state and insert into database 
+    # read current state and insert into database 
     (domains, providers) = ([], [])
-    session = get_apic_session()
-    if session is None: 
-        logger.error("unable to connect to APIC")
-        return
-    dnsDomain = get_class(session, "dnsDomain")
-    dnsProv = get_class(session, "dnsProv")
-    if dnsDomain is None or dnsProv is None:
-        logger.error("failed to perform dns init")
-        return
-    for obj in dnsDomain:
-        attr = obj[obj.keys()[0]]["attributes"]
-        if "name" in attr and "dn" in attr and "isDefault" in attr:
-            if "/dnsp-default/" in attr["dn"]:
-                domains.append({
-                    "dn": attr["dn"],
-                    "name":attr["name"], 
-                    "isDefault": True if attr["isDefault"]=="yes" else False
-                })
-    for obj in dnsProv:
-        attr = obj[obj.keys()[0]]["attributes"]
-        if "addr" in attr and "dn" in attr and "preferred" in attr:
-            if "/dnsp-default/" in attr["dn"]:
-                providers.append({
-                    "dn": attr["dn"],
-                    "addr":attr["addr"],
-                    "preferred": True if attr["preferred"]=="yes" else False
-                })
-    # insert domains and providers into database
-    logger.debug("inserting domains: %s, and providers: %s"%(domains,providers))
-    db.dnsDomain.insert_many(domains)
-    db.dnsProv.insert_many(providers)
-        
-    # setup subscriptions to interesting objects
-    interests = {
-        "dnsDomain": {"callback": handle_dns_event},
-        "dnsProv": {"callback": handle_dns_event},
-    }
-    subscribe(interests)
-    logger.error("subscription unexpectedly ended")
-    
+    with apic_session() as session:
+        if session is None:
+            logger.error("unable to connect to APIC")
+            return False
+        try:
+            for obj in iter_class(session, "dnsDomain"):
+                attr = obj[obj.keys()[0]]["attributes"]
+                if "name" in attr and "dn" in attr and "isDefault" in attr:
+                    if "/dnsp-default/" in attr["dn"]:
+                        domains.append({
+                            "dn": attr["dn"],
+                            "name":attr["name"], 
+                            "isDefault": attr["isDefault"]=="yes"
+                        })
+            for obj in iter_class(session, "dnsProv"):
+                attr = obj[obj.keys()[0]]["attributes"]
+                if "addr" in attr and "dn" in attr and "preferred" in attr:
+                    if "/dnsp-default/" in attr["dn"]:
+                        providers.append({
+                            "dn": attr["dn"],
+                            "addr":attr["addr"],
+                            "preferred": attr["preferred"]=="yes"
+                        })
+        except ApicQueryError as e:
+            logger.error("failed to perform dns init")
+            return False
+    # apply changes to domains and providers in database
+    logger.debug("reconciling domains: %s, and providers: %s", domains,
+        providers)
+    reconcile(db.dnsDomain, domains)
+    (inserted, updated, deleted) = reconcile(db.dnsProv, providers)
+    if len(inserted) > 0 or len(updated) > 0 or len(deleted) > 0:
+        bump_generation(db, "dnsProv")
+        # only deleted providers and providers whose addr changed answered
+        # entries that are no longer valid, a preferred flip keeps the cache
+        removed = set(p["addr"] for p in deleted)
+        removed.update(old["addr"] for (old, new) in updated
+            if old.get("addr") != new["addr"])
+        invalidate_removed_providers(db, removed)
+    return True
+
+def resync_dns():
+    """ reconcile dns objects after subscription events have been lost.
+        Returns boolean success
+    """
+    return load_dns(db)
+
+class DnsEventBatch(object):
+    """ pending dnsProv and dnsDomain changes collected from one or more
+        events.  Changes to the same object are coalesced to its final state so
+        each object is written at most once per flush
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.pending = OrderedDict()    # (cname, dn) -> obj or None if deleted
+        self.events = 0
+
+    def add(self, cname, status, obj):
+        """ add created, modified, or deleted object to batch """
+        key = (cname, obj["dn"])
+        if status == "deleted":
+            self.pending[key] = None
+        elif status == "modified" and key in self.pending:
+            # modified events only contain changed attributes.  A modified
+            # event after a delete is not a complete object so the object
+            # stays deleted instead of upserting the partial attributes
+            if self.pending[key] is not None:
+                self.pending[key].update(obj)
+        else:
+            self.pending[key] = obj
+        self.events+= 1
+
+    def flush(self, db):
+        """ apply all pending changes with one unordered bulk write per
+            collection.  dnsCache entries answered by removed providers are
+            deleted and negative entries are revalidated on next lookup since
+            the dnsProv generation changes.  dnsDomain changes do not affect
+            dnsCache
+        """
+        if self.events == 0: return
+        # addresses of providers that are deleted or have changed address
+        provs = [dn for (cname, dn) in self.pending if cname == "dnsProv"]
+        removed = set()
+        for prov in db.dnsProv.find({"dn":{"$in":provs}}):
+            obj = self.pending[("dnsProv", prov["dn"])]
+            if obj is None or obj.get("addr", prov["addr"]) != prov["addr"]:
+                removed.add(prov["addr"])
+        ops = {}
+        for ((cname, dn), obj) in self.pending.items():
+            if obj is None: op = DeleteOne({"dn":dn})
+            else: op = UpdateOne({"dn":dn}, {"$set":obj}, upsert=True)
+            ops.setdefault(cname, []).append(op)
+        for cname in ops:
+            try:
+                ret = db[cname].bulk_write(ops[cname], ordered=False)
+                logger.debug("%s bulk write (%s events) match/modify/upsert/"\
+                    "delete: [%s,%s,%s,%s]", cname, self.events,
+                    ret.matched_count, ret.modified_count, ret.upserted_count,
+                    ret.deleted_count)
+            except BulkWriteError as e:
+                logger.warn("%s bulk write errors: %s", cname, e.details)
+
+        # notify other processes to rebuild their resolver
+        if "dnsProv" in ops:
+            bump_generation(db, "dnsProv")
+            invalidate_removed_providers(db, removed)
+        self.clear()
+
+def invalidate_removed_providers(db, addrs):
+    """ remove dnsCache entries for provider addresses no longer in dnsProv """
+    if len(addrs) == 0: return
+    for prov in db.dnsProv.find({"addr":{"$in":list(addrs)}}):
+        addrs.discard(prov["addr"])
+    invalidate_providers(db, addrs)
+
+# dns changes waiting for flush_dns_events
+dns_batch = DnsEventBatch()
 
 def handle_dns_event(event):
     """ handle created, deleted, modified events for dnsProv and dnsDomain by
-        updating corresponding object in db.
-        On successful create/delete clear dnsCache
+        adding the corresponding object to the pending dns_batch which is
+        written to the db by flush_dns_events.
     """
     if "imdata" in event and type(event["imdata"]) is list:
         for obj in event["imdata"]:
@@ -79,10 +229,10 @@ def handle_dns_event(event):
             attr = obj[cname]["attributes"]
             if "status" not in attr or "dn" not in attr or \
                 attr["status"] not in ["created","modified", "deleted"]:
-                logger.warn("skipping invalid event for %s: %s" % (attr,cname))
+                logger.warn("skipping invalid event for %s: %s", attr,cname)
                 continue
             if cname not in ["dnsProv", "dnsDomain"]:
-                logger.debug("skipping event for classname %s" % cname)
+                logger.debug("skipping event for classname %s", cname)
                 continue
 
             db_attr = ["dn"]
@@ -98,22 +248,203 @@ def handle_dns_event(event):
             if "preferred" in obj:
                 obj["preferred"] = True if obj["preferred"]=="yes" else False
 
-            logger.debug("%s %s obj:%s" % (cname, attr["status"], obj))
-            if attr["status"] == "created" or attr["status"] == "modified":
-                ret = db[cname].update_one(
-                    {"dn":attr["dn"]}, {"$set":obj}, upsert=True
-                )
-                logger.debug("update_one match/modify/upsert: [%s,%s,%s]" % (
-                    ret.matched_count, ret.modified_count, ret.upserted_id))
-        
-            if attr["status"] == "deleted":
-                ret = db[cname].delete_one({"dn":attr["dn"]})
-                logger.debug("delete_one deleted: %s" % ret.deleted_count)
+            logger.debug("%s %s obj:%s", cname, attr["status"], obj)
+            dns_batch.add(cname, attr["status"], obj)
 
-            if attr["status"] == "created" or attr["status"] == "deleted":
-                logger.debug("clearing dnsCache")
-                db["dnsCache"].drop()
+def flush_dns_events():
+    """ write all pending dns changes to db """
+    dns_batch.flush(db)
 
+def start_dns_refresher(db):
+    """ start background thread refreshing frequently used dnsCache entries
+        before they expire.  Disabled if DNS_REFRESH_INTERVAL is 0
+    """
+    config = get_app_config()
+    interval = config.get("DNS_REFRESH_INTERVAL", 5.0)
+    if interval <= 0: return None
+    kwargs = {
+        "ahead": config.get("DNS_REFRESH_AHEAD", 30.0),
+        "min_hits": config.get("DNS_REFRESH_MIN_HITS", 2),
+        "limit": config.get("DNS_REFRESH_MAX", 1000),
+    }
+    thread = threading.Thread(target=run_dns_refresher,
+        args=(db, interval, kwargs))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def run_dns_refresher(db, interval, kwargs):
+    """ run refresh_ahead every interval seconds """
+    logger.debug("starting dns refresher every %s seconds: %s", interval,
+        kwargs)
+    while True:
+        time.sleep(interval)
+        try:
+            refresh_ahead(db, **kwargs)
+        except Exception as e:
+            logger.error("dns refresh failed: %s", traceback.format_exc())
+
+def start_metrics_dump():
+    """ start background thread writing subscriber metrics to LOG_DIR where
+        they are served by the api.  Disabled if METRICS_DUMP_INTERVAL is 0
+    """
+    config = get_app_config()
+    interval = config.get("METRICS_DUMP_INTERVAL", 15.0)
+    if interval <= 0: return None
+    path = os.path.join(config["LOG_DIR"], metrics.SUBSCRIBER_METRICS_FILE)
+    thread = threading.Thread(target=metrics.run_metrics_dump,
+        args=(path, interval))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def get_endpoint_obj(cname, attr):
+    """ return endpoint db object from fvCEp or fvIp attributes.  For modified
+        events only the attributes present in the event are returned
+    """
+    obj = {}
+    if cname == "fvCEp": db_attr = ["dn", "mac", "ip", "encap", "name"]
+    else: db_attr = ["dn", "addr"]
+    for a in db_attr:
+        if a in attr: obj[a] = attr[a]
+    # fvIp is always a child of the fvCEp
+    if cname == "fvIp" and "dn" in obj: obj["ep"] = get_parent_dn(obj["dn"])
+    return obj
+
+def endpoint_subscriptions(db):
+    """ mirror APIC endpoints into the database and return subscription
+        interests to keep the mirror consistent.  Returns None on error.
+    """
+    if not load_endpoints(db): return None
+    return {
+        "fvCEp": {"callback": handle_endpoint_event,
+            "resync": resync_endpoints},
+        "fvIp": {"callback": handle_endpoint_event,
+            "resync": resync_endpoints},
+    }
+
+def copy_indexes(src, dst):
+    """ create the indexes of collection src on collection dst """
+    for (name, index) in src.index_information().items():
+        if name == "_id_": continue
+        dst.create_index(index["key"], name=name,
+            unique=index.get("unique", False))
+
+def load_endpoints(db):
+    """ replace endpoint mirror with current endpoints from the APIC and notify
+        other processes to reload.  Objects are streamed into staging
+        collections which replace the mirror only once both classes are fully
+        loaded, so readers never see a partial mirror and the mirror is kept
+        if the load fails.  Returns boolean success.
+
+        fvCEp   -> endpoint collection
+            - track 'dn', 'mac', 'ip', 'encap', and 'name'
+        fvIp    -> endpointIp collection
+            - track 'dn', 'addr', and parent fvCEp dn as 'ep'
+    """
+    collections = {"fvCEp": db.endpoint, "fvIp": db.endpointIp}
+    staging = {}
+    for cname in collections:
+        staging[cname] = db["%s_staging" % collections[cname].name]
+        staging[cname].drop()
+        copy_indexes(collections[cname], staging[cname])
+    with apic_session() as session:
+        if session is None:
+            logger.error("unable to connect to APIC")
+            return False
+        for cname in ["fvCEp", "fvIp"]:
+            (count, batch) = (0, [])
+            try:
+                # stream objects straight into batched inserts
+                for obj in iter_class(session, cname, page_size=BULK_PAGE_SIZE):
+                    attr = obj[obj.keys()[0]]["attributes"]
+                    if "dn" not in attr: continue
+                    batch.append(get_endpoint_obj(cname, attr))
+                    if len(batch) >= BULK_INSERT_SIZE:
+                        staging[cname].insert_many(batch, ordered=False)
+                        count+= len(batch)
+                        batch = []
+            except ApicQueryError as e:
+                logger.error("failed to perform endpoint init for %s", cname)
+                for c in staging: staging[c].drop()
+                return False
+            if len(batch) > 0:
+                staging[cname].insert_many(batch, ordered=False)
+                count+= len(batch)
+            logger.debug("inserted %s %s objects", count, cname)
+
+    # replace mirror and notify other processes to reload their endpoint
+    # prefix trie
+    for cname in ["fvCEp", "fvIp"]:
+        staging[cname].rename(collections[cname].name, dropTarget=True)
+    bump_generation(db, "endpointLoad")
+    return True
+
+def resync_endpoints():
+    """ reload endpoint mirror after subscription events have been lost.
+        Returns boolean success
+    """
+    return load_endpoints(db)
+
+def get_endpoint_change(cname, status, obj):
+    """ return endpointChanges entry for an endpoint event or None if the event
+        does not change the address of the object.  Each entry has an 'op':
+            set     - set 'addr' of owner 'dn' belonging to endpoint 'ep'
+            del     - remove address of owner 'dn'
+            delep   - remove all addresses of endpoint 'ep'
+    """
+    if status == "deleted":
+        if cname == "fvCEp": return {"op":"delep", "ep":obj["dn"]}
+        return {"op":"del", "dn":obj["dn"]}
+    if cname == "fvCEp" and "ip" in obj:
+        return {"op":"set", "dn":obj["dn"], "addr":obj["ip"], "ep":obj["dn"]}
+    if cname == "fvIp" and "addr" in obj:
+        return {"op":"set", "dn":obj["dn"], "addr":obj["addr"], "ep":obj["ep"]}
+    return None
+
+def add_endpoint_changes(db, changes):
+    """ append changes to endpointChanges log with contiguous sequence numbers
+        allocated from the endpoint generation counter
+    """
+    if len(changes) == 0: return
+    seq = bump_generation(db, "endpoint", len(changes)) - len(changes)
+    for change in changes:
+        seq+= 1
+        change["seq"] = seq
+    db.endpointChanges.insert_many(changes)
+
+def handle_endpoint_event(event):
+    """ handle created, deleted, modified events for fvCEp and fvIp by updating
+        corresponding object in endpoint mirror.  Deleting an fvCEp also
+        removes all of its fvIp objects.  Address changes are appended to the
+        endpointChanges log
+    """
+    changes = []
+    if "imdata" in event and type(event["imdata"]) is list:
+        for obj in event["imdata"]:
+            cname = obj.keys()[0]
+            attr = obj[cname]["attributes"]
+            if "status" not in attr or "dn" not in attr or \
+                attr["status"] not in ["created","modified", "deleted"]:
+                logger.warn("skipping invalid event for %s: %s", attr,cname)
+                continue
+            if cname not in ["fvCEp", "fvIp"]:
+                logger.debug("skipping event for classname %s", cname)
+                continue
+
+            collection = db.endpoint if cname == "fvCEp" else db.endpointIp
+            obj = get_endpoint_obj(cname, attr)
+            logger.debug("%s %s obj:%s", cname, attr["status"], obj)
+            if attr["status"] == "created" or attr["status"] == "modified":
+                collection.update_one({"dn":attr["dn"]}, {"$set":obj},
+                    upsert=True)
+            elif attr["status"] == "deleted":
+                collection.delete_one({"dn":attr["dn"]})
+                if cname == "fvCEp":
+                    db.endpointIp.delete_many({"ep":attr["dn"]})
+            change = get_endpoint_change(cname, attr["status"], obj)
+            if change is not None: changes.append(change)
+    add_endpoint_changes(db, changes)
 
 
 if __name__ == "__main__":
@@ -143,7 +474,7 @@ if __name__ == "__main__":
         app = get_app()
         with app.app_context():
             db = app.mongo.db
-            dns_subscriptions(db) 
+            run_subscriptions(db)
 
     except KeyboardInterrupt as e:
         print "\ngoodbye!\n"
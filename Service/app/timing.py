@@ -0,0 +1,180 @@
+
+import logging, os, re, time, threading, random, cProfile
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# categories of time tracked per request
+CATEGORIES = ("mongo", "apic", "dns")
+
+# per-thread timings of the current request, None when no request is tracked
+_local = threading.local()
+
+def start():
+    """ start tracking timings for the current thread """
+    _local.timings = {}
+
+def stop():
+    """ stop tracking timings for the current thread and return dict indexed
+        by category with tuple (seconds, count) or None if not tracking
+    """
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    if timings is None: return None
+    return dict((c, tuple(v)) for (c, v) in timings.items())
+
+def add(category, seconds, count=1):
+    """ add seconds spent in category to timings of the current thread.  This
+        is a no-op for threads not tracking a request such as worker pools and
+        the subscriber
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is None: return
+    if category not in timings: timings[category] = [0.0, 0]
+    timings[category][0]+= seconds
+    timings[category][1]+= count
+
+@contextmanager
+def timed(category):
+    """ context manager adding time of the enclosed block to category """
+    ts = time.time()
+    try:
+        yield
+    finally:
+        add(category, time.time() - ts)
+
+class MongoTimingListener(monitoring.CommandListener):
+    """ add duration of each mongo command to the thread's request timings.
+        Command events are published on the thread executing the command
+    """
+    def started(self, event):
+        pass
+    def succeeded(self, event):
+        add("mongo", event.duration_micros / 1000000.0)
+    def failed(self, event):
+        add("mongo", event.duration_micros / 1000000.0)
+
+# listener is registered once per process before any MongoClient is created
+_g_listener = None
+_g_listener_lock = threading.Lock()
+def register_mongo_listener():
+    """ register process-wide MongoTimingListener """
+    global _g_listener
+    with _g_listener_lock:
+        if _g_listener is None:
+            _g_listener = MongoTimingListener()
+            monitoring.register(_g_listener)
+        return _g_listener
+
+def format_timings(timings):
+    """ return string of seconds and count per category """
+    return ", ".join("%s %0.3fs/%s" % (c, timings.get(c, (0.0, 0))[0],
+        timings.get(c, (0.0, 0))[1]) for c in CATEGORIES)
+
+def server_timing(timings, total):
+    """ return Server-Timing header value with milliseconds per category """
+    ret = ["%s;dur=%0.1f" % (c, timings[c][0] * 1000.0) for c in CATEGORIES
+        if c in timings]
+    ret.append("total;dur=%0.1f" % (total * 1000.0))
+    return ", ".join(ret)
+
+def profile_path(log_dir, method, path):
+    """ return unique file within LOG_DIR/profile for request profile """
+    name = re.sub("[^A-Za-z0-9_.-]+", "_", path.strip("/")) or "root"
+    ts = time.time()
+    return os.path.join(log_dir, "profile", "%s.%06d-%s-%s-%s-%s.prof" % (
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(ts)),
+        int(ts % 1 * 1000000), os.getpid(), threading.current_thread().ident,
+        method.lower(), name))
+
+def dump_profile(profiler, path, max_files=20):
+    """ write profiler stats to path, removing the oldest profiles so at most
+        max_files remain in the directory.  Return True on success
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        profiler.dump_stats(path)
+    except (IOError, OSError) as e:
+        logger.warn("failed to write profile %s: %s", path, e)
+        return False
+    prune_profiles(os.path.dirname(path), max_files)
+    return True
+
+def prune_profiles(directory, max_files):
+    """ remove oldest .prof files so at most max_files remain in directory """
+    try:
+        files = [os.path.join(directory, f) for f in os.listdir(directory)
+            if f.endswith(".prof")]
+        files.sort(key=os.path.getmtime)
+        for f in files[:max(0, len(files) - max_files)]:
+            os.remove(f)
+    except (IOError, OSError) as e:
+        # another process may have already removed the file
+        logger.debug("failed to prune profiles in %s: %s", directory, e)
+
+def profile_requested(request):
+    """ return True if profiling was requested with the X-Profile header """
+    return request.headers.get("X-Profile", "0") not in ("", "0")
+
+def register_request_timing(app):
+    """ register request handlers that track time spent in mongo, apic, and
+        dns for each request.  Requests taking at least REQUEST_SLOW_THRESHOLD
+        seconds are logged with their breakdown.  A REQUEST_PROFILE_RATE
+        fraction of requests, along with requests sent with the X-Profile
+        header if REQUEST_PROFILE_ON_DEMAND is enabled, are run under cProfile
+        and the profile of slow (or X-Profile) requests is written to
+        LOG_DIR/profile, keeping the newest REQUEST_PROFILE_MAX_FILES.  The
+        mongo listener must be registered before the MongoClient is created
+    """
+    from flask import g, request
+    register_mongo_listener()
+    threshold = app.config.get("REQUEST_SLOW_THRESHOLD", 1.0)
+    rate = app.config.get("REQUEST_PROFILE_RATE", 0.0)
+    on_demand = app.config.get("REQUEST_PROFILE_ON_DEMAND", False)
+    max_files = app.config.get("REQUEST_PROFILE_MAX_FILES", 20)
+    log_dir = app.config.get("LOG_DIR", ".")
+
+    def before_request():
+        start()
+        g.request_ts = time.time()
+        g.request_profiler = None
+        g.request_forced = on_demand and profile_requested(request)
+        if g.request_forced or (rate > 0 and random.random() < rate):
+            g.request_profiler = cProfile.Profile()
+            g.request_profiler.enable()
+
+    def after_request(response):
+        profiler = getattr(g, "request_profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            g.request_profiler = None
+        timings = stop()
+        if timings is None: return response
+        total = time.time() - g.request_ts
+        response.headers["Server-Timing"] = server_timing(timings, total)
+        slow = threshold > 0 and total >= threshold
+        if slow or g.request_forced:
+            path = None
+            if profiler is not None:
+                path = profile_path(log_dir, request.method, request.path)
+                if not dump_profile(profiler, path, max_files): path = None
+            logger.warn("%s request %s %s %s %0.3fs (%s)%s",
+                "slow" if slow else "profiled", request.method, request.path,
+                response.status_code, total,
+                format_timings(timings),
+                ", profile: %s" % path if path is not None else "")
+        return response
+
+    def teardown_request(exc):
+        # cleanup for requests that raised before after_request
+        profiler = getattr(g, "request_profiler", None)
+        if profiler is not None: profiler.disable()
+        stop()
+
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
+    return None
@@ -1,9 +1,15 @@
 
-import logging, logging.handlers, time, re, sys, traceback, json
+import logging, logging.handlers, time, re, sys, traceback, json, os, threading
+import Queue
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from flask import request
-from pymongo import IndexModel
+from pymongo import IndexModel, ReturnDocument
 from pymongo.errors import (DuplicateKeyError, ServerSelectionTimeoutError)
 from pymongo import (ASCENDING, DESCENDING)
+from .jsonstream import load_imdata
+from . import metrics, timing
 
 # module level logging
 logger = logging.getLogger(__name__)
@@ -33,8 +39,162 @@ SESSION_LOGIN_TIMEOUT = 10  # login should be fast
 #
 ###############################################################################
 
+class AsyncLogHandler(logging.Handler):
+    """ handler that queues records and writes them with the wrapped handler on
+        a background thread so file i/o is not performed on request threads.
+        Records are formatted on the calling thread so later changes to their
+        arguments are not logged.  If the queue is still full after waiting up
+        to timeout seconds the record is dropped, keeping records in order,
+        and the writer logs the number of dropped records at most once per
+        report_interval seconds
+    """
+    def __init__(self, handler, maxsize=10000, timeout=0.1,
+        report_interval=1.0):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+        self.reported_ts = 0
+        self._start_lock = threading.Lock()
+        self._dropped_lock = threading.Lock()
+
+    def _get_queue(self):
+        # return queue with running writer thread, rebuilt after fork
+        with self._start_lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = Queue.Queue(maxsize=self.maxsize)
+                self.thread = threading.Thread(target=self._run,
+                    args=(self.queue,))
+                self.thread.daemon = True
+                self.thread.start()
+                self.pid = os.getpid()
+                self.dropped = 0
+            return self.queue
+
+    def _run(self, queue):
+        while True:
+            record = queue.get()
+            try:
+                self._report_dropped(force=record is None)
+                if record is None: return
+                self.handler.handle(record)
+            finally:
+                queue.task_done()
+
+    def _report_dropped(self, force=False):
+        # write one record with the count of records dropped since last report
+        ts = time.time()
+        if not force and ts - self.reported_ts < self.report_interval: return
+        self.reported_ts = ts
+        with self._dropped_lock:
+            (dropped, self.dropped) = (self.dropped, 0)
+        if dropped == 0: return
+        self.handler.handle(logging.LogRecord(logger.name, logging.WARNING,
+            __file__, 0, "%s log records dropped, log queue full", (dropped,),
+            None))
+
+    def prepare(self, record):
+        """ merge args into message and format exception on calling thread """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            formatter = self.handler.formatter or logging.Formatter()
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            try:
+                self._get_queue().put(record, timeout=self.timeout)
+            except Queue.Full:
+                with self._dropped_lock:
+                    self.dropped+= 1
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """ wait for queued records to be written """
+        if self.thread is not None and self.pid == os.getpid() and \
+            self.thread.is_alive():
+            self.queue.join()
+        self.handler.flush()
+
+    def close(self):
+        """ write queued records and stop the writer thread """
+        if self.thread is not None and self.pid == os.getpid() and \
+            self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(5.0)
+        self.thread = None
+        self.handler.close()
+        logging.Handler.close(self)
+
+class LogPayload(object):
+    """ log argument for large payloads such as APIC responses.  The payload is
+        only formatted if the record is emitted and is truncated to max_length
+        characters (LOG_PAYLOAD_MAX by default)
+    """
+    def __init__(self, js, pretty=False, max_length=None):
+        self.js = js
+        self.pretty = pretty
+        self.max_length = max_length
+
+    def __str__(self):
+        text = pretty_print(self.js) if self.pretty else "%s" % (self.js,)
+        max_length = self.max_length
+        if max_length is None:
+            max_length = get_app_config().get("LOG_PAYLOAD_MAX", 4096)
+        if max_length > 0 and len(text) > max_length:
+            return "%s...(%s characters truncated)" % (text[:max_length],
+                len(text) - max_length)
+        return text
+
+def get_log_level(level):
+    """ return logging level number from level name or number.  Raises
+        ValueError on invalid level
+    """
+    if isinstance(level, basestring) and not level.isdigit():
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError("invalid log level %s" % level)
+        return value
+    return int(level)
+
+def set_log_level(name, level):
+    """ set level of logger name (for example 'app' or 'app.dnscache') at
+        runtime and return the level number.  Loggers without a level use the
+        level of their parent.  Raises ValueError on invalid level
+    """
+    level = get_log_level(level)
+    logging.getLogger(name).setLevel(level)
+    logger.info("log level of %s set to %s", name, logging.getLevelName(level))
+    return level
+
+def get_log_levels(prefix="app"):
+    """ return dict of configured level name for prefix and each of its child
+        loggers, NOTSET indicates the level is inherited from the parent
+    """
+    ret = {prefix: logging.getLevelName(logging.getLogger(prefix).level)}
+    for name in list(logging.Logger.manager.loggerDict):
+        l = logging.Logger.manager.loggerDict[name]
+        if name.startswith("%s." % prefix) and isinstance(l, logging.Logger):
+            ret[name] = logging.getLevelName(l.level)
+    return ret
+
 def setup_logger(logger, fname="app.log", quiet=False, stdout=False):
-    """ setup logger with appropriate logging level and rotate options """
+    """ setup logger with appropriate logging level and rotate options.  Unless
+        LOG_ASYNC is disabled, records are written on a background thread.
+        LOG_LEVELS sets the level of individual child loggers
+    """
 
     # quiet all other loggers...
     if quiet:
@@ -66,9 +226,25 @@ def setup_logger(logger, fname="app.log", quiet=False, stdout=False):
         fmt=fmt,
         datefmt="%Z %Y-%m-%d %H:%M:%S")
     )
+    if app.config.get("LOG_ASYNC", True):
+        logger_handler = AsyncLogHandler(logger_handler,
+            maxsize=app.config.get("LOG_QUEUE_SIZE", 10000),
+            timeout=app.config.get("LOG_QUEUE_TIMEOUT", 0.1))
     # remove previous handlers if present
-    for h in list(logger.handlers): logger.removeHandler(h)
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+        h.close()
     logger.addHandler(logger_handler)
+
+    # per-module levels 'name=level,...' for children of this logger
+    for entry in app.config.get("LOG_LEVELS", "").split(","):
+        if "=" not in entry: continue
+        (name, level) = [v.strip() for v in entry.split("=", 1)]
+        if name.startswith("%s." % logger.name):
+            try: logging.getLogger(name).setLevel(get_log_level(level))
+            except ValueError as e:
+                sys.stderr.write("invalid LOG_LEVELS entry %s: %s\n" % (
+                    entry, e))
     return logger
 
 ###############################################################################
@@ -145,55 +321,154 @@ def build_query_filters(**kwargs):
     if len(opts)>0: opts = "?%s" % opts.strip("&")
     return opts
 
-def get(session, url, **kwargs):
-    # handle session request and perform basic data validation.  Return
-    # None on error
+class ApicQueryError(Exception):
+    """ raised by iter_pages when a page cannot be retrieved or decoded """
+    pass
+
+APIC_PAGES = metrics.counter("apic_pages_total",
+    "APIC pages received and decoded", ["url"])
+APIC_PAGE_OBJECTS = metrics.counter("apic_page_objects_total",
+    "objects within APIC pages", ["url"])
+APIC_PAGE_SECONDS = metrics.histogram("apic_page_seconds",
+    "APIC page request latency including decode of the page", ["url"])
+SUBSCRIPTION_EVENTS = metrics.counter("subscription_events_total",
+    "subscription events dispatched to callback", ["class"])
+SUBSCRIPTION_CALLBACK_SECONDS = metrics.histogram(
+    "subscription_callback_seconds", "subscription callback latency per event",
+    ["class"], buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+    1.0, 5.0))
+SUBSCRIPTION_QUEUE = metrics.gauge("subscription_event_queue",
+    "subscription event queue depth, high-water mark, and dropped events",
+    ["stat"])
+
+def get_page(session, url, timeout=SESSION_MAX_TIMEOUT):
+    # perform single page request and return tuple (imdata, totalCount).
+    # Raises ApicQueryError on error
+    logger.debug("host:%s, timeout:%s, get:%s", session.ipaddr, timeout,url)
+    tstart = time.time()
+    try:
+        resp = session.get(url, timeout=timeout, stream=True)
+    except Exception as e:
+        logger.warn("exception occurred in get request: %s",
+            traceback.format_exc())
+        raise ApicQueryError("exception occurred in get request")
+    if resp is None or not resp.ok:
+        logger.warn("failed to get data: %s", url)
+        raise ApicQueryError("failed to get data: %s" % url)
+    # decode imdata objects as they are read from the socket
+    try:
+        (imdata, attributes) = load_imdata(resp)
+    except Exception as e:
+        logger.warn("failed to decode resp: %s", traceback.format_exc())
+        raise ApicQueryError("failed to decode resp")
+    elapsed = time.time() - tstart
+    logger.debug("response time: %f", elapsed)
+    if "totalCount" not in attributes:
+        logger.warn("failed to parse js reply: %s", LogPayload(attributes,
+            pretty=True))
+        raise ApicQueryError("failed to parse js reply")
+    label = metrics.url_label(url)
+    APIC_PAGES.inc(url=label)
+    APIC_PAGE_OBJECTS.inc(len(imdata), url=label)
+    APIC_PAGE_SECONDS.observe(elapsed, url=label)
+    return (imdata, int(attributes["totalCount"]))
+
+# track page worker pool per process, rebuilt if process has been forked
+_g_page_pool = None
+_g_page_pool_pid = None
+_g_page_pool_lock = threading.Lock()
+def get_page_pool():
+    """ return process-wide ThreadPool used for concurrent page requests """
+    global _g_page_pool, _g_page_pool_pid
+    with _g_page_pool_lock:
+        if _g_page_pool is None or _g_page_pool_pid != os.getpid():
+            workers = get_app_config().get("APIC_PAGE_WORKERS", 4)
+            _g_page_pool = ThreadPool(processes=max(1, int(workers)))
+            _g_page_pool_pid = os.getpid()
+        return _g_page_pool
+
+def iter_pages(session, url, **kwargs):
+    # generator that handles session request and performs basic data
+    # validation, yielding the imdata list of each page in order so only a
+    # bounded number of pages are held in memory.  Once the first page returns
+    # the totalCount, remaining pages are requested concurrently with at most
+    # 'workers' requests in flight.  Raises ApicQueryError on error
 
     # default page size handler and timeouts
     page_size = kwargs.get("page_size", 75000)
     timeout = kwargs.get("timeout", SESSION_MAX_TIMEOUT)
     limit = kwargs.get("limit", None)       # max number of returned objects
-    page = 0
+    workers = kwargs.get("workers", None)   # max concurrent page requests
+    if workers is None: workers = get_app_config().get("APIC_PAGE_WORKERS", 4)
 
     url_delim = "?"
     if "?" in url: url_delim="&"
+    def page_url(page):
+        return "%s%spage-size=%s&page=%s" % (url, url_delim, page_size, page)
+
+    # first page provides totalCount and determines number of pages
+    with timing.timed("apic"):
+        (imdata, total) = get_page(session, page_url(0), timeout=timeout)
+    if limit is not None: total = min(total, limit)
+    pages = max(1, (total + page_size - 1) // page_size)
+    logger.debug("results count: %s/%s (%s pages)", len(imdata), total,
+        pages)
+
+    # request remaining pages with at most 'workers' requests in flight and
+    # yield each page in order.  If more pages exist than reported by the
+    # initial totalCount then they are requested one at a time.  Outstanding
+    # requests are always completed before the generator ends
+    pool = get_page_pool() if workers > 1 and pages > 2 else None
+    pending = deque()
+    page = 1
+    count = 0
+    try:
+        while True:
+            count+= len(imdata)
+            if limit is not None and count >= limit:
+                logger.debug("limit(%s) hit or exceeded", limit)
+                yield imdata[0:len(imdata)-(count-limit)]
+                return
+            # keep window full while caller processes the current page
+            while pool is not None and page < pages and len(pending) < workers:
+                pending.append(pool.apply_async(get_page,
+                    (session, page_url(page), timeout)))
+                page+= 1
+            yield imdata
+            if len(imdata)<page_size or count>=total:
+                logger.debug("all pages received")
+                return
+            # pool pages are requested on worker threads, only the wait for them
+            # is added to the request timings
+            with timing.timed("apic"):
+                if len(pending) > 0:
+                    (imdata, _) = pending.popleft().get()
+                else:
+                    (imdata, _) = get_page(session, page_url(page),
+                        timeout=timeout)
+                    page+= 1
+            logger.debug("results count: %s/%s", count+len(imdata), total)
+    finally:
+        # pages still in flight when the caller stops early, the generator is
+        # closed, or a page fails use the session, wait for them so the
+        # session is not in use once it is returned to the session pool
+        for result in pending: result.wait()
+
+def iter_get(session, url, **kwargs):
+    # generator yielding each object returned for url, see iter_pages
+    for page in iter_pages(session, url, **kwargs):
+        for obj in page: yield obj
 
+def get(session, url, **kwargs):
+    # handle session request and perform basic data validation.  Return
+    # None on error
     results = []
-    # walk through pages until return count is less than page_size
-    while 1:
-        turl = "%s%spage-size=%s&page=%s" % (url, url_delim, page_size, page)
-        logger.debug("host:%s, timeout:%s, get:%s" % (session.ipaddr,
-            timeout,turl))
-        tstart = time.time()
-        try:
-            resp = session.get(turl, timeout=timeout)
-        except Exception as e:
-            logger.warn("exception occurred in get request: %s" % (
-                traceback.format_exc()))
-            return None
-        logger.debug("response time: %f" % (time.time() - tstart))
-        if resp is None or not resp.ok:
-            logger.warn("failed to get data: %s" % url)
-            return None
-        try:
-            js = resp.json()
-            if "imdata" not in js or "totalCount" not in js:
-                logger.warn("failed to parse js reply: %s" % pretty_print(js))
-                return None
-            results+=js["imdata"]
-            logger.debug("results count: %s/%s"%(len(results),js["totalCount"]))
-            if len(js["imdata"])<page_size or \
-                len(results)>=int(js["totalCount"]):
-                logger.debug("all pages received")
-                return results
-            elif (limit is not None and len(js["imdata"]) >= limit):
-                logger.debug("limit(%s) hit or exceeded" % limit)
-                return results[0:limit]
-            page+= 1
-        except ValueError as e:
-            logger.warn("failed to decode resp: %s" % resp.text)
-            return None
-    return None
+    try:
+        for page in iter_pages(session, url, **kwargs):
+            results+= page
+    except ApicQueryError as e:
+        return None
+    return results
 
 def get_dn(session, dn, **kwargs):
     # get a single dn.  Note, with advanced queries this may be list as well
@@ -212,6 +487,13 @@ def get_class(session, classname, **kwargs):
     url = "/api/class/%s.json%s" % (classname, opts)
     return get(session, url, **kwargs)
 
+def iter_class(session, classname, **kwargs):
+    # perform class query returning generator that yields each object page by
+    # page.  Raises ApicQueryError on error
+    opts = build_query_filters(**kwargs)
+    url = "/api/class/%s.json%s" % (classname, opts)
+    return iter_get(session, url, **kwargs)
+
 def get_parent_dn(dn):
     # return parent dn for provided dn
     t = dn.split("/")
@@ -235,41 +517,206 @@ def get_apic_session(subscription_enabled=False):
     apic_password = app.config["APIC_PASSWORD"]
     apic_app_user = app.config["APIC_APP_USER"]
     private_cert = app.config["PRIVATE_CERT"]
+    token_login = app.config.get("APIC_CERT_TOKEN_LOGIN", True)
+    queue_size = app.config.get("APIC_EVENT_QUEUE_SIZE", 0)
+    queue_policy = app.config.get("APIC_EVENT_QUEUE_POLICY",
+        "drop-oldest")
 
     # ensure apic_hostname is in url form.  If not, assuming https
     if not re.search("^http", apic_hostname.lower()): 
         apic_hostname = "https://%s" % apic_hostname
 
     # create session object
-    logger.debug("attempting to create session on (cert:%r) %s@%s" % (
-        apic_cert_mode, apic_username, apic_hostname))
+    logger.debug("attempting to create session on (cert:%r) %s@%s",
+        apic_cert_mode, apic_username, apic_hostname)
     resp = None
     try:
         if apic_cert_mode:
             session = Session(apic_hostname, apic_app_user, appcenter_user=True,
                     cert_name=apic_app_user, key=private_cert,
-                    subscription_enabled=subscription_enabled)
+                    subscription_enabled=subscription_enabled,
+                    event_queue_size=queue_size,
+                    event_queue_policy=queue_policy,
+                    token_login=token_login)
         else:
             session = Session(apic_hostname, apic_username, apic_password,
-                    subscription_enabled=subscription_enabled)
+                    subscription_enabled=subscription_enabled,
+                    event_queue_size=queue_size,
+                    event_queue_policy=queue_policy)
         resp = session.login(timeout=SESSION_LOGIN_TIMEOUT)
         if resp is not None and resp.ok:
-            logger.debug("successfully connected on %s" % apic_hostname)
+            logger.debug("successfully connected on %s", apic_hostname)
             return session
         else:
-            logger.warn("failed to connect on %s" % apic_hostname)
+            logger.warn("failed to connect on %s", apic_hostname)
             session.close()
     except Exception as e:
-        logger.error("an error occurred creating session: %s" % (
-            traceback.format_exc()))
+        logger.error("an error occurred creating session: %s",
+            traceback.format_exc())
+
+class ApicSessionPool(object):
+    """ process-wide pool of logged in APIC sessions.  Sessions are checked out
+        by a single thread at a time and returned to the pool on release so the
+        login (and for password auth the token maintained by the Login refresh
+        thread) is reused across requests.  Dead sessions are retired and
+        replaced on the next checkout.
+    """
+    def __init__(self, size=5, timeout=SESSION_LOGIN_TIMEOUT):
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._idle = []
+        self._in_use = 0
+        self._creating = 0
+        self._stats = {
+            "created": 0,       # successful logins
+            "failed": 0,        # failed logins
+            "reused": 0,        # checkouts served from an idle session
+            "retired": 0,       # sessions closed because they were dead
+            "waits": 0,         # checkouts that had to wait for a release
+            "timeouts": 0,      # checkouts that gave up waiting
+        }
+
+    def is_alive(self, session):
+        """ return True if session is still usable """
+        if session.login_error: return False
+        # cert auth without token login is stateless, otherwise require an
+        # active login and a running refresh thread
+        if session.cert_auth and not session.logged_in(): return True
+        return session.logged_in() and session.login_thread.is_alive()
+
+    def checkout(self, timeout=None):
+        """ return an idle session, creating a new one if pool is not at max
+            size.  Block up to timeout seconds for a session to be released
+            and return None on timeout or if unable to login.
+        """
+        if timeout is None: timeout = self.timeout
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                while len(self._idle)>0:
+                    session = self._idle.pop()
+                    if self.is_alive(session):
+                        self._in_use+= 1
+                        self._stats["reused"]+= 1
+                        return session
+                    self._retire(session)
+                if self._in_use + self._creating < self.size:
+                    self._creating+= 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.warn("timeout waiting for apic session: %s",
+                        self.stats())
+                    self._stats["timeouts"]+= 1
+                    return None
+                self._stats["waits"]+= 1
+                self._cond.wait(remaining)
+
+        # perform login outside of lock so other threads can check in sessions
+        session = None
+        try:
+            session = get_apic_session()
+        finally:
+            with self._lock:
+                self._creating-= 1
+                if session is None:
+                    self._stats["failed"]+= 1
+                    self._cond.notify()
+                else:
+                    self._stats["created"]+= 1
+                    self._in_use+= 1
+        return session
+
+    def release(self, session, discard=False):
+        """ return session to pool.  If discard is set or the session is no
+            longer alive then the session is closed instead
+        """
+        with self._lock:
+            self._in_use-= 1
+            if discard or not self.is_alive(session):
+                self._retire(session)
+            else:
+                self._idle.append(session)
+            self._cond.notify()
+
+    def _retire(self, session):
+        # stop refresh thread and close underlying connection, lock held
+        self._stats["retired"]+= 1
+        try:
+            session.login_thread.exit()
+            if session.session is not None: session.close()
+        except Exception as e:
+            logger.debug("error closing session: %s", e)
+
+    def close(self):
+        """ close all idle sessions """
+        with self._lock:
+            while len(self._idle)>0:
+                self._retire(self._idle.pop())
+
+    def stats(self):
+        """ return dict of current pool statistics """
+        ret = dict(self._stats)
+        ret.update({
+            "size": self.size,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "creating": self._creating,
+        })
+        return ret
 
-def subscribe(interests, heartbeat=60.0):
+# track session pool per process, rebuilt if process has been forked
+_g_session_pool = None
+_g_session_pool_lock = threading.Lock()
+def get_apic_session_pool():
+    """ return process-wide ApicSessionPool """
+    global _g_session_pool
+    with _g_session_pool_lock:
+        if _g_session_pool is None or _g_session_pool.pid != os.getpid():
+            config = get_app_config()
+            _g_session_pool = ApicSessionPool(
+                size=config.get("APIC_SESSION_POOL_SIZE", 5),
+                timeout=config.get("APIC_SESSION_POOL_TIMEOUT",
+                    SESSION_LOGIN_TIMEOUT))
+        return _g_session_pool
+
+@contextmanager
+def apic_session():
+    """ context manager that checks out a session from the process-wide pool
+        and returns it on exit.  Yields None if no session is available.
+        A session in use when a connection error is raised is discarded.
+    """
+    from requests.exceptions import RequestException
+    pool = get_apic_session_pool()
+    with timing.timed("apic"):
+        session = pool.checkout()
+    discard = False
+    try:
+        yield session
+    except RequestException:
+        discard = True
+        raise
+    finally:
+        if session is not None: pool.release(session, discard=discard)
+
+def subscribe(interests, heartbeat=60.0, batch_window=0.0):
     """ blocking subscription call to one or more objects. calling function must
         provide dict 'interest' which contains the following: 
         {
             "classname": {          # classname in which to subscribe
                 "callback": <func>  # callback function for object event
                                     # must accept single argument which is event
+                "resync": <func>    # optional function called without
+                                    # arguments to reload all objects after
+                                    # events were dropped from the event queue.
+                                    # Must return boolean success
+                "flush": <func>     # optional function called without
+                                    # arguments at most batch_window seconds
+                                    # after callback received events, allowing
+                                    # the callback to batch its writes
             },
         }  
 
@@ -279,26 +726,29 @@ def subscribe(interests, heartbeat=60.0):
 
         additional kwargs:
             heartbeat (int)         # dead interval to check health of session
+            batch_window (float)    # max seconds events are collected before
+                                    # flush functions are called
 
         This function returns only when subscriptions exits
     """
 
     # verify caller arguments
     if type(interests) is not dict or len(interests)==0:
-        logger.error("invalid interests for subscription: %s" % interests)
+        logger.error("invalid interests for subscription: %s", interests)
         return
     for cname in interests:
         if type(interests[cname]) is not dict or \
             "callback" not in interests[cname]:
-            logger.error("invalid interest %s: %s" % (cname, interests[cname]))
-            return
-        if not callable(interests[cname]["callback"]):
-            logger.error("callback '%s' for %s is not callable" % (
-                interests[cname]["callback"], cname))
+            logger.error("invalid interest %s: %s", cname, interests[cname])
             return
+        for c in ["callback", "resync", "flush"]:
+            if c in interests[cname] and not callable(interests[cname][c]):
+                logger.error("%s '%s' for %s is not callable", c,
+                    interests[cname][c], cname)
+                return
     try: heartbeat = float(heartbeat)
     except ValueError as e:
-        logger.warn("invalid heartbeat '%s', setting to 60.0" % e)
+        logger.warn("invalid heartbeat '%s', setting to 60.0", e)
         heartbeat = 60.0
 
     # setup subscriptions
@@ -311,34 +761,107 @@ def subscribe(interests, heartbeat=60.0):
         interests[cname]["url"] = url
         resp = session.subscribe(url, True)
         if resp is None or not resp.ok:
-            logger.warn("failed to subscribe to %s" % cname)
+            logger.warn("failed to subscribe to %s", cname)
             return
-        logger.debug("successfully subscribed to %s" % cname)
+        logger.debug("successfully subscribed to %s", cname)
     
-    # listen for events and send to callback    
+    # periodically wake the dispatcher so session health is checked even when
+    # no events are received
+    stop = threading.Event()
+    waker = threading.Thread(target=_wake_subscriber,
+        args=(session, heartbeat/2.0, stop))
+    waker.daemon = True
+    waker.start()
+
+    # block until events are received and send all pending events to callback.
+    # Track flush functions of interests that received events along with the
+    # time of the first unflushed event
     last_heartbeat = time.time()
-    while True:
-        interest_found = False
-        ts = time.time()
-        for cname in interests:
-            url = interests[cname]["url"]
-            count = session.get_event_count(url)
+    (flushes, flush_ts) = ([], None)
+    try:
+        while True:
+            timeout = None
+            if flush_ts is not None:
+                timeout = max(0, flush_ts + batch_window - time.time())
+            session.wait_for_events(timeout=timeout)
+            ts = time.time()
+            if session.resync_required():
+                (flushes, flush_ts) = (flush_interests(flushes), None)
+                if not resync_interests(session, interests): return
+                last_heartbeat = ts
+                continue
+            queue_stats = session.get_event_queue_stats()
+            for stat in ("depth", "high_water", "dropped"):
+                SUBSCRIPTION_QUEUE.set(queue_stats[stat], stat=stat)
+            count = 0
+            for cname in interests:
+                events = session.get_events(interests[cname]["url"])
+                if len(events) == 0: continue
+                logger.debug("%s events found for %s", len(events), cname)
+                count+= len(events)
+                SUBSCRIPTION_EVENTS.inc(len(events), **{"class": cname})
+                callback = interests[cname]["callback"]
+                for event in events:
+                    cts = time.time()
+                    callback(event)
+                    SUBSCRIPTION_CALLBACK_SECONDS.observe(time.time() - cts,
+                        **{"class": cname})
+                flush = interests[cname].get("flush", None)
+                if flush is not None and flush not in flushes:
+                    flushes.append(flush)
+                    if flush_ts is None: flush_ts = ts
+            if flush_ts is not None and time.time() - flush_ts >= batch_window:
+                (flushes, flush_ts) = (flush_interests(flushes), None)
+
+            # update last_heartbeat or if exceed heartbeat, check session health
             if count > 0:
-                logger.debug("1/%s events found for %s" % (count, cname))
-                interests[cname]["callback"](session.get_event(url))
-                interest_found = True
-
-        # update last_heartbeat or if exceed heartbeat, check session health
-        if interest_found: 
-            last_heartbeat = ts
-        elif (ts-last_heartbeat) > heartbeat:
-            logger.debug("checking session status, last_heartbeat: %s" % (
-                last_heartbeat))
-            if not check_session_subscription_health(session):
-                logger.warn("session no longer alive")
-                return
-            last_heartbeat = ts
-        else: time.sleep(0.1)
+                last_heartbeat = ts
+            elif (ts-last_heartbeat) > heartbeat:
+                logger.debug("checking session status, last_heartbeat: %s, "\
+                    "event queue: %s, transfer: %s", last_heartbeat,
+                    session.get_event_queue_stats(),
+                    session.get_transfer_stats())
+                if not check_session_subscription_health(session):
+                    logger.warn("session no longer alive")
+                    return
+                last_heartbeat = ts
+    finally:
+        stop.set()
+        flush_interests(flushes)
+
+def flush_interests(flushes):
+    """ call each flush function and return new empty list of flushes """
+    for flush in flushes: flush()
+    return []
+
+def resync_interests(session, interests):
+    """ discard pending events and call resync function of each interest after
+        events have been dropped from a full event queue.  Return False if
+        any interest could not be resynchronized
+    """
+    logger.warn("subscription events dropped, resyncing (event queue: %s)",
+        session.get_event_queue_stats())
+    for cname in interests:
+        session.get_events(interests[cname]["url"])
+    # interests may share a single resync function
+    resyncs = []
+    for cname in interests:
+        resync = interests[cname].get("resync", None)
+        if resync is None:
+            logger.error("unable to resync %s, no resync function", cname)
+            return False
+        if resync not in resyncs: resyncs.append(resync)
+    for resync in resyncs:
+        if not resync():
+            logger.error("failed to resync subscriptions")
+            return False
+    return True
+
+def _wake_subscriber(session, interval, stop):
+    # wake session event dispatcher every interval seconds until stop is set
+    while not stop.is_set():
+        stop.wait(interval)
+        session.wake_events()
 
 def check_session_subscription_health(session):
     """ check health of session subscription thread and that corresponding
@@ -356,7 +879,7 @@ def check_session_subscription_health(session):
             get_dn(session, "uni") is not None
         )
     except Exception as e: pass
-    logger.debug("manual check to ensure session is still alive: %r" % alive)
+    logger.debug("manual check to ensure session is still alive: %r", alive)
     return alive
 
 ###############################################################################
@@ -379,23 +902,68 @@ def db_is_alive():
     logger.error("failed to connect to database")
     return False
 
-def init_db():
+def get_generation(db, name):
+    """ return current value of generation counter 'name' """
+    gen = db.generation.find_one({"_id":name})
+    if gen is None: return 0
+    return gen["gen"]
+
+def get_generations(db, names):
+    """ return dict with current value of each generation counter in names """
+    gens = dict((name, 0) for name in names)
+    for gen in db.generation.find({"_id":{"$in":list(names)}}):
+        gens[gen["_id"]] = gen["gen"]
+    return gens
+
+def bump_generation(db, name, count=1):
+    """ increment generation counter 'name' by count and return the new value.
+        Generation counters allow other processes to cheaply detect that a
+        collection has changed and can be used to allocate sequence numbers
+    """
+    gen = db.generation.find_one_and_update({"_id":name},
+        {"$inc":{"gen":count}}, upsert=True,
+        return_document=ReturnDocument.AFTER)
+    return gen["gen"]
+
+def init_db(drop=True):
     """ initalize database by dropping current db and setting up new collection
-        indexes
+        indexes.  Collections with a 'ttl' attribute get a TTL index on that
+        date field so documents are purged once the date has passed,
+        'indexes' is a list of additional non-unique indexed fields, and
+        'capped' creates a capped collection of the provided size in bytes.
+        If drop is False then existing collections and their documents are
+        kept and only missing collections and indexes are created
     """
     collections = {
         "dnsDomain": {"key": "dn"},
         "dnsProv": {"key": "dn"},   
-        "dnsCache": {"key": "addr"},
+        "dnsCache": {"key": "addr", "ttl": "expire", "indexes": ["prov"]},
+        "endpoint": {"key": "dn", "indexes": ["ip", "mac"]},
+        "endpointIp": {"key": "dn", "indexes": ["addr", "ep"]},
+        "endpointChanges": {"indexes": ["seq"]},
     }
     logger.debug("initializing database")
     app = get_app()
+    collections["endpointChanges"]["capped"] = app.config.get(
+        "ENDPOINT_CHANGES_SIZE", 16777216)
     with app.app_context():
         db = app.mongo.db
+        existing = db.collection_names()
         for cname in collections:
-            logger.debug("initializing collection: %s" % cname)
-            db[cname].drop()
+            logger.debug("initializing collection: %s", cname)
+            if drop or ("capped" in collections[cname] and cname in existing \
+                and not db[cname].options().get("capped", False)):
+                db[cname].drop()
+                if cname in existing: existing.remove(cname)
+            if "capped" in collections[cname] and cname not in existing:
+                db.create_collection(cname, capped=True,
+                    size=collections[cname]["capped"])
             if "key" in collections[cname]:
                 indexes = [(collections[cname]["key"], DESCENDING)]
                 db[cname].create_index(indexes, unique=True)
+            for index in collections[cname].get("indexes", []):
+                db[cname].create_index([(index, ASCENDING)])
+            if "ttl" in collections[cname]:
+                db[cname].create_index(collections[cname]["ttl"],
+                    expireAfterSeconds=0)
     logger.debug("database initialization complete")
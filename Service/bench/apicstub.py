@@ -0,0 +1,351 @@
+"""
+local APIC stand-in for offline benchmarks.  Serves synthetic class queries
+with APIC paging semantics, answers login, refresh and subscription requests,
+and pushes subscription events over a websocket on the same port.
+
+    python bench/apicstub.py -p 8080 -c fvCEp=100000 -c dnsProv=4 -l 5
+
+Benchmarks control the stand-in over http:
+    /bench/config?latency=<sec>&error_rate=<0-1>&compress=<0|1>
+    /bench/events?class=<classname>&count=<n>&rate=<events per sec>
+    /bench/stats
+"""
+import os, sys, re, time, json, gzip, base64, hashlib, random, struct
+import socket, threading, logging
+from io import BytesIO
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# websocket handshake magic value (rfc 6455)
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# login token and refresh timeout returned by aaaLogin/aaaRefresh
+LOGIN_TOKEN = "benchtoken"
+LOGIN_TIMEOUT = 600
+
+def make_object(cname, i):
+    """ return synthetic object of class cname for index i """
+    ip = "10.%s.%s.%s" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+    mac = "00:00:%02X:%02X:%02X:%02X" % ((i >> 24) & 0xff, (i >> 16) & 0xff,
+        (i >> 8) & 0xff, i & 0xff)
+    cep = "uni/tn-bench/ap-bench/epg-bench%s/cep-%s" % (i % 64, mac)
+    if cname == "fvCEp":
+        attr = {"dn": cep, "ip": ip, "mac": mac, "encap": "vlan-%s" % (
+            i % 4000 + 1)}
+    elif cname == "fvIp":
+        attr = {"dn": "%s/ip-[%s]" % (cep, ip), "addr": ip}
+    elif cname == "dnsProv":
+        attr = {"dn": "uni/fabric/dnsp-default/prov-[%s]" % ip, "addr": ip,
+            "preferred": "yes" if i == 0 else "no"}
+    elif cname == "dnsDomain":
+        attr = {"dn": "uni/fabric/dnsp-default/dom-bench%s.local" % i,
+            "name": "bench%s.local" % i,
+            "isDefault": "yes" if i == 0 else "no"}
+    else:
+        attr = {"dn": "uni/bench/%s-%s" % (cname, i), "name": "%s-%s" % (
+            cname, i)}
+    return {cname: {"attributes": attr}}
+
+def ws_frame(payload, opcode=0x1):
+    """ return unmasked websocket frame with fin bit set """
+    n = len(payload)
+    if n < 126: header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 65536: header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else: header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+class WebSocket(object):
+    """ server side of a single websocket connection """
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, payload, opcode=0x1):
+        with self.lock:
+            if self.closed: return False
+            try:
+                self.wfile.write(ws_frame(payload, opcode))
+                self.wfile.flush()
+                return True
+            except socket.error:
+                self.closed = True
+                return False
+
+    def read(self):
+        """ return tuple (opcode, payload) of next client frame or None if
+            the connection is closed
+        """
+        header = self.rfile.read(2)
+        if len(header) < 2: return None
+        (b0, b1) = struct.unpack("!BB", header)
+        n = b1 & 0x7f
+        if n == 126: n = struct.unpack("!H", self.rfile.read(2))[0]
+        elif n == 127: n = struct.unpack("!Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if b1 & 0x80 else None
+        payload = self.rfile.read(n)
+        if mask is not None:
+            payload = "".join(chr(ord(c) ^ ord(mask[j % 4])) for (j, c) in
+                enumerate(payload))
+        return (b0 & 0x0f, payload)
+
+    def serve(self):
+        """ answer pings and block until the client closes the connection """
+        while not self.closed:
+            frame = self.read()
+            if frame is None or frame[0] == 0x8:
+                self.send("", opcode=0x8)
+                break
+            if frame[0] == 0x9:
+                self.send(frame[1], opcode=0xa)
+        self.closed = True
+
+class ApicStub(ThreadingMixIn, HTTPServer):
+    """ threaded http server holding stand-in APIC state """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, classes, latency=0.0, error_rate=0.0,
+        compress=True, max_unpaged=100000):
+        HTTPServer.__init__(self, address, ApicStubHandler)
+        self.classes = classes          # classname -> object count
+        self.latency = latency          # seconds added to each api request
+        self.error_rate = error_rate    # fraction of class queries failing
+        self.compress = compress        # gzip responses when accepted
+        self.max_unpaged = max_unpaged  # unpaged 'dataset is too big' limit
+        self.lock = threading.Lock()
+        self.subscriptions = {}         # subscription id -> classname
+        self.websockets = []
+        self.stats = {"requests": 0, "errors": 0, "events": 0, "logins": 0}
+        self._pages = {}
+        self._next_id = 1
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat]+= n
+
+    def subscribe(self, cname):
+        """ return new subscription id for classname """
+        with self.lock:
+            sid = "%s" % (72057598332895233 + self._next_id)
+            self._next_id+= 1
+            self.subscriptions[sid] = cname
+            return sid
+
+    def page(self, cname, page, page_size):
+        """ return json string with imdata list of a page of objects.  Pages
+            are cached so repeated queries measure the client, not the stub
+        """
+        key = (cname, page, page_size)
+        with self.lock:
+            if key in self._pages: return self._pages[key]
+        total = self.classes.get(cname, 0)
+        start = min(total, page * page_size)
+        end = min(total, start + page_size)
+        imdata = ",".join(json.dumps(make_object(cname, i)) for i in
+            xrange(start, end))
+        with self.lock:
+            if len(self._pages) >= 64: self._pages.clear()
+            self._pages[key] = imdata
+        return imdata
+
+    def push_events(self, cname, count, rate=0.0):
+        """ send count modified events for classname to all websockets at
+            rate events per second (0 for as fast as possible)
+        """
+        with self.lock:
+            sids = [s for s in self.subscriptions if
+                self.subscriptions[s] == cname]
+            websockets = [ws for ws in self.websockets if not ws.closed]
+        total = max(1, self.classes.get(cname, 0))
+        start = time.time()
+        for i in xrange(count):
+            if rate > 0:
+                delay = start + float(i) / rate - time.time()
+                if delay > 0: time.sleep(delay)
+            obj = make_object(cname, i % total)
+            obj[cname]["attributes"].update({"status": "modified",
+                "benchTs": "%f" % time.time()})
+            payload = json.dumps({"subscriptionId": sids, "imdata": [obj]})
+            for ws in websockets: ws.send(payload)
+        self.count("events", count)
+
+class ApicStubHandler(BaseHTTPRequestHandler):
+    """ stand-in for the APIC REST api and websocket """
+    protocol_version = "HTTP/1.1"
+    # buffer each reply into a single write so small responses are not
+    # delayed by nagle and delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt % args)
+
+    def reply(self, code, body, content_type="application/json"):
+        headers = {"Content-Type": content_type}
+        if self.server.compress and len(body) > 1024 and \
+            "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = BytesIO()
+            with gzip.GzipFile(mode="wb", compresslevel=1, fileobj=buf) as f:
+                f.write(body)
+            body = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = "%s" % len(body)
+        self.send_response(code)
+        for h in headers: self.send_header(h, headers[h])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def login(self):
+        self.server.count("logins")
+        body = json.dumps({"totalCount": "1", "imdata": [{"aaaLogin": {
+            "attributes": {"token": LOGIN_TOKEN,
+            "refreshTimeoutSeconds": "%s" % LOGIN_TIMEOUT}}}]})
+        self.reply(200, body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 0: self.rfile.read(length)
+        self.server.count("requests")
+        if re.search("/api/(aaaLogin|requestAppToken).json", self.path):
+            return self.login()
+        self.reply(200, '{"totalCount":"0","imdata":[]}')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for (k, v) in parse_qs(url.query).items())
+        if url.path.startswith("/socket"):
+            return self.websocket()
+        if url.path.startswith("/bench/"):
+            return self.control(url.path, params)
+        self.server.count("requests")
+        if self.server.latency > 0: time.sleep(self.server.latency)
+        if url.path == "/api/aaaRefresh.json":
+            return self.login()
+        if url.path == "/api/subscriptionRefresh.json":
+            return self.reply(200, '{"totalCount":"0","imdata":[]}')
+        r1 = re.search("^/api/class/(?P<cname>[^/]+)\.json$", url.path)
+        if r1 is not None:
+            return self.class_query(r1.group("cname"), params)
+        r1 = re.search("^/api/mo/(?P<dn>.+)\.json$", url.path)
+        if r1 is not None:
+            body = json.dumps({"totalCount": "1", "imdata": [{"polUni": {
+                "attributes": {"dn": r1.group("dn")}}}]})
+            return self.reply(200, body)
+        self.reply(404, '{"totalCount":"0","imdata":[]}')
+
+    def class_query(self, cname, params):
+        if self.server.error_rate > 0 and \
+            random.random() < self.server.error_rate:
+            self.server.count("errors")
+            return self.reply(500, '{"totalCount":"0","imdata":[]}')
+        total = self.server.classes.get(cname, 0)
+        if "page-size" in params:
+            page_size = max(1, int(params["page-size"]))
+            page = int(params.get("page", 0))
+        elif self.server.max_unpaged > 0 and total > self.server.max_unpaged:
+            return self.reply(400, json.dumps({"totalCount": "1", "imdata": [
+                {"error": {"attributes": {"code": "400", "text": "Unable to "\
+                "process the query, result dataset is too big"}}}]}))
+        else:
+            (page, page_size) = (0, max(1, total))
+        body = '{"totalCount":"%s",' % total
+        if params.get("subscription") == "yes":
+            body+= '"subscriptionId":"%s",' % self.server.subscribe(cname)
+        body+= '"imdata":[%s]}' % self.server.page(cname, page, page_size)
+        self.reply(200, body)
+
+    def websocket(self):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        ws = WebSocket(self.rfile, self.wfile)
+        with self.server.lock:
+            self.server.websockets.append(ws)
+        try:
+            ws.serve()
+        finally:
+            with self.server.lock:
+                self.server.websockets.remove(ws)
+            self.close_connection = 1
+
+    def control(self, path, params):
+        server = self.server
+        if path == "/bench/config":
+            if "latency" in params: server.latency = float(params["latency"])
+            if "error_rate" in params:
+                server.error_rate = float(params["error_rate"])
+            if "compress" in params:
+                server.compress = bool(int(params["compress"]))
+        elif path == "/bench/events":
+            t = threading.Thread(target=server.push_events, args=(
+                params.get("class", "fvCEp"), int(params.get("count", 1)),
+                float(params.get("rate", 0))))
+            t.daemon = True
+            t.start()
+        elif path != "/bench/stats":
+            return self.reply(404, "{}")
+        with server.lock:
+            stats = dict(server.stats)
+            stats.update({"latency": server.latency,
+                "error_rate": server.error_rate, "compress": server.compress,
+                "websockets": len(server.websockets)})
+        self.reply(200, json.dumps(stats))
+
+def parse_classes(values):
+    """ return dict of classname to object count from list of 'class=count' """
+    classes = {}
+    for value in values:
+        (cname, count) = value.split("=", 1)
+        classes[cname] = int(count)
+    return classes
+
+def get_args():
+    # get command line arguments
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", action="store", dest="address",
+        default="127.0.0.1", help="listen address")
+    parser.add_argument("-p", action="store", dest="port", type=int,
+        default=8080, help="listen port")
+    parser.add_argument("-c", action="append", dest="classes", default=[],
+        help="classname=count of synthetic objects, may be repeated")
+    parser.add_argument("-l", action="store", dest="latency", type=float,
+        default=0.0, help="milliseconds added to each api request")
+    parser.add_argument("-e", action="store", dest="error_rate", type=float,
+        default=0.0, help="fraction of class queries returning an error")
+    parser.add_argument("--max-unpaged", action="store", dest="max_unpaged",
+        type=int, default=100000, help="objects returned by an unpaged query "\
+        "before it fails with 'dataset is too big'")
+    parser.add_argument("--no-compress", action="store_false", dest="compress",
+        help="never compress responses")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = get_args()
+    classes = parse_classes(args.classes)
+    if len(classes) == 0:
+        classes = {"fvCEp": 10000, "fvIp": 10000, "dnsProv": 4, "dnsDomain": 2}
+    server = ApicStub((args.address, args.port), classes,
+        latency=args.latency / 1000.0, error_rate=args.error_rate,
+        compress=args.compress, max_unpaged=args.max_unpaged)
+    print "APIC stand-in listening on %s:%s, classes: %s" % (args.address,
+        server.server_address[1], classes)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt as e:
+        print "\ngoodbye!\n"
@@ -0,0 +1,60 @@
+"""
+common helpers for benchmark runners
+"""
+import time, socket, resource
+
+# only database benchmarks write to and drop
+BENCH_DBNAME = "bench"
+
+def percentile(values, p):
+    """ return p percentile (0-100) of sorted list of values """
+    if len(values) == 0: return 0.0
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def summarize(name, count, seconds, latencies, **kwargs):
+    """ return result dict for a benchmark path with latencies in seconds """
+    latencies = sorted(latencies)
+    ret = {
+        "path": name,
+        "count": count,
+        "seconds": seconds,
+        "rate": count / seconds if seconds > 0 else 0.0,
+        "p50": percentile(latencies, 50) * 1000.0,
+        "p95": percentile(latencies, 95) * 1000.0,
+        "p99": percentile(latencies, 99) * 1000.0,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+    ret.update(kwargs)
+    return ret
+
+def print_results(results):
+    """ print table of result dicts """
+    print "%-16s %9s %9s %11s %9s %9s %9s %8s" % ("path", "count", "seconds",
+        "rate/s", "p50 ms", "p95 ms", "p99 ms", "rss MB")
+    for r in results:
+        if "error" in r:
+            print "%-16s error: %s" % (r["path"], r["error"])
+            continue
+        print "%-16s %9s %9.3f %11.1f %9.3f %9.3f %9.3f %8.1f" % (r["path"],
+            r["count"], r["seconds"], r["rate"], r["p50"], r["p95"], r["p99"],
+            r["rss"])
+
+def check_bench_db(db):
+    """ raise Exception unless db is the benchmark database so a mongo uri
+        pointing at the app database is never initialized or dropped
+    """
+    if db.name != BENCH_DBNAME:
+        raise Exception("refusing to use database '%s', benchmarks only use "
+            "'%s'" % (db.name, BENCH_DBNAME))
+
+def wait_for_port(port, timeout=10.0, host="127.0.0.1"):
+    """ return True once tcp port accepts connections, False on timeout """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.1)
+    return False
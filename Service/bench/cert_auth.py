@@ -0,0 +1,73 @@
+"""
+micro-benchmark of per-request client cpu cost for certificate authentication
+where every request is signed with the private key, compared to token login
+where requests only carry the login token cookie.  Both modes perform the
+same per-request work: the Session header preparation followed by building
+the request with the session cookie jar (which holds the token when logged in).
+
+    python bench/cert_auth.py -n 2000 -b 2048
+"""
+import os, sys, time, tempfile, logging, requests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from OpenSSL.crypto import PKey, TYPE_RSA, FILETYPE_PEM, dump_privatekey
+from app.acitoolkit.acisession import Session
+
+# stand-in for the APIC-cookie token set by the login
+TOKEN = "x" * 256
+
+def get_args():
+    # get command line arguments
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", action="store", dest="count", type=int,
+        default=2000, help="number of requests to prepare per mode")
+    parser.add_argument("-b", action="store", dest="bits", type=int,
+        default=2048, help="rsa key size in bits")
+    parser.add_argument("-u", action="store", dest="url",
+        default="/api/class/fvCEp.json?page=%s&page-size=75000",
+        help="request url, %%s is replaced with request number")
+    return parser.parse_args()
+
+def get_session(bits):
+    """ return cert auth Session using a newly generated private key """
+    key = PKey()
+    key.generate_key(TYPE_RSA, bits)
+    (fd, path) = tempfile.mkstemp(suffix=".key")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(dump_privatekey(FILETYPE_PEM, key))
+        return Session("https://127.0.0.1", "bench", cert_name="bench",
+            key=path, appcenter_user=True, subscription_enabled=False)
+    finally:
+        os.remove(path)
+
+def run(session, logged_in, count, url):
+    """ return tuple (wall, cpu) seconds to prepare count GET requests """
+    session._logged_in = logged_in
+    if session.session is None: session.session = session._new_session()
+    session.session.cookies.clear()
+    if logged_in: session.session.cookies.set("APIC-cookie", TOKEN)
+    (wall, cpu) = (time.time(), time.clock())
+    for i in xrange(count):
+        cookies = session._prep_x509_header("GET", url % i)
+        session.session.prepare_request(requests.Request("GET",
+            session.api + url % i, cookies=cookies))
+    return (time.time() - wall, time.clock() - cpu)
+
+if __name__ == "__main__":
+
+    args = get_args()
+    # headers are logged at debug, keep logging cost out of the comparison
+    logging.getLogger().setLevel(logging.WARN)
+    session = get_session(args.bits)
+    print "%s requests, %s bit rsa key" % (args.count, args.bits)
+    results = {}
+    for (name, logged_in) in [("signature", False), ("token", True)]:
+        (wall, cpu) = run(session, logged_in, args.count, args.url)
+        results[name] = cpu
+        print "%-10s wall: %0.3fs, cpu: %0.3fs, %0.1fus cpu/request" % (name,
+            wall, cpu, cpu * 1e6 / args.count)
+    if results["token"] > 0:
+        print "signature/token cpu ratio: %0.1fx" % (
+            results["signature"] / results["token"])
@@ -0,0 +1,120 @@
+"""
+local authoritative DNS stand-in for offline benchmarks.  Answers every PTR
+query with a synthetic hostname after a configurable latency, drops a fraction
+of queries and answers a fraction of addresses with NXDOMAIN.  The NXDOMAIN
+decision is a hash of the query name so repeated lookups of an address get the
+same answer.  Addresses within the short-ttl network are answered with a short
+ttl (and never NXDOMAIN) so their cache entries expire quickly.
+
+    python bench/dnsstub.py -p 5353 -l 2 --loss 0.01 --nxdomain 0.1
+"""
+import sys, time, random, zlib, threading, logging
+import ipaddress
+from SocketServer import ThreadingUDPServer, BaseRequestHandler
+import dns.message, dns.rcode, dns.rdatatype, dns.rrset, dns.reversename
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+class DnsStub(ThreadingUDPServer):
+    """ threaded udp server holding stand-in nameserver settings """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, loss=0.0, nxdomain=0.0, ttl=300,
+        short_ttl=2, short_ttl_net="10.2.0.0/16"):
+        ThreadingUDPServer.__init__(self, address, DnsStubHandler)
+        self.latency = latency          # seconds before each answer
+        self.loss = loss                # fraction of queries not answered
+        self.nxdomain = nxdomain        # fraction of addresses not found
+        self.ttl = ttl
+        self.short_ttl = short_ttl
+        self.short_ttl_net = ipaddress.ip_network(u"%s" % short_ttl_net)
+        self.lock = threading.Lock()
+        self.stats = {"queries": 0, "dropped": 0, "nxdomain": 0}
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat]+= 1
+
+    def answer(self, query):
+        """ return response message for query or None to drop it """
+        self.count("queries")
+        if self.loss > 0 and random.random() < self.loss:
+            self.count("dropped")
+            return None
+        if self.latency > 0: time.sleep(self.latency)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        if question.rdtype != dns.rdatatype.PTR:
+            return response
+        name = question.name
+        try:
+            addr = ipaddress.ip_address(u"%s" % dns.reversename.to_address(
+                name))
+        except Exception:
+            response.set_rcode(dns.rcode.FORMERR)
+            return response
+        short = addr in self.short_ttl_net
+        if not short and self.nxdomain > 0 and (zlib.crc32(name.to_text()) & \
+            0xffff) < self.nxdomain * 0x10000:
+            self.count("nxdomain")
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            return response
+        host = "host-%s.bench.local." % ("%s" % addr).replace(".", "-"
+            ).replace(":", "-")
+        response.answer.append(dns.rrset.from_text(name,
+            self.short_ttl if short else self.ttl, "IN", "PTR", host))
+        return response
+
+class DnsStubHandler(BaseRequestHandler):
+    """ answer a single udp dns query """
+    def handle(self):
+        (data, sock) = self.request
+        try:
+            query = dns.message.from_wire(data)
+        except Exception as e:
+            logger.debug("invalid query from %s: %s" % (self.client_address,
+                e))
+            return
+        response = self.server.answer(query)
+        if response is not None:
+            sock.sendto(response.to_wire(), self.client_address)
+
+def get_args():
+    # get command line arguments
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", action="store", dest="address",
+        default="127.0.0.1", help="listen address")
+    parser.add_argument("-p", action="store", dest="port", type=int,
+        default=5353, help="listen udp port")
+    parser.add_argument("-l", action="store", dest="latency", type=float,
+        default=0.0, help="milliseconds before each answer")
+    parser.add_argument("--loss", action="store", type=float, default=0.0,
+        help="fraction of queries that are not answered")
+    parser.add_argument("--nxdomain", action="store", type=float, default=0.0,
+        help="fraction of addresses answered with NXDOMAIN")
+    parser.add_argument("--ttl", action="store", type=int, default=300,
+        help="ttl of PTR records")
+    parser.add_argument("--short-ttl", action="store", dest="short_ttl",
+        type=int, default=2, help="ttl of PTR records in --short-ttl-net")
+    parser.add_argument("--short-ttl-net", action="store",
+        dest="short_ttl_net", default="10.2.0.0/16",
+        help="network answered with --short-ttl")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = get_args()
+    server = DnsStub((args.address, args.port), latency=args.latency/1000.0,
+        loss=args.loss, nxdomain=args.nxdomain, ttl=args.ttl,
+        short_ttl=args.short_ttl, short_ttl_net=args.short_ttl_net)
+    print "DNS stand-in listening on udp %s:%s" % (args.address,
+        server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt as e:
+        print "\ngoodbye!\n"
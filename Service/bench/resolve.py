@@ -0,0 +1,234 @@
+"""
+load test of /resolve.json through the Flask app against the local DNS
+stand-in (bench/dnsstub.py).  The app is served by a WSGI server with a fixed
+number of request threads, matching the WSGIDaemonProcess threads=5 deployment,
+and driven by concurrent clients.  Latency percentiles and requests per second
+are reported separately for:
+
+    resolve.miss      addresses not yet cached, resolved by the stand-in
+    resolve.hit       the same addresses again, answered from the cache
+    resolve.expired   addresses whose cached entries (short ttl) have expired
+
+Uses the 'bench' database on mongo at --mongo-uri, or a local mongod started
+with --mongod, or MONGO_HOST/MONGO_PORT.  Any other database is refused.  The
+database is dropped once complete.
+
+    python bench/resolve.py -n 2000 -l 5 --loss 0.01 --nxdomain 0.1
+"""
+import os, sys, time, json, shutil, subprocess, tempfile, threading, logging
+from Queue import Queue
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+import requests
+import dns.message, dns.query, dns.exception
+from benchutils import (summarize, print_results, wait_for_port,
+    check_bench_db, BENCH_DBNAME)
+
+# app logging only for warnings, set before the app config is imported
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+os.environ.setdefault("LOG_DIR", tempfile.gettempdir())
+os.environ.setdefault("LOG_LEVEL", "%s" % logging.WARN)
+os.environ["MONGO_DBNAME"] = BENCH_DBNAME
+os.environ.pop("MONGO_URI", None)
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+class PoolWSGIServer(WSGIServer):
+    """ WSGI server handling requests on a fixed number of threads """
+    def __init__(self, address, app, threads=5):
+        WSGIServer.__init__(self, address, QuietHandler)
+        self.set_app(app)
+        self.requests = Queue()
+        for i in xrange(threads):
+            t = threading.Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+
+    def worker(self):
+        while True:
+            (request, client_address) = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+def addresses(net, count):
+    """ return list of count ipv4 addresses within 10.<net>.0.0/16 """
+    return ["10.%s.%s.%s" % (net, (i >> 8) & 0xff, i & 0xff) for i in
+        xrange(count)]
+
+def run_phase(name, url, addrs, clients):
+    """ resolve each address once with concurrent clients and return result
+        dict, counting responses served from the cache
+    """
+    pending = Queue()
+    for addr in addrs: pending.put(addr)
+    (latencies, cached, errors) = ([], [0], [0])
+    lock = threading.Lock()
+    def client():
+        session = requests.Session()
+        while not pending.empty():
+            try: addr = pending.get_nowait()
+            except Exception: break
+            ts = time.time()
+            try:
+                resp = session.get(url, params={"ip": addr}, timeout=30)
+                ok = resp.status_code == 200
+                cache = ok and resp.json().get("cache", False)
+            except requests.exceptions.RequestException:
+                (ok, cache) = (False, False)
+            latency = time.time() - ts
+            with lock:
+                latencies.append(latency)
+                if not ok: errors[0]+= 1
+                if cache: cached[0]+= 1
+    threads = [threading.Thread(target=client) for i in xrange(clients)]
+    start = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return summarize(name, len(latencies), time.time() - start, latencies,
+        cached=cached[0], errors=errors[0], clients=clients)
+
+def start_dns_stub(args):
+    """ start DNS stand-in subprocess and wait until it answers """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), "dnsstub.py"), "-p", "%s" % args.dns_port,
+        "-l", "%s" % args.latency, "--loss", "%s" % args.loss,
+        "--nxdomain", "%s" % args.nxdomain,
+        "--short-ttl", "%s" % args.short_ttl]
+    stub = subprocess.Popen(cmd, stdout=open(os.devnull, "w"))
+    query = dns.message.make_query("1.0.0.127.in-addr.arpa.", "PTR")
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            dns.query.udp(query, "127.0.0.1", timeout=0.5, port=args.dns_port)
+            return stub
+        except dns.exception.Timeout:
+            pass
+    stub.kill()
+    raise Exception("DNS stand-in did not start on port %s" % args.dns_port)
+
+def start_mongod(args):
+    """ start local mongod with temporary dbpath and return tuple
+        (process, dbpath)
+    """
+    dbpath = tempfile.mkdtemp(prefix="benchdb")
+    cmd = [args.mongod, "--dbpath", dbpath, "--port", "%s" % args.mongo_port,
+        "--bind_ip", "127.0.0.1"]
+    mongod = subprocess.Popen(cmd, stdout=open(os.devnull, "w"))
+    if wait_for_port(args.mongo_port, timeout=30): return (mongod, dbpath)
+    mongod.kill()
+    shutil.rmtree(dbpath, ignore_errors=True)
+    raise Exception("mongod did not start on port %s" % args.mongo_port)
+
+def setup_db(app, args):
+    """ initialize dns collections with the stand-in as only dnsProv """
+    from app.utils import init_db, bump_generation
+    with app.app_context():
+        db = app.mongo.db
+        check_bench_db(db)
+        db.client.server_info()
+        init_db()
+        db.dnsProv.insert_one({"dn": "uni/fabric/dnsp-default/prov-[127.0.0.1]",
+            "addr": "127.0.0.1", "preferred": True})
+        bump_generation(db, "dnsProv")
+
+def drop_db(app):
+    """ drop the benchmark database """
+    with app.app_context():
+        db = app.mongo.db
+        check_bench_db(db)
+        db.client.drop_database(db.name)
+
+def get_args():
+    # get command line arguments
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", action="store", dest="count", type=int,
+        default=2000, help="requests per case")
+    parser.add_argument("-t", action="store", dest="threads", type=int,
+        default=5, help="WSGI request threads")
+    parser.add_argument("-c", action="store", dest="clients", type=int,
+        default=10, help="concurrent clients")
+    parser.add_argument("-p", action="store", dest="port", type=int,
+        default=18081, help="WSGI server port")
+    parser.add_argument("-l", action="store", dest="latency", type=float,
+        default=2.0, help="milliseconds of DNS stand-in latency")
+    parser.add_argument("--loss", action="store", type=float, default=0.0,
+        help="fraction of DNS queries dropped")
+    parser.add_argument("--nxdomain", action="store", type=float, default=0.1,
+        help="fraction of addresses answered with NXDOMAIN")
+    parser.add_argument("--short-ttl", action="store", dest="short_ttl",
+        type=int, default=2, help="ttl of records for the expired case")
+    parser.add_argument("--dns-port", action="store", dest="dns_port",
+        type=int, default=15353, help="DNS stand-in udp port")
+    parser.add_argument("--mongo-uri", action="store", dest="mongo_uri",
+        default=None, help="mongo uri with database %s" % BENCH_DBNAME)
+    parser.add_argument("--mongod", action="store", default=None,
+        help="path of mongod binary to start a temporary local mongo")
+    parser.add_argument("--mongo-port", action="store", dest="mongo_port",
+        type=int, default=27117, help="port of the temporary local mongo")
+    parser.add_argument("--json", action="store_true", dest="json",
+        help="print results as json")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+
+    args = get_args()
+    os.environ["DNS_PORT"] = "%s" % args.dns_port
+    (mongod, dbpath) = (None, None)
+    if args.mongod is not None:
+        (mongod, dbpath) = start_mongod(args)
+        args.mongo_uri = "mongodb://127.0.0.1:%s/%s" % (args.mongo_port,
+            BENCH_DBNAME)
+    if args.mongo_uri is not None: os.environ["MONGO_URI"] = args.mongo_uri
+    stub = start_dns_stub(args)
+    try:
+        from app.utils import get_app
+        app = get_app()
+        setup_db(app, args)
+        server = PoolWSGIServer(("127.0.0.1", args.port), app, args.threads)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        url = "http://127.0.0.1:%s/resolve.json" % args.port
+
+        # addresses in 10.2.0.0/16 are answered with a short ttl by the
+        # stand-in, cache them first so they have expired by the last case
+        expiring = addresses(2, args.count)
+        run_phase("setup", url, expiring, args.clients)
+        warmed = time.time()
+        fresh = addresses(1, args.count)
+        results = [
+            run_phase("resolve.miss", url, fresh, args.clients),
+            run_phase("resolve.hit", url, fresh, args.clients),
+        ]
+        time.sleep(max(0, warmed + args.short_ttl + 1 - time.time()))
+        results.append(run_phase("resolve.expired", url, expiring,
+            args.clients))
+        server.shutdown()
+        drop_db(app)
+    finally:
+        stub.terminate()
+        if mongod is not None:
+            mongod.terminate()
+            mongod.wait()
+            shutil.rmtree(dbpath, ignore_errors=True)
+
+    if args.json:
+        print json.dumps(results, indent=4, sort_keys=True)
+        sys.exit(0)
+    print "%s threads, %s clients, dns latency %sms, loss %s, nxdomain %s" % (
+        args.threads, args.clients, args.latency, args.loss, args.nxdomain)
+    print_results(results)
+    for r in results:
+        print "%-16s cached: %s, errors: %s" % (r["path"], r["cached"],
+            r["errors"])
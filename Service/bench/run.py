@@ -0,0 +1,237 @@
+"""
+offline benchmark runner.  Starts the local APIC stand-in (bench/apicstub.py)
+and runs each benchmark in its own process against it, reporting throughput,
+latency percentiles and peak RSS per path:
+
+    paging      utils.get_class paged pull of fvCEp objects
+    session     Session.get single page queries, including error retries
+    events      websocket events through Subscriber routing and utils.subscribe
+                dispatch to the callback
+    dns         subscriber handle_dns_event and batched writes to the 'bench'
+                database on mongo at --mongo-uri or MONGO_HOST/MONGO_PORT.
+                Any other database is refused.  The database is dropped
+
+    python bench/run.py -n 100000 -l 2 paging events
+"""
+import os, sys, time, json, subprocess, tempfile, threading
+import multiprocessing, logging
+from urllib2 import urlopen
+from benchutils import (summarize, print_results, wait_for_port,
+    check_bench_db, BENCH_DBNAME)
+
+# run against the stand-in with app logging only for warnings, set before the
+# app config is imported
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+os.environ.setdefault("LOG_DIR", tempfile.gettempdir())
+os.environ.setdefault("LOG_LEVEL", "%s" % logging.WARN)
+os.environ["MONGO_DBNAME"] = BENCH_DBNAME
+os.environ.pop("MONGO_URI", None)
+os.environ["APIC_CERT_MODE"] = "0"
+
+BENCHMARKS = ["paging", "session", "events", "dns"]
+
+def stub_control(args, path):
+    """ send control request to the stand-in and return its stats """
+    return json.loads(urlopen("http://127.0.0.1:%s%s" % (args.port, path),
+        timeout=10).read())
+
+def bench_paging(args):
+    """ repeated paged class pulls through utils.get_class """
+    from app.utils import get_apic_session, get_class
+    session = get_apic_session()
+    (count, latencies) = (0, [])
+    start = time.time()
+    for i in xrange(args.iterations):
+        ts = time.time()
+        objects = get_class(session, "fvCEp", page_size=args.page_size)
+        latencies.append(time.time() - ts)
+        if objects is None: raise Exception("fvCEp query failed")
+        count+= len(objects)
+    return [summarize("paging", count, time.time() - start, latencies,
+        unit="objects", transfer=session.get_transfer_stats())]
+
+def bench_session(args):
+    """ single page Session.get calls with error_rate failed requests that
+        are retried by the session
+    """
+    from app.utils import get_apic_session
+    session = get_apic_session()
+    stub_control(args, "/bench/config?error_rate=%s" % args.error_rate)
+    url = "/api/class/fvCEp.json?page-size=%s&page=0" % min(args.objects,
+        args.page_size)
+    latencies = []
+    start = time.time()
+    try:
+        for i in xrange(args.requests):
+            ts = time.time()
+            resp = session.get(url)
+            resp.content
+            latencies.append(time.time() - ts)
+    finally:
+        stub_control(args, "/bench/config?error_rate=0")
+    return [summarize("session", args.requests, time.time() - start,
+        latencies, unit="requests", error_rate=args.error_rate)]
+
+class StopBenchmark(Exception):
+    pass
+
+def bench_events(args):
+    """ fvCEp events pushed by the stand-in through the websocket, Subscriber
+        event routing and utils.subscribe dispatch.  'events.route' measures
+        websocket receive to callback, 'events.e2e' stand-in send to callback
+    """
+    from app.utils import subscribe
+    (route, e2e, received) = ([], [], [])
+    done = threading.Event()
+    def callback(event):
+        ts = time.time()
+        for obj in event.get("imdata", []):
+            attr = obj.values()[0]["attributes"]
+            route.append(ts - event["_ts"])
+            if "benchTs" in attr: e2e.append(ts - float(attr["benchTs"]))
+            received.append(ts)
+        if len(received) >= args.events:
+            done.set()
+            raise StopBenchmark()
+    def run():
+        try:
+            subscribe({"fvCEp": {"callback": callback}}, heartbeat=5.0)
+        except StopBenchmark: pass
+        done.set()
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    # wait for subscription before pushing events
+    deadline = time.time() + 30
+    while stub_control(args, "/bench/stats")["websockets"] == 0:
+        if time.time() > deadline or done.is_set():
+            raise Exception("subscription not established")
+        time.sleep(0.1)
+    time.sleep(0.5)
+    start = time.time()
+    stub_control(args, "/bench/events?class=fvCEp&count=%s&rate=%s" % (
+        args.events, args.rate))
+    done.wait(max(60, 2 * args.events / args.rate if args.rate > 0 else 0))
+    seconds = (received[-1] if len(received) > 0 else time.time()) - start
+    return [
+        summarize("events.route", len(route), seconds, route, unit="events",
+            rate_limit=args.rate),
+        summarize("events.e2e", len(e2e), seconds, e2e, unit="events",
+            rate_limit=args.rate),
+    ]
+
+def bench_dns(args):
+    """ dnsProv and dnsDomain events through subscriber.handle_dns_event with
+        batched writes flushed every batch events
+    """
+    from app.utils import get_app, init_db
+    from app import subscriber
+    from apicstub import make_object
+    app = get_app()
+    with app.app_context():
+        db = app.mongo.db
+        check_bench_db(db)
+        db.client.server_info()
+        init_db()
+        subscriber.db = db
+        statuses = ["created", "modified", "deleted"]
+        (latencies, count) = ([], 0)
+        start = time.time()
+        for i in xrange(args.dns_events / args.batch):
+            ts = time.time()
+            for j in xrange(args.batch):
+                n = i * args.batch + j
+                cname = "dnsProv" if n % 2 == 0 else "dnsDomain"
+                obj = make_object(cname, (n / 2) % 256)
+                obj[cname]["attributes"]["status"] = statuses[(n / 512) % 3]
+                subscriber.handle_dns_event({"imdata": [obj]})
+            subscriber.flush_dns_events()
+            latencies.append(time.time() - ts)
+            count+= args.batch
+        seconds = time.time() - start
+        db.client.drop_database(db.name)
+    return [summarize("dns", count, seconds, latencies, unit="events",
+        batch=args.batch)]
+
+def run_benchmark(name, args, queue):
+    # run a single benchmark in a child process and return results on queue
+    try:
+        queue.put(globals()["bench_%s" % name](args))
+    except Exception as e:
+        queue.put([{"path": name, "error": "%s" % e}])
+
+def start_stub(args):
+    """ start stand-in subprocess and wait until it accepts connections """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(
+        __file__)), "apicstub.py"), "-p", "%s" % args.port,
+        "-l", "%s" % args.latency, "-c", "fvCEp=%s" % args.objects,
+        "-c", "dnsProv=4", "-c", "dnsDomain=2"]
+    if args.no_compress: cmd.append("--no-compress")
+    stub = subprocess.Popen(cmd, stdout=open(os.devnull, "w"))
+    if wait_for_port(args.port): return stub
+    stub.kill()
+    raise Exception("APIC stand-in did not start on port %s" % args.port)
+
+def get_args():
+    # get command line arguments
+
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", default=BENCHMARKS,
+        help="benchmarks to run: %s (default all)" % ", ".join(BENCHMARKS))
+    parser.add_argument("-p", action="store", dest="port", type=int,
+        default=18080, help="stand-in listen port")
+    parser.add_argument("-n", action="store", dest="objects", type=int,
+        default=50000, help="number of fvCEp objects")
+    parser.add_argument("-l", action="store", dest="latency", type=float,
+        default=0.0, help="milliseconds of stand-in latency per request")
+    parser.add_argument("-i", action="store", dest="iterations", type=int,
+        default=5, help="paging: number of full class pulls")
+    parser.add_argument("--page-size", action="store", dest="page_size",
+        type=int, default=10000, help="paging: objects per page")
+    parser.add_argument("--requests", action="store", type=int, default=200,
+        help="session: number of requests")
+    parser.add_argument("--error-rate", action="store", dest="error_rate",
+        type=float, default=0.1, help="session: fraction of failed requests")
+    parser.add_argument("--events", action="store", type=int, default=20000,
+        help="events: number of websocket events")
+    parser.add_argument("--rate", action="store", type=float, default=0,
+        help="events: events per second, 0 for as fast as possible")
+    parser.add_argument("--dns-events", action="store", dest="dns_events",
+        type=int, default=20000, help="dns: number of dns events")
+    parser.add_argument("--batch", action="store", type=int, default=500,
+        help="dns: events per flush")
+    parser.add_argument("--mongo-uri", action="store", dest="mongo_uri",
+        default=None, help="dns: mongo uri with database %s" % BENCH_DBNAME)
+    parser.add_argument("--no-compress", action="store_true",
+        dest="no_compress", help="disable stand-in response compression")
+    parser.add_argument("--json", action="store_true", dest="json",
+        help="print results as json")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS: parser.error("unknown benchmark %s" % name)
+    return args
+
+if __name__ == "__main__":
+
+    args = get_args()
+    os.environ["APIC_HOSTNAME"] = "http://127.0.0.1:%s" % args.port
+    if args.mongo_uri is not None: os.environ["MONGO_URI"] = args.mongo_uri
+    stub = start_stub(args)
+    results = []
+    try:
+        for name in args.benchmarks:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run_benchmark, args=(name, args,
+                queue))
+            p.start()
+            results+= queue.get()
+            p.join()
+    finally:
+        stub.terminate()
+
+    if args.json:
+        print json.dumps(results, indent=4, sort_keys=True)
+        sys.exit(0)
+    print_results(results)
@@ -11,6 +11,8 @@ MONGO_DBNAME = os.environ.get("MONGO_DBNAME","devdb")
 MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
 MONGO_CONNECT_TIMEOUT_MS = 5000
 MONGO_SOCKET_TIMEOUT_MS = 20000
+# MONGO_URI (including database name) overrides host, port, and dbname
+if "MONGO_URI" in os.environ: MONGO_URI = os.environ["MONGO_URI"]
 
 # enable application debugging (ensure debugging is disabled on production app)
 DEBUG = bool(int(os.environ.get("DEBUG", 1)))
@@ -19,9 +21,37 @@ DEBUG = bool(int(os.environ.get("DEBUG", 1)))
 JSONIFY_PRETTYPRINT_REGULAR = bool(int(
                             os.environ.get("JSONIFY_PRETTYPRINT_REGULAR",0)))
 
-# logging options
+# compress api responses of at least COMPRESS_MIN_SIZE bytes for clients that
+# accept gzip or deflate encoding, COMPRESS_LEVEL 1-9 or 0 to disable
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+# requests taking at least REQUEST_SLOW_THRESHOLD seconds (0 disables) are
+# logged with the time spent in mongo, apic, and dns.  REQUEST_PROFILE_RATE is
+# the fraction of requests run under cProfile and requests with an X-Profile
+# header are always profiled if REQUEST_PROFILE_ON_DEMAND is enabled.  Profiles
+# of slow or X-Profile requests are written to LOG_DIR/profile which keeps the
+# newest REQUEST_PROFILE_MAX_FILES profiles
+REQUEST_SLOW_THRESHOLD = float(os.environ.get("REQUEST_SLOW_THRESHOLD", 1.0))
+REQUEST_PROFILE_RATE = float(os.environ.get("REQUEST_PROFILE_RATE", 0.0))
+REQUEST_PROFILE_ON_DEMAND = bool(int(
+                            os.environ.get("REQUEST_PROFILE_ON_DEMAND", 0)))
+REQUEST_PROFILE_MAX_FILES = int(os.environ.get("REQUEST_PROFILE_MAX_FILES", 20))
+
+# logging options.  LOG_LEVELS sets per-module levels such as
+# "app.dnscache=DEBUG,app.utils=WARN" and levels of the api process can be
+# changed at runtime with /loglevel.json, the subscriber only uses LOG_LEVELS.
+# Unless LOG_ASYNC is disabled records are written by a background thread with
+# up to LOG_QUEUE_SIZE pending records, records are dropped (and counted) when
+# the queue is still full after LOG_QUEUE_TIMEOUT seconds.  Large payloads are
+# truncated to LOG_PAYLOAD_MAX characters
 LOG_DIR = os.environ.get("LOG_DIR", "/home/app/log")
-LOG_LEVEL = int(os.environ.get("LOG_LEVEL", logging.DEBUG))
+LOG_LEVEL = int(os.environ.get("LOG_LEVEL", logging.INFO))
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_ASYNC = bool(int(os.environ.get("LOG_ASYNC", 1)))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_QUEUE_TIMEOUT = float(os.environ.get("LOG_QUEUE_TIMEOUT", 0.1))
+LOG_PAYLOAD_MAX = int(os.environ.get("LOG_PAYLOAD_MAX", 4096))
 LOG_ROTATE = bool(int(os.environ.get("LOG_ROTATE", 0)))
 LOG_ROTATE_SIZE = os.environ.get("LOG_ROTATE_SIZE", 26214400)
 LOG_ROTATE_COUNT = os.environ.get("LOG_ROTATE_COUNT", 3)
@@ -34,4 +64,77 @@ APIC_PASSWORD = os.environ.get("APIC_PASSWORD", "cisco")
 APIC_CERT_MODE= bool(int(os.environ.get("APIC_CERT_MODE", 1)))
 APIC_APP_USER = os.environ.get("APIC_APP_USER", "Cisco_CLUS")
 PRIVATE_CERT = os.environ.get("PRIVATE_CERT","/home/app/credentials/plugin.key")
+# in cert mode, request a login token once and use it for following requests
+# instead of signing every request with the private key
+APIC_CERT_TOKEN_LOGIN = bool(int(os.environ.get("APIC_CERT_TOKEN_LOGIN", 1)))
+
+# number of APIC sessions kept per process (match WSGIDaemonProcess threads) and
+# max seconds to wait for a free session
+APIC_SESSION_POOL_SIZE = int(os.environ.get("APIC_SESSION_POOL_SIZE", 5))
+APIC_SESSION_POOL_TIMEOUT = int(os.environ.get("APIC_SESSION_POOL_TIMEOUT",10))
+
+# max concurrent page requests per paged APIC query once totalCount is known
+APIC_PAGE_WORKERS = int(os.environ.get("APIC_PAGE_WORKERS", 4))
+
+# max subscription events waiting to be processed (0 for unbounded) and policy
+# when full: 'drop-oldest' discards events and reloads all subscribed objects,
+# 'block' stops reading the websocket until events are processed.  A blocked
+# websocket also stops answering pings so the APIC may close it and the events
+# sent meanwhile are lost without a resync
+APIC_EVENT_QUEUE_SIZE = int(os.environ.get("APIC_EVENT_QUEUE_SIZE", 100000))
+APIC_EVENT_QUEUE_POLICY = os.environ.get("APIC_EVENT_QUEUE_POLICY",
+                            "drop-oldest")
+
+# max seconds subscriber collects events before writing batched changes to db
+SUBSCRIBER_BATCH_WINDOW = float(os.environ.get("SUBSCRIBER_BATCH_WINDOW",0.25))
+
+# seconds between writes of subscriber metrics to LOG_DIR, served by the api
+# at /metrics/subscriber (0 disables)
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", 15.0))
+
+# concurrent dns lookups per process for bulk resolve and max number of
+# addresses accepted per bulk request
+DNS_BULK_WORKERS = int(os.environ.get("DNS_BULK_WORKERS", 16))
+DNS_BULK_MAX = int(os.environ.get("DNS_BULK_MAX", 4096))
+
+# in-process dns cache memory budget in bytes (0 to disable)
+DNS_LOCAL_CACHE_MAX_BYTES = int(os.environ.get("DNS_LOCAL_CACHE_MAX_BYTES",
+                                                16777216))
+# max seconds between checks of dnsCache/dnsProv generation counters used by
+# the subscriber to invalidate in-process caches and resolvers
+DNS_GEN_INTERVAL = float(os.environ.get("DNS_GEN_INTERVAL", 1.0))
+
+# per-nameserver query timeout in seconds.  Nameservers with a rolling failure
+# rate or latency above threshold are queried last and retried after
+# DNS_RETRY_INTERVAL seconds
+DNS_TIMEOUT = float(os.environ.get("DNS_TIMEOUT", 2.0))
+DNS_FAILURE_THRESHOLD = float(os.environ.get("DNS_FAILURE_THRESHOLD", 0.3))
+DNS_SLOW_THRESHOLD = float(os.environ.get("DNS_SLOW_THRESHOLD", 1.0))
+DNS_RETRY_INTERVAL = float(os.environ.get("DNS_RETRY_INTERVAL", 30.0))
+
+# udp port of dnsProv nameservers
+DNS_PORT = int(os.environ.get("DNS_PORT", 53))
+
+# seconds to cache negative lookup results: NXDOMAIN or no PTR record, SERVFAIL
+# from all nameservers, and timeout.  Set to 0 to disable caching of the result
+DNS_NXDOMAIN_TTL = int(os.environ.get("DNS_NXDOMAIN_TTL", 600))
+DNS_SERVFAIL_TTL = int(os.environ.get("DNS_SERVFAIL_TTL", 60))
+DNS_TIMEOUT_TTL = int(os.environ.get("DNS_TIMEOUT_TTL", 30))
+
+# frequently used dnsCache entries are refreshed by the subscriber before they
+# expire.  Each web process adds its cache hits to dnsCache every
+# DNS_HITS_INTERVAL seconds.  Every DNS_REFRESH_INTERVAL seconds (0 disables)
+# up to DNS_REFRESH_MAX entries with at least DNS_REFRESH_MIN_HITS hits that
+# expire within DNS_REFRESH_AHEAD seconds are resolved again
+DNS_HITS_INTERVAL = float(os.environ.get("DNS_HITS_INTERVAL", 10.0))
+DNS_REFRESH_INTERVAL = float(os.environ.get("DNS_REFRESH_INTERVAL", 5.0))
+DNS_REFRESH_AHEAD = float(os.environ.get("DNS_REFRESH_AHEAD", 30.0))
+DNS_REFRESH_MIN_HITS = int(os.environ.get("DNS_REFRESH_MIN_HITS", 2))
+DNS_REFRESH_MAX = int(os.environ.get("DNS_REFRESH_MAX", 1000))
 
+# max number of endpoints returned by a single endpoint search
+ENDPOINT_SEARCH_MAX = int(os.environ.get("ENDPOINT_SEARCH_MAX", 10000))
+# size in bytes of capped endpointChanges log used to update the in-process
+# endpoint prefix trie, and max seconds between checks for new changes
+ENDPOINT_CHANGES_SIZE = int(os.environ.get("ENDPOINT_CHANGES_SIZE", 16777216))
+ENDPOINT_SYNC_INTERVAL = float(os.environ.get("ENDPOINT_SYNC_INTERVAL", 1.0))
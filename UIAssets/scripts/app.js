@@ -70,9 +70,40 @@ function getFromApi(url, success, error) {
     $.ajax(params);
 }
 
+function postToApi(url, data, success, error) {
+    var params = {
+        type: 'POST',
+        url: window.ENTRY_POINT + url,
+        dataType: 'json',
+        contentType: 'application/json',
+        data: JSON.stringify(data),
+        headers: {
+            'DevCookie': window.TOKEN
+        },
+        success: function (results) {
+            success(results)
+        },
+        error: function (results) {
+            error(results)
+        }
+    };
+    if (window.LOCAL) {
+        console.log('Posting local url ' + url);
+        params['url'] += '?challenge=' + window.URL_TOKEN;
+    } else {
+        console.log('Posting app url ' + url);
+        params['headers']['APIC-challenge'] = window.APIC_URL_TOKEN;
+    }
+    $.ajax(params);
+}
+
 function listEndpoints(subnet, success, error) {
     console.log('Listing endpoints');
-    getFromApi('/api/class/fvCEp.json?query-target-filter=wcard(fvCEp.ip,"' + subnet + '")&rsp-subtree=children', success, error);
+    if (subnet.indexOf('/') !== -1) {
+        getFromApi('/appcenter/Cisco/CLUS/subnet.json?prefix=' + encodeURIComponent(subnet), success, error);
+    } else {
+        getFromApi('/appcenter/Cisco/CLUS/endpoints.json?prefix=' + encodeURIComponent(subnet), success, error);
+    }
 }
 
 function resolveIp(ip, success, error) {
@@ -80,6 +111,19 @@ function resolveIp(ip, success, error) {
     getFromApi('/appcenter/Cisco/CLUS/resolve.json?ip=' + ip, success, error);
 }
 
+function resolveIps(ips, success, error) {
+    console.log('Resolving ' + ips.length + ' IPs');
+    postToApi('/appcenter/Cisco/CLUS/resolve_bulk.json', {'ips': ips}, success, error);
+}
+
+function showPtr(ip, ptr) {
+    if (ptr == "n/a") {
+        $('tbody td:contains(' + ip + ')').text(ip + " (n/a)");
+    } else {
+        $('tbody td:contains(' + ip + ')').text(ptr);
+    }
+}
+
 $(function () {
     console.log('Frontend is ready');
     if (window.LOCAL) {
@@ -95,11 +139,7 @@ $(function () {
         resolveIp(ip, function (results) {
             if ("ptr" in results ) {
                 console.log(results);
-                if (results["ptr"] == "n/a") {
-                    $('tbody td:contains(' + ip + ')').text(ip + " (n/a)");
-                } else { 
-                    $('tbody td:contains(' + ip + ')').text(results['ptr']);
-                }
+                showPtr(ip, results['ptr']);
             } else {
                 console.error(results);
             }
@@ -107,15 +147,39 @@ $(function () {
             console.error(error);
         })
     });
+    $(document).on('click', '.resolve-all', function (event) {
+        event.preventDefault();
+        var ips = $('tbody .resolve').map(function () {
+            return $(this).attr('id');
+        }).get();
+        if (ips.length == 0) {
+            return;
+        }
+        resolveIps(ips, function (results) {
+            var entries = results['results'];
+            for (var i = 0; i < entries.length; i++) {
+                if ("ptr" in entries[i]) {
+                    showPtr(entries[i]['ip'], entries[i]['ptr']);
+                } else {
+                    console.error(entries[i]);
+                }
+            }
+        }, function (error) {
+            console.error(error);
+        })
+    });
     $('form').submit(function (event) {
         event.preventDefault();
         var subnet = $('#subnet').val();
         listEndpoints(subnet, function (results) {
-            var entries = results['imdata'];
+            var entries = results['endpoints'];
             var tbody = $('tbody');
             tbody.empty();
+            if (results['truncated']) {
+                console.log('Endpoint results truncated to ' + entries.length + ' entries');
+            }
             for (var i = 0; i < entries.length; i++) {
-                var attributes = entries[i]['fvCEp'].attributes;
+                var attributes = entries[i];
                 var ip = attributes['ip'];
                 var mac = attributes['mac'];
                 var encap = attributes['encap'];